@@ -0,0 +1,117 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Benchmarks the firewall exposure index on a large synthetic firewall table
+
+Builds the FirewallIndex of security.exposure and times its exposed and
+containing queries, against a reference that parses the Range and Port
+cells of every rule for every query. Both must return the same rules.
+
+    python bench/bench_exposure.py --rules 100000
+
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from security.exposure import FirewallIndex, parse_cidr, parse_address, parse_ports
+
+COLUMNS = ['Project_ID', 'Rule_name', 'Range', 'Protocol', 'Port']
+
+PROTOCOLS = ['tcp', 'tcp', 'tcp', 'udp', 'icmp', 'all']
+PORTS = ['22', '80, 443', '3389', '8000-8080', '53', None, '1000-2000, 5432']
+RANGES = ['0.0.0.0/0', '10.0.0.0/8', '::/0', '2001:db8::/32', '']
+
+# (max_prefix, ports, address) like the exposure rules of a config
+QUERIES = [('exposed /0 on 22, 3389', dict(max_prefix=0, ports=[22, 3389])),
+           ('exposed /16 on all ports', dict(max_prefix=16)),
+           ('containing 10.1.2.3 on 443', dict(ports=[443], address='10.1.2.3')),
+           ('containing 2001:db8::1', dict(address='2001:db8::1'))]
+
+def _range(generator):
+    if generator.random() < 0.5:
+        return generator.choice(RANGES)
+    # Mostly private and a few public ranges of all sizes, some cells with several
+    cidrs = ['%d.%d.0.0/%d' % (generator.choice([10, 172, 192, 35]), generator.randint(0, 255),
+                               generator.randint(8, 32))
+             for _ in range(generator.choice([1, 1, 1, 2, 3]))]
+    return ', '.join(cidrs)
+
+def _rows(count, seed):
+    generator = random.Random(seed)
+    for i in xrange(count):
+        yield ['project-%05d' % (i // 10), 'rule-%d' % i, _range(generator),
+               generator.choice(PROTOCOLS), generator.choice(PORTS)]
+
+def naive_exposed(firewalls, max_prefix=0, ports=None, address=None):
+    """
+    Return the exposed rows, parsing the cells of every rule, like a first implementation
+    """
+
+    if address:
+        family, value = parse_address(address)
+
+    mask = np.zeros(len(firewalls), dtype=bool)
+    for row, (ranges, protocol, port) in enumerate(
+            firewalls[['Range', 'Protocol', 'Port']].values):
+        opened = False
+        for cidr in str(ranges).split(',') if ranges is not None else []:
+            if not cidr.strip():
+                continue
+            range_family, first, last, prefix = parse_cidr(cidr)
+            if address:
+                opened |= range_family == family and first <= value <= last
+            else:
+                opened |= prefix <= max_prefix
+        if opened and ports:
+            opened = any(first <= port_last and last >= port_first
+                         for first, last in parse_ports(port, protocol)
+                         for port_first, port_last in [(p, p) for p in ports])
+        mask[row] = opened
+    return mask
+
+def _best(function, repeat):
+    seconds = []
+    for _ in range(repeat):
+        start = time.time()
+        result = function()
+        seconds.append(time.time() - start)
+    return result, min(seconds)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rules', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3, help='runs per query, the best counts')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    firewalls = pd.DataFrame(list(_rows(args.rules, args.seed)), columns=COLUMNS)
+
+    index, seconds = _best(lambda: FirewallIndex(firewalls), args.repeat)
+    print "%-30s %8.3fs  %d ranges, %d port spans" % ('index build', seconds,
+                                                     len(index.range_rows), len(index.port_rows))
+    _, seconds = _best(index._radix_index, 1)
+    print "%-30s %8.3fs" % ('radix index build', seconds)
+
+    for name, query in QUERIES:
+        mask, seconds = _best(lambda: index.exposed(**query), args.repeat)
+        reference, naive_seconds = _best(lambda: naive_exposed(firewalls, **query), 1)
+        print "%-30s %8.4fs  %6.1fx faster than per rule, %d rules" % (
+            name, seconds, naive_seconds / max(seconds, 1e-6), mask.sum())
+
+        if not np.array_equal(mask, reference):
+            print "%s differs from the per rule reference" % name
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
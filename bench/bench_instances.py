@@ -0,0 +1,152 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Benchmarks listing the instances with aggregatedList against a list per zone
+
+A stub compute client answers every request after a fixed latency, like a
+GCP round trip, and pages its answers like the API. Both ways must return
+the same rows.
+
+    python bench/bench_instances.py --projects 200 --zones 40 --latency 0.05
+
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from security.collector import Collector
+from security.gcp_calls import get_instance_data
+
+class StubRequest(object):
+    """
+    A discovery request that answers one page after the latency
+    """
+
+    def __init__(self, client, method, items, page_size, token=0):
+        self.client = client
+        self.method = method
+        self.items = items
+        self.page_size = page_size
+        self.token = token
+
+    def execute(self, http=None):
+        time.sleep(self.client.latency)
+        with self.client.lock:
+            self.client.requests[self.method] = self.client.requests.get(self.method, 0) + 1
+
+        page = self.items[self.token:self.token + self.page_size]
+        response = {'items': self.client.page(self.method, page)}
+        if self.token + self.page_size < len(self.items):
+            response['nextPageToken'] = self.token + self.page_size
+        return response
+
+class StubInstances(object):
+    """
+    compute.instances() of an organization with instances in a few of its zones
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def list(self, project, zone, maxResults=None):
+        items = [item for item in self.client.project_instances[project] if item['zone'] == zone]
+        return StubRequest(self.client, 'list', items, maxResults or 500)
+
+    def aggregatedList(self, project, maxResults=None):
+        # Like the API, every zone is a scope, with or without instances
+        items = self.client.project_instances[project] + [
+            {'zone': zone, 'empty': True} for zone in self.client.zones]
+        return StubRequest(self.client, 'aggregatedList', items, maxResults or 500)
+
+    def _next(self, previous_request, previous_response):
+        if 'nextPageToken' not in previous_response:
+            return None
+        return StubRequest(self.client, previous_request.method, previous_request.items,
+                           previous_request.page_size, previous_response['nextPageToken'])
+
+    list_next = aggregatedList_next = _next
+
+class StubCompute(object):
+    """
+    The compute client of the benchmark, counts the requests per method
+    """
+
+    def __init__(self, projects, zones, instances, latency):
+        self.zones = ['zone-%02d' % i for i in range(zones)]
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = {}
+
+        # Most instances are in the first zones, like in most organizations
+        self.project_instances = {}
+        for p in range(projects):
+            self.project_instances['project-%04d' % p] = [
+                {'name': 'vm-%d' % i, 'status': 'RUNNING',
+                 'machineType': 'zones/x/machineTypes/n1-standard-1',
+                 'zone': self.zones[(p + i) % min(3, zones)]}
+                for i in range(instances)]
+
+    def instances(self):
+        return StubInstances(self)
+
+    def page(self, method, items):
+        if method == 'list':
+            return items
+
+        scopes = {}
+        for item in items:
+            scope = scopes.setdefault('zones/' + item['zone'], {})
+            if not item.get('empty'):
+                scope.setdefault('instances', []).append(item)
+            elif 'instances' not in scope:
+                scope['warning'] = {'code': 'NO_RESULTS_ON_PAGE'}
+        return scopes
+
+def _run(compute, projects, aggregated, workers, max_results):
+    compute.requests = {}
+    collector = Collector(workers=workers)
+    try:
+        start = time.time()
+        rows = get_instance_data(compute, projects, compute.zones, aggregated,
+                                 collector, max_results)
+        return rows, time.time() - start, sum(compute.requests.values())
+    finally:
+        collector.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--projects', type=int, default=200)
+    parser.add_argument('--zones', type=int, default=40)
+    parser.add_argument('--instances', type=int, default=5, help='instances per project')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per request')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--max-results', type=int, default=500, help='page size')
+    args = parser.parse_args()
+
+    compute = StubCompute(args.projects, args.zones, args.instances, args.latency)
+    projects = sorted(compute.project_instances)
+
+    results = {}
+    for name, aggregated in [('list per zone', False), ('aggregatedList', True)]:
+        results[name] = _run(compute, projects, aggregated, args.workers, args.max_results)
+        _, seconds, requests = results[name]
+        print "%-14s %7.2fs %7d requests" % (name, seconds, requests)
+
+    if results['list per zone'][0] != results['aggregatedList'][0]:
+        print "The instance rows differ"
+        sys.exit(1)
+
+    print "aggregatedList: %.1fx faster, %.1fx fewer requests (%d rows)" % (
+        results['list per zone'][1] / results['aggregatedList'][1],
+        float(results['list per zone'][2]) / results['aggregatedList'][2],
+        len(results['aggregatedList'][0]))
+
+if __name__ == '__main__':
+    main()
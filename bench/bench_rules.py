@@ -0,0 +1,116 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Benchmarks the rule evaluation on a large synthetic IAM table
+
+evaluate_rules runs on the table with object columns and on the categorical
+table of security.tables, against a reference that calls str.contains for
+every string of every rule. All three must keep and highlight the same rows.
+
+    python bench/bench_rules.py --rows 1000000
+
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from security.config import RULE_TYPES, TABLE_RULES, IAM_FIELDS, compile_rules
+from security.rules import evaluate_rules
+from security.tables import build_frame
+
+COLUMNS = ['Project_ID', 'Name', 'Email', 'Email_suffix', 'Account_type', 'Role']
+
+# The IAM section of a normalized config
+RULES = {'ignore-rules': {'email': ['my.company.com'], 'name': ['robot']},
+         'notify-rules': {'account-type': ['user', 'group']},
+         'alert-rules': {'email': ['others.com', 'gmail.com'], 'role': ['owner', 'editor']}}
+
+ROLES = [['viewer'], ['owner'], ['editor'], ['compute.admin'], ['storage.objectViewer'],
+         ['viewer', 'compute.admin'], ['editor', 'storage.admin']]
+DOMAINS = ['my.company.com', 'others.com', 'partner.com', 'gmail.com']
+TYPES = ['user', 'user', 'user', 'serviceAccount', 'group']
+
+def _rows(count, seed):
+    generator = random.Random(seed)
+    for i in xrange(count):
+        person = generator.randint(0, 20000)
+        domain = DOMAINS[person % len(DOMAINS)]
+        name = 'robot %d' % person if person % 50 == 0 else 'first%d last%d' % (person, person)
+        yield ['project-%05d' % (i // 20), name, '%s@%s' % (name.replace(' ', '.'), domain),
+               domain, TYPES[person % len(TYPES)], generator.choice(ROLES)]
+
+def naive_rules(table, rules):
+    """
+    Return (keep, highlight) with one str.contains per string, like a first implementation
+    """
+
+    keep = np.ones(len(table), dtype=bool)
+    alert = np.zeros(len(table), dtype=bool)
+
+    for rule_type in RULE_TYPES:
+        for column, strings, _ in getattr(rules, rule_type):
+            values = table[column].astype(object).map(
+                lambda value: ', '.join(value) if isinstance(value, list) else value)
+            matches = np.zeros(len(table), dtype=bool)
+            for string in strings:
+                matches |= values.str.contains(string, regex=False).fillna(False).values \
+                    .astype(bool)
+
+            if rule_type == 'ignore':
+                keep &= ~matches
+            elif rule_type == 'notify':
+                keep &= matches
+            elif rule_type == 'alert':
+                alert |= matches
+
+    return keep, keep & alert
+
+def _best(function, table, rules, repeat):
+    seconds = []
+    for _ in range(repeat):
+        start = time.time()
+        result = function(table, rules)
+        seconds.append(time.time() - start)
+    return result, min(seconds)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=3, help='runs per implementation, the best counts')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rules = compile_rules(RULES, TABLE_RULES, IAM_FIELDS)
+
+    start = time.time()
+    objects = pd.DataFrame(list(_rows(args.rows, args.seed)), columns=COLUMNS)
+    categorical = build_frame(_rows(args.rows, args.seed), COLUMNS, objects=('Role',))
+    print "%d rows built in %.1fs" % (args.rows, time.time() - start)
+
+    results = {}
+    for name, function, table in [('str.contains', naive_rules, objects),
+                                  ('evaluate_rules', evaluate_rules, objects),
+                                  ('evaluate_rules categorical', evaluate_rules, categorical)]:
+        results[name] = _best(function, table, rules, args.repeat)
+        (keep, highlight), seconds = results[name]
+        print "%-27s %7.3fs %6.1fM rows/s  %d kept, %d highlighted" % (
+            name, seconds, args.rows / seconds / 1e6, keep.sum(), highlight.sum())
+
+    reference = results['str.contains'][0]
+    for name, ((keep, highlight), _) in sorted(results.items()):
+        if not (np.array_equal(keep, reference[0]) and np.array_equal(highlight, reference[1])):
+            print "%s differs from str.contains" % name
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Benchmarks a whole run on generated organizations and reports regressions
+
+Runs the watchdog with --synthetic and --profile at every size and compares
+the stages with a baseline file. A stage regresses if it got slower or
+bigger than the tolerance allows or makes more API calls; a changed number
+of rows is reported too. --update writes the measured sizes into the
+baseline instead, e.g. before a change:
+
+    python bench/bench_synthetic.py --update
+    python bench/bench_synthetic.py --sizes 10,1000
+
+Every run writes its HTML report, so the render stage is timed, and runs in
+a temporary directory with a copy of the config (bench/bench.yaml, without
+rate limits, cache, history or snapshots), so nothing is written into the
+checkout. The synthetic organization is served with the cached discovery
+documents, so the discovery cache must hold compute v1 and
+cloudresourcemanager v1 (any run against GCP stores them).
+
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_SIZES = '10,1000,100000'
+DEFAULT_BASELINE = os.path.join(ROOT, 'bench', 'baseline.json')
+DEFAULT_CONFIG = os.path.join(ROOT, 'bench', 'bench.yaml')
+
+# Stage statistics kept in the baseline
+STAGE_KEYS = ('seconds', 'api_calls', 'rows', 'peak_rss_mb')
+
+# Differences below these are noise, whatever the tolerance
+MIN_SECONDS = 0.5
+MIN_MEMORY_MB = 20.0
+
+def _copy_config(config, directory, discovery_cache=None):
+    """
+    Copy a config into directory, with another discovery cache if given
+    """
+
+    with open(config, 'r') as the_file:
+        raw = yaml.safe_load(the_file)
+    if discovery_cache:
+        raw['general']['discovery-cache'] = os.path.abspath(discovery_cache)
+
+    path = os.path.join(directory, os.path.basename(config))
+    with open(path, 'w') as the_file:
+        yaml.safe_dump(raw, the_file, default_flow_style=False)
+    return path
+
+def run_watchdog(size, config, discovery_cache=None):
+    """
+    Run the watchdog on a synthetic organization of size projects, return its statistics
+    """
+
+    directory = tempfile.mkdtemp(prefix='bench_synthetic_')
+    try:
+        profile_file = os.path.join(directory, 'profile.json')
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([ROOT] + filter(None, [env.get('PYTHONPATH')]))
+        command = [sys.executable, '-c', 'from watchdog.watchdog import main; main()',
+                   '--config', _copy_config(config, directory, discovery_cache),
+                   '--synthetic', 'projects=%d' % size,
+                   '--output', os.path.join(directory, 'report.html'),
+                   '--profile', profile_file]
+
+        start = time.time()
+        process = subprocess.Popen(command, cwd=directory, env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        seconds = time.time() - start
+        if process.returncode != 0:
+            raise RuntimeError("the run with %d projects failed:\n%s" % (size, output))
+
+        with open(profile_file, 'r') as the_file:
+            profile = json.load(the_file)
+    finally:
+        shutil.rmtree(directory)
+
+    stages = dict((str(stage['stage']), dict((key, stage[key]) for key in STAGE_KEYS))
+                  for stage in profile['stages'])
+    return {'seconds': seconds, 'stages': stages}
+
+def _grew(old, new, tolerance, minimum):
+    return new - old > max(old * tolerance, minimum)
+
+def compare(baseline, stats, tolerance):
+    """
+    Return the regressions of the statistics of one size against its baseline
+    """
+
+    regressions = []
+    if _grew(baseline['seconds'], stats['seconds'], tolerance, MIN_SECONDS):
+        regressions.append("run: %.1fs, baseline %.1fs" % (stats['seconds'], baseline['seconds']))
+
+    for name, stage in sorted(stats['stages'].items()):
+        old = baseline['stages'].get(name)
+        if old is None:
+            continue
+
+        if _grew(old['seconds'], stage['seconds'], tolerance, MIN_SECONDS):
+            regressions.append("%s: %.1fs, baseline %.1fs" % (name, stage['seconds'],
+                                                              old['seconds']))
+        if stage['api_calls'] > old['api_calls']:
+            regressions.append("%s: %d API calls, baseline %d" % (name, stage['api_calls'],
+                                                                  old['api_calls']))
+        if _grew(old['peak_rss_mb'], stage['peak_rss_mb'], tolerance, MIN_MEMORY_MB):
+            regressions.append("%s: %.0fMB peak memory, baseline %.0fMB" % (
+                name, stage['peak_rss_mb'], old['peak_rss_mb']))
+        if stage['rows'] != old['rows']:
+            regressions.append("%s: %d rows, baseline %d" % (name, stage['rows'], old['rows']))
+
+    return regressions
+
+def _sizes(text):
+    try:
+        return [int(size) for size in text.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("use project counts, e.g. 10,1000")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=_sizes, default=_sizes(DEFAULT_SIZES),
+                        help='projects of the organizations (default: %s)' % DEFAULT_SIZES)
+    parser.add_argument('--config', '-c', default=DEFAULT_CONFIG,
+                        help='configuration file (default: bench/bench.yaml)')
+    parser.add_argument('--discovery-cache',
+                        help="""directory of the discovery documents (default: discovery-cache
+                        of the config)""")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='baseline file (default: bench/baseline.json)')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed growth of time and memory (default: 0.25)')
+    parser.add_argument('--update', action='store_true',
+                        help='write the measured sizes into the baseline file')
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as the_file:
+            baseline = json.load(the_file)
+
+    results = {}
+    regressions = []
+    for size in args.sizes:
+        stats = results[str(size)] = run_watchdog(size, os.path.abspath(args.config),
+                                                    args.discovery_cache)
+        print "%d projects: %.1fs (%s)" % (size, stats['seconds'], ', '.join(
+            '%s %.1fs' % (name, stage['seconds']) for name, stage in
+            sorted(stats['stages'].items(), key=lambda item: -item[1]['seconds'])[:3]))
+
+        if args.update:
+            continue
+        if str(size) not in baseline:
+            print "  no baseline, run with --update"
+            continue
+        for regression in compare(baseline[str(size)], stats, args.tolerance):
+            print "  REGRESSION %s" % regression
+            regressions.append(regression)
+
+    if args.update:
+        baseline.update(results)
+        with open(args.baseline, 'w') as the_file:
+            json.dump(baseline, the_file, indent=2, sort_keys=True)
+        print "Wrote %s" % args.baseline
+    elif regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -7,269 +7,117 @@ Applies the rules of the watchdog.yaml to the GCP data
 
 notify-rules: white-list
 ignore-rules: black-list
-alert-rules : color highlight
+alert-rules : color highlight (returned as a boolean mask aligned with the rows)
+
+The rules are read from the compiled config (cfg['rules'], see security.config).
 
 """
 
 import pandas as pd
 from googleapiclient.errors import HttpError
 
-# Colors for highlighting
-color_string = 'background-color: darkorange'
-default_color_string = 'background-color: '
+from security.collector import default_collector
+from security.gcp_calls import get_zone_items, get_iam_policies
+from security.scheduler import is_quota_error
+from security.rules import apply_rules
+from security.exposure import exposure_highlight
 
-def check_projects(compute, rm, projects):
+def check_projects(compute, rm, projects, collector=default_collector):
     """
     Checks if compute, ressource manager and permissions are correct
     If permissions are not met, the project is excluded
 
+    The zone list and IAM policy are fetched through the collector cache, so
+    the later stages reuse them instead of calling the APIs again.
+
     Add unaccessible projects and the reason to a dataframe(to be displayed in report)
     """
 
-    inaccessible_projects = []
-    inaccessible_reasons = []
-
-    for project in projects['Project_ID'].tolist():
-        try:
-            compute.zones().list(project=str(project)).execute()
-
-        except HttpError:
-            print("\nGCP Error: Compute Engine is not configured for %s \nor "
-                  "the service account does not have perimssions to access it" % project)
-
-            inaccessible_projects.append(str(project))
-            inaccessible_reasons.append("GCE or SA")
-
-            projects = projects[projects.Project_ID != project]
-            continue
-
-        try:
-            rm.projects().getIamPolicy(body={}, resource=str(project)).execute()
-
-        except HttpError:
+    project_IDs = projects['Project_ID'].tolist()
+    reasons = collector.map(_check_compute, project_IDs, compute, collector)
+
+    # The IAM policies are fetched with batch requests for all projects with compute access
+    policies = get_iam_policies(rm, [project for project, reason in zip(project_IDs, reasons)
+                                     if reason is None], collector)
+    for i, project in enumerate(project_IDs):
+        policy = policies.get(str(project))
+        if reasons[i] is None and is_quota_error(policy):
+            print("GCP Error: Ressource Manager quota exceeded for %s" % project)
+            reasons[i] = "Quota exceeded"
+        elif reasons[i] is None and isinstance(policy, HttpError):
             print("GCP Error: Ressource Manager is not configured for %s \nor "
                   "the service account does not have perimssions to access it" % project)
-            
-            inaccessible_projects.append(str(project))
-            inaccessible_reasons.append("RM")
+            reasons[i] = "RM"
 
-            projects = projects[projects.Project_ID != project]
-            continue
+    inaccessible_projects = [str(project) for project, reason in zip(project_IDs, reasons)
+                             if reason is not None]
+    inaccessible_reasons = [reason for reason in reasons if reason is not None]
+
+    projects = projects[~projects.Project_ID.isin(inaccessible_projects)]
 
     inaccessible_projects_df = pd.DataFrame({'Project_ID': inaccessible_projects,
         'Reason': inaccessible_reasons})
 
     return projects, inaccessible_projects_df
 
-def alert_projects(projects, general_cfg):
+def _check_compute(project, compute, collector):
     """
-    Return filtered projects
+    Return the reason why the compute engine of a project is inaccessible, or None
     """
 
-    rules_list = ['ignore-projects', 'notify-projects']
-    alert_instances_list = ['name', 'poject-ID']
-    columns_dict = {'name': 'Name', 'poject-ID': 'Project_ID'}
+    try:
+        get_zone_items(compute, project, collector)
 
-    for rule in rules_list:
+    except HttpError as error:
+        if is_quota_error(error):
+            print("\nGCP Error: Compute Engine quota exceeded for %s" % project)
+            return "Quota exceeded"
 
-        for alert in alert_instances_list:
-            if alert in general_cfg[rule].keys():
+        print("\nGCP Error: Compute Engine is not configured for %s \nor "
+              "the service account does not have perimssions to access it" % project)
+        return "GCE or SA"
 
-                if type(general_cfg[rule][alert]) == list:
-                    string = [d['string'] for d in general_cfg[rule][alert] if 'string' in d]
-                else:
-                    string = [general_cfg[rule][alert]]
+    return None
 
-                if string[0] != None:
-
-                    if rule == 'ignore-projects':
-                        projects = projects.loc[- projects[columns_dict[alert]]\
-                        .str.contains('|'.join(string))]
-                    elif rule == 'notify-projects':
-                        projects = projects.loc[projects[columns_dict[alert]]\
-                        .str.contains('|'.join(string))]
+def alert_projects(projects, rules):
+    """
+    Return filtered projects
+    """
 
-    projects.reset_index(inplace=True)
-    projects.drop('index', axis=1, inplace=True)
-    projects.index += 1
+    projects, _ = apply_rules(projects, rules)
     return projects
 
-def alert_zones(zones, general_cfg):
+def alert_zones(zones, rules):
     """
     Return filtered zones
     """
 
-    rules_list = ['ignore-zones', 'notify-zones']
-    alert_instances_list = ['name']
-    columns_dict = {'name': 'Name'}
-
-    for rule in rules_list:
-
-        for alert in alert_instances_list:
-            if alert in general_cfg[rule].keys():
-
-                if type(general_cfg[rule][alert]) == list:
-
-                    string = [d['string'] for d in general_cfg[rule][alert] if 'string' in d]
-                else:
-                    string = [general_cfg[rule][alert]]
-
-                if string[0] != None:
-
-                    if   rule == 'ignore-zones':
-                        zones = zones.loc[- zones[columns_dict[alert]]\
-                        .str.contains('|'.join(string))]
-                    elif rule == 'notify-zones':
-                        zones = zones.loc[zones[columns_dict[alert]]\
-                        .str.contains('|'.join(string))]
-
-    zones.reset_index(inplace=True)
-    zones = zones.drop('index', axis=1)
-    zones.index += 1
+    zones, _ = apply_rules(zones, rules)
     return zones
 
-def alert_instances(instances, alert_cfg):
+def alert_instances(instances, rules):
     """
     Return filtered instances of all projects
     """
 
-    rules_list = ['ignore-rules', 'notify-rules', 'alert-rules']
-    alert_instances_list = ['status', 'machine-type', 'name']
-    columns_dict = {'status': 'Status', 'machine-type': 'Machine_type', 'name': 'Instance'}
-    highlight_index = []
-
-    for rule in rules_list:
-        # Prepare for alert highlighting
-        if rule == 'alert-rules':
-            instances.reset_index(inplace=True)
-            instances = instances.drop('index', axis=1)
-            instances.index += 1
-
-        for alert in alert_instances_list:
-            if alert in alert_cfg[rule].keys():
-
-                if type(alert_cfg[rule][alert]) == list:
-                    string = [d['string'] for d in alert_cfg[rule][alert] if 'string' in d]
-                else:
-                    string = [alert_cfg[rule][alert]]
-
-                if string[0] != None:
-
-                    if   rule == 'ignore-rules':
-                        instances = instances.loc[- instances[columns_dict[alert]]\
-                        .str.contains('|'.join(string))]
-                    elif rule == 'notify-rules':
-                        instances = instances.loc[instances[columns_dict[alert]]\
-                        .str.contains('|'.join(string))]
-                    elif rule == 'alert-rules':
-                        highlight_index.extend(instances[instances[columns_dict[alert]]\
-                            .str.contains('|'.join(string))].index.tolist())
-
-    colors = [color_string for i in range(instances.shape[1])]
-    default_colors = [default_color_string for i in range(instances.shape[1])]
-
-    instances_styler = instances.style
-    if instances.shape[0] > 0:
-        instances_styler = instances_styler.apply(
-            lambda x: colors if (x.name in set(highlight_index)) else default_colors, axis=1)
-
-    instances_styler.set_table_attributes("border=1")
-    return instances, instances_styler
-
-def alert_iam(iam, alert_cfg):
+    return apply_rules(instances, rules)
+
+def alert_iam(iam, rules):
     """
     Returns filtered persona and accounts
     """
 
-    rules_list = ['ignore-rules', 'notify-rules', 'alert-rules']
-    alert_instances_list = ['name', 'email', 'account-type', 'role']
-    columns_dict = {'name': 'Name', 'email': 'Email',
-                    'account-type': 'Account_type', 'role': 'Role'}
-    highlight_index = []
-
-    for rule in rules_list:
-        # Prepare for alert highlighting
-        if rule == 'alert-rules':
-            iam.reset_index(inplace=True)
-            iam = iam.drop('index', axis=1)
-            iam.index += 1
-
-        for alert in alert_instances_list:
-            if alert in alert_cfg[rule].keys():
-
-                if type(alert_cfg[rule][alert]) == list:
-                    string = [d['string'] for d in alert_cfg[rule][alert] if 'string' in d]
-                else:
-                    string = [alert_cfg[rule][alert]]
-
-                if string[0] != None:
-
-                    if   rule == 'ignore-rules':
-                        iam = iam.loc[- iam[columns_dict[alert]]\
-                        .str.contains('|'.join(string))]
-                    elif rule == 'notify-rules':
-                        iam = iam.loc[iam[columns_dict[alert]].\
-                        str.contains('|'.join(string))]
-                    elif rule == 'alert-rules':
-                        highlight_index.extend(iam[iam[columns_dict[alert]]\
-                            .str.contains('|'.join(string))].index.tolist())
-
-    colors = [color_string for i in range(iam.shape[1])]
-    default_colors = [default_color_string for i in range(iam.shape[1])]
-
-    iam_styler = iam.style
-    if iam.shape[0] > 0:
-        iam_styler = iam_styler.apply(
-            lambda x: colors if (x.name in set(highlight_index)) else default_colors, axis=1)
-
-    iam_styler.set_table_attributes("border=1")
-    return iam, iam_styler
-
-def alert_firewalls(firewalls, alert_cfg):
+    return apply_rules(iam, rules)
+
+def alert_firewalls(firewalls, rules):
     """
     Returns filtered firewall
     """
-    rules_list = ['ignore-rules', 'notify-rules', 'alert-rules']
-    alert_instances_list = ['name', 'range', 'protocol', 'port']
-    columns_dict = {'name': 'Rule_name', 'range': 'Range',
-                    'protocol': 'Protocol', 'port': 'Port'}
-    highlight_index = []
-
-    for rule in rules_list:
-        # Prepare for alert highlighting
-        if rule == 'alert-rules':
-            firewalls.reset_index(inplace=True)
-            firewalls = firewalls.drop('index', axis=1)
-            firewalls = firewalls.drop('Firewall_type', axis=1)
-            firewalls.index += 1
-
-        for alert in alert_instances_list:
-            if alert in alert_cfg[rule].keys():
-
-                if type(alert_cfg[rule][alert]) == list:
-                    string = [d['string'] for d in alert_cfg[rule][alert] if 'string' in d]
-                else:
-                    string = [alert_cfg[rule][alert]]
-
-                if string[0] != None:
-
-                    if   rule == 'ignore-rules':
-                        firewalls = firewalls.loc[- firewalls[columns_dict[alert]]\
-                        .str.contains('|'.join(string))]
-                    elif rule == 'notify-rules':
-                        firewalls = firewalls.loc[firewalls[columns_dict[alert]]\
-                        .str.contains('|'.join(string))]
-                    elif rule == 'alert-rules':
-                        highlight_index.extend(firewalls[firewalls[columns_dict[alert]]\
-                        .str.contains('|'.join(string))].index.tolist())
-
-    colors = [color_string for i in range(firewalls.shape[1])]
-    default_colors = [default_color_string for i in range(firewalls.shape[1])]
-
-    firewalls_styler = firewalls.style
-    if firewalls.shape[0] > 0:
-        firewalls_styler = firewalls_styler.apply(
-            lambda x: colors if (x.name in set(highlight_index)) else default_colors, axis=1)
-
-    firewalls_styler.set_table_attributes("border=1")
-    return firewalls, firewalls_styler
\ No newline at end of file
+
+    firewalls, highlight = apply_rules(firewalls, rules)
+
+    # Rules opening ports to wide ranges are highlighted as well
+    highlight = highlight | exposure_highlight(firewalls, rules.exposure)
+
+    firewalls = firewalls.drop('Firewall_type', axis=1)
+    return firewalls, highlight
@@ -0,0 +1,209 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Turns Admin Activity audit-log entries into patches of the inventory tables
+
+Handled entries (LogEntry JSON, as exported by a log sink):
+
+    SetIamPolicy (cloudresourcemanager)    the IAM rows of the project
+    compute.firewalls.insert/update/patch/delete
+                                           the rows of the firewall rule
+    compute.instances.insert/delete/start/stop/suspend/resume/setMachineType
+                                           the row of the instance
+
+When an entry carries the new state (the policy in the response, the
+firewall or instance in the request) it is patched in directly, otherwise
+(e.g. firewalls.patch, which only has the changed fields) the rows of the
+project are fetched again. Failed operations and other methods are ignored.
+
+Subscribers deliver the entries: FileSubscriber follows a JSONL file (e.g.
+written by a Pub/Sub subscription of the sink), QueueSubscriber is fed from
+Python. Any object with pull() returning a list of entries can be used.
+
+"""
+
+import json
+import os
+import re
+import threading
+
+from security.gcp_calls import instance_row, firewall_rows, iam_member_rows
+
+# e.g. v1.compute.instances.insert, beta.compute.firewalls.patch
+_compute_method_pattern = re.compile(r'compute\.(instances|firewalls)\.(\w+)$')
+
+# e.g. projects/my-project/zones/europe-west1-b/instances/vm-1
+_resource_pattern = re.compile(r'projects/([^/]+)(?:/zones/([^/]+))?'
+                               r'(?:/(?:global/)?(?:instances|firewalls)/([^/]+))?')
+
+# Instance status after a successful operation
+INSTANCE_STATUS = {'insert': 'RUNNING', 'start': 'RUNNING', 'resume': 'RUNNING',
+                   'stop': 'TERMINATED', 'suspend': 'SUSPENDED'}
+
+class Patch(object):
+    """
+    Change of one report table (kind is its config section, see watchdog.sections)
+
+    The rows matching `match` ({column: value}) are replaced by
+    rows   : the new rows, in the column order of the table
+    values : the matched rows with these {column: value} changes
+    refetch: the rows of the project fetched again (entries without the new state)
+
+    policy is the new IAM policy of a SetIamPolicy entry, to update the cache.
+    """
+
+    def __init__(self, kind, project, match, rows=None, values=None, refetch=False,
+                 policy=None):
+        self.kind = kind
+        self.project = project
+        self.match = match
+        self.rows = rows
+        self.values = values
+        self.refetch = refetch
+        self.policy = policy
+
+    def __repr__(self):
+        return 'Patch(%s, %s)' % (self.kind, self.match)
+
+def _firewall(resource):
+    """
+    Return a firewall resource with the field names of the compute API
+
+    The requests in the audit log name the list of allowed protocols 'alloweds'.
+    """
+
+    resource = dict(resource)
+    if 'alloweds' in resource and 'allowed' not in resource:
+        resource['allowed'] = resource.pop('alloweds')
+    return resource
+
+def parse_entry(entry):
+    """
+    Return the patches of an audit-log entry (a dict), [] for unrelated entries
+    """
+
+    payload = entry.get('protoPayload') or {}
+    method = str(payload.get('methodName', ''))
+    if (payload.get('status') or {}).get('code'):
+        # Failed operation, nothing changed
+        return []
+
+    match = _resource_pattern.search(str(payload.get('resourceName', '')))
+    labels = (entry.get('resource') or {}).get('labels') or {}
+    project = str(match.group(1) if match else labels.get('project_id', ''))
+    if not project:
+        return []
+
+    if method.endswith('SetIamPolicy'):
+        # Only project policies, not those of buckets, topics, ...
+        if payload.get('serviceName') != 'cloudresourcemanager.googleapis.com':
+            return []
+
+        policy = payload.get('response') or {}
+        if 'bindings' not in policy:
+            return [Patch('IAM', project, {'Project_ID': project}, refetch=True)]
+        return [Patch('IAM', project, {'Project_ID': project},
+                      rows=iam_member_rows(project, policy), policy=policy)]
+
+    compute_method = _compute_method_pattern.search(method)
+    if compute_method is None or match is None or not match.group(3):
+        return []
+
+    collection, operation = compute_method.groups()
+    name = str(match.group(3))
+    request = payload.get('request') or {}
+
+    if collection == 'firewalls':
+        rule = {'Project_ID': project, 'Rule_name': name}
+        if operation == 'delete':
+            return [Patch('firewall', project, rule, rows=[])]
+        if operation in ('insert', 'update') and request:
+            return [Patch('firewall', project, rule, rows=firewall_rows(
+                project, dict(_firewall(request), name=name)))]
+        if operation in ('insert', 'update', 'patch'):
+            return [Patch('firewall', project, rule, refetch=True)]
+        return []
+
+    zone = str(match.group(2) or labels.get('zone', ''))
+    instance = {'Project_ID': project, 'Zone': zone, 'Instance': name}
+    if operation == 'delete':
+        return [Patch('compute', project, instance, rows=[])]
+    if operation == 'insert':
+        if not request.get('machineType'):
+            # Only the first entry of an operation has the request
+            return []
+        return [Patch('compute', project, instance, rows=[instance_row(
+            project, zone, {'name': name, 'status': INSTANCE_STATUS['insert'],
+                            'machineType': request['machineType']})])]
+    if operation in INSTANCE_STATUS:
+        return [Patch('compute', project, instance, values={'Status': INSTANCE_STATUS[operation]})]
+    if operation == 'setMachineType' and request.get('machineType'):
+        return [Patch('compute', project, instance, values={
+            'Machine_type': str(request['machineType']).split('/')[-1]})]
+    return []
+
+def parse_entries(entries):
+    """
+    Return the patches of a list of entries, in order
+    """
+
+    return [patch for entry in entries for patch in parse_entry(entry)]
+
+class FileSubscriber(object):
+    """
+    Follows a JSONL file of audit-log entries, pull() returns the new ones
+
+    With from_start=False the entries already in the file are skipped. A
+    partly written last line is kept until it is complete, lines that are
+    not JSON are skipped.
+    """
+
+    def __init__(self, path, from_start=False):
+        self.path = path
+        self._offset = 0
+        if not from_start and os.path.exists(path):
+            self._offset = os.path.getsize(path)
+
+    def pull(self):
+        if not os.path.exists(self.path):
+            return []
+
+        if os.path.getsize(self.path) < self._offset:
+            # The file was truncated or rotated
+            self._offset = 0
+
+        entries = []
+        with open(self.path, 'r') as the_file:
+            the_file.seek(self._offset)
+            for line in iter(the_file.readline, ''):
+                if not line.endswith('\n'):
+                    break
+                self._offset += len(line)
+                if not line.strip():
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except ValueError as error:
+                    print "Skipping a bad line of %s: %s" % (self.path, error)
+
+        return entries
+
+class QueueSubscriber(object):
+    """
+    In-memory subscriber: push() entries, pull() returns them (thread-safe)
+    """
+
+    def __init__(self):
+        self._entries = []
+        self._lock = threading.Lock()
+
+    def push(self, entry):
+        with self._lock:
+            self._entries.append(entry)
+
+    def pull(self):
+        with self._lock:
+            entries, self._entries = self._entries, []
+        return entries
@@ -0,0 +1,204 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Inventory backends: where the projects, zones, instances, firewall rules and
+IAM policies of the report come from
+
+ApiBackend        : crawls the Compute Engine and Resource Manager APIs per project
+AssetExportBackend: streams one organization-wide Cloud Asset Inventory export
+                    (newline-delimited JSON)
+
+Both have the methods that watchdog.sections calls, their rows have the
+columns of the report tables:
+
+get_projects()                      [Name, Project_ID] rows of all projects
+check_projects(projects)            the accessible projects and a DataFrame of
+                                    inaccessible ones (Project_ID, Reason)
+get_zones(project_IDs)              the names of all zones
+iter_instances(project_IDs, zones)  [Instance, Status, Machine_type, Project_ID, Zone]
+iter_firewalls(project_IDs)         [Project_ID, Rule_name, Range, Protocol, Port,
+                                     Firewall_type]
+iter_iam_members(project_IDs)       [Project_ID, Name, Email, Email_suffix,
+                                     Account_type, Role] with the list of roles
+
+"""
+
+import json
+import re
+
+import pandas as pd
+
+from security.collector import default_collector
+from security.gcp_calls import get_projects, get_gcp_zones, iter_instance_data
+from security.gcp_calls import iter_firewall_data, iter_iam_members
+from security.gcp_calls import instance_row, firewall_rows, iam_member_rows
+from security.alerts import check_projects
+
+class ApiBackend(object):
+    """
+    Crawls the GCP APIs project by project (see security.gcp_calls)
+    """
+
+    def __init__(self, compute, rm, collector=default_collector, max_results=None):
+        self.compute = compute
+        self.rm = rm
+        self.collector = collector
+        self.max_results = max_results
+
+    def get_projects(self):
+        return get_projects(self.rm, self.collector, self.max_results)
+
+    def check_projects(self, projects):
+        return check_projects(self.compute, self.rm, projects, self.collector)
+
+    def get_zones(self, project_IDs):
+        return get_gcp_zones(self.compute, project_IDs[0], self.collector, self.max_results)
+
+    def iter_instances(self, project_IDs, zones):
+        return iter_instance_data(self.compute, project_IDs, zones, collector=self.collector,
+                                  max_results=self.max_results)
+
+    def iter_firewalls(self, project_IDs):
+        return iter_firewall_data(self.compute, project_IDs, self.collector, self.max_results)
+
+    def iter_iam_members(self, project_IDs):
+        return iter_iam_members(self.rm, project_IDs, self.collector)
+
+# e.g. //compute.googleapis.com/projects/my-project/zones/europe-west1-b/instances/vm-1
+_project_pattern = re.compile(r'/projects/([^/]+)')
+
+# The asset type and name of a line, read without parsing the whole asset
+_asset_type_pattern = re.compile(r'"asset_?[tT]ype"\s*:\s*"([^"]+)"')
+_asset_name_pattern = re.compile(r'"name"\s*:\s*"//[^"]*?/projects/([^/"]+)')
+
+PROJECT_ASSET = 'cloudresourcemanager.googleapis.com/Project'
+INSTANCE_ASSET = 'compute.googleapis.com/Instance'
+FIREWALL_ASSET = 'compute.googleapis.com/Firewall'
+
+def _resource(asset):
+    """
+    Return the project and resource data of a compute asset (None if it has no data)
+    """
+
+    match = _project_pattern.search(asset.get('name', ''))
+    data = (asset.get('resource') or {}).get('data')
+    if match is None or not data:
+        return None, None
+    return match.group(1), data
+
+class AssetExportBackend(object):
+    """
+    Streams a Cloud Asset Inventory export (one JSON asset per line)
+
+    source is the path of the export or a list of its lines. The projects and
+    zones are read in a first pass, then every table is streamed from its own
+    pass over the export, which only parses the lines of its asset type. So
+    large exports are never held in memory. Exports with the resource and the
+    IAM policy content type can be concatenated into one file. An iterator of
+    lines (e.g. a generator) can only be read once, it is kept in a list.
+
+    Instances and firewall rules are yielded in the order of the export.
+    """
+
+    def __init__(self, source):
+        if not isinstance(source, basestring) and iter(source) is source:
+            source = list(source)
+        self.source = source
+        self._projects = None
+
+    def _lines(self):
+        if isinstance(self.source, basestring):
+            with open(self.source, 'r') as the_file:
+                for line in the_file:
+                    yield line
+        else:
+            for line in self.source:
+                yield line
+
+    def _assets(self, asset_type):
+        """
+        Yield the assets of one type
+        """
+
+        for line in self._lines():
+            match = _asset_type_pattern.search(line)
+            if match is not None and match.group(1) == asset_type:
+                yield json.loads(line)
+
+    def _scan(self):
+        # Projects, project numbers (IAM policies are named by number) and zones
+        if self._projects is not None:
+            return
+
+        projects, numbers, zones, named = [], {}, set(), set()
+
+        for line in self._lines():
+            match = _asset_type_pattern.search(line)
+            asset_type = match.group(1) if match is not None else None
+
+            if asset_type == PROJECT_ASSET:
+                asset = json.loads(line)
+                data = (asset.get('resource') or {}).get('data')
+                if data:
+                    project = str(data['projectId'])
+                    numbers[asset['name'].rsplit('/', 1)[-1]] = project
+                    projects.append([str(data.get('name', project)), project])
+
+            elif asset_type == INSTANCE_ASSET:
+                project, data = _resource(json.loads(line))
+                if data:
+                    zones.add(str(data['zone']).split('/')[-1])
+                    named.add(project)
+
+            elif asset_type == FIREWALL_ASSET:
+                match = _asset_name_pattern.search(line)
+                if match is not None:
+                    named.add(match.group(1))
+
+        # Exports without project assets: the projects named by the resources
+        self._projects = projects or [[name, name] for name in sorted(named)]
+        self._numbers = numbers
+        self._zones = sorted(zones)
+
+    def get_projects(self):
+        self._scan()
+        return self._projects
+
+    def check_projects(self, projects):
+        # Everything in the export was readable when it was taken
+        return projects, pd.DataFrame({'Project_ID': [], 'Reason': []})
+
+    def get_zones(self, project_IDs):
+        self._scan()
+        return self._zones
+
+    def iter_instances(self, project_IDs, zones):
+        project_IDs, zones = set(str(project) for project in project_IDs), set(zones)
+        for asset in self._assets(INSTANCE_ASSET):
+            project, data = _resource(asset)
+            if project in project_IDs:
+                zone = str(data['zone']).split('/')[-1]
+                if zone in zones:
+                    yield instance_row(project, zone, data)
+
+    def iter_firewalls(self, project_IDs):
+        project_IDs = set(str(project) for project in project_IDs)
+        for asset in self._assets(FIREWALL_ASSET):
+            project, data = _resource(asset)
+            if project in project_IDs:
+                for row in firewall_rows(project, data):
+                    yield row
+
+    def iter_iam_members(self, project_IDs):
+        self._scan()
+        project_IDs = set(str(project) for project in project_IDs)
+        members = {}
+        for asset in self._assets(PROJECT_ASSET):
+            policy = asset.get('iam_policy', asset.get('iamPolicy'))
+            number = asset['name'].rsplit('/', 1)[-1]
+            project = self._numbers.get(number, number)
+            if policy is not None and project in project_IDs:
+                for row in iam_member_rows(project, policy, members):
+                    yield row
@@ -0,0 +1,167 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Caches GCP responses per (resource kind, project)
+
+MemoryCache keeps the responses of one run. DiskCache additionally keeps them
+in a SQLite file between runs, with a TTL per resource kind.
+
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+def fingerprint(value):
+    """
+    Return a content hash of a JSON serializable response
+    """
+
+    return hashlib.sha1(json.dumps(value, sort_keys=True)).hexdigest()
+
+class MemoryCache(object):
+    """
+    Keeps responses for the lifetime of one run
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind, project):
+        """
+        Return the cached response or None
+        """
+
+        with self._lock:
+            return self._data.get((kind, str(project)))
+
+    def set(self, kind, project, value, tag=None):
+        """
+        Cache a response
+        """
+
+        with self._lock:
+            self._data[(kind, str(project))] = value
+
+    def invalidate(self, kind, project=None):
+        """
+        Drop the responses of a kind (or of one project), so they are fetched again
+        """
+
+        with self._lock:
+            for key in [key for key in self._data if key[0] == kind and
+                        (project is None or key[1] == str(project))]:
+                del self._data[key]
+
+class DiskCache(MemoryCache):
+    """
+    Keeps responses in a SQLite file between runs
+
+    ttls maps a resource kind to the number of seconds a response stays valid.
+    Kinds without a TTL are only cached for the current run. With refresh=True
+    the file is not read, but still updated with the new responses.
+
+    Expired entries are fetched again in full (getIamPolicy and the compute
+    list calls have no conditional requests). Every entry keeps a tag (the IAM
+    policy etag or a fingerprint of the firewall rules): if the new response
+    has the same tag, only the timestamp of the entry is renewed and the
+    response is counted as unchanged.
+    """
+
+    def __init__(self, path, ttls=None, refresh=False):
+        super(DiskCache, self).__init__()
+        self.ttls = dict(ttls or {})
+        self.refresh = refresh
+        self.stats = {}
+
+        # Shard processes of one crawl write to the same file, wait for their locks
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                kind TEXT, project TEXT, stored REAL, tag TEXT, value TEXT,
+                                PRIMARY KEY (kind, project))""")
+        self._db.commit()
+
+    def _count(self, kind, outcome):
+        counts = self.stats.setdefault(kind, {'hits': 0, 'misses': 0, 'unchanged': 0})
+        counts[outcome] += 1
+
+    def get(self, kind, project):
+        """
+        Return the response of this run, a valid response from disk, or None
+        """
+
+        value = super(DiskCache, self).get(kind, project)
+        if value is not None:
+            return value
+
+        ttl = self.ttls.get(kind)
+        if not ttl:
+            return None
+
+        row = None
+        if not self.refresh:
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT value FROM responses WHERE kind = ? AND project = ? AND stored > ?",
+                    (kind, str(project), time.time() - ttl)).fetchone()
+
+        with self._lock:
+            self._count(kind, 'hits' if row is not None else 'misses')
+
+        if row is None:
+            return None
+
+        value = json.loads(row[0])
+        super(DiskCache, self).set(kind, project, value)
+        return value
+
+    def set(self, kind, project, value, tag=None):
+        """
+        Cache a response for this run and, if its kind has a TTL, on disk
+        """
+
+        super(DiskCache, self).set(kind, project, value)
+
+        if not self.ttls.get(kind):
+            return
+
+        with self._lock:
+            row = self._db.execute("SELECT tag FROM responses WHERE kind = ? AND project = ?",
+                                   (kind, str(project))).fetchone()
+
+            if tag is not None and row is not None and row[0] == tag:
+                self._db.execute("UPDATE responses SET stored = ? WHERE kind = ? AND project = ?",
+                                 (time.time(), kind, str(project)))
+                self._count(kind, 'unchanged')
+            else:
+                self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                                 (kind, str(project), time.time(), tag, json.dumps(value)))
+            self._db.commit()
+
+    def invalidate(self, kind, project=None):
+        """
+        Expire the responses of a kind (or of one project), they are fetched again
+        """
+
+        super(DiskCache, self).invalidate(kind, project)
+
+        with self._lock:
+            if project is None:
+                self._db.execute("UPDATE responses SET stored = 0 WHERE kind = ?", (kind,))
+            else:
+                self._db.execute("UPDATE responses SET stored = 0 WHERE kind = ? AND project = ?",
+                                 (kind, str(project)))
+            self._db.commit()
+
+    def close(self):
+        """
+        Close the SQLite file
+        """
+
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,196 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Fans the per-project GCP calls out over a bounded pool of worker threads
+
+The discovery clients are shared, but httplib2 is not thread-safe, so every
+worker executes its requests on its own http object. The worker threads and
+their http objects (with their open connections) are kept until close(), so
+later sections and daemon polls reuse warm connections.
+
+"""
+
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from security.profiling import CountingHttp
+
+class Collector(object):
+    """
+    Runs per-project calls with at most `workers` threads
+
+    http_factory returns a new authorized http object. It is called once per
+    worker thread. Without it the requests use the http of their client.
+
+    cache (see security.cache) keeps responses that are needed by several
+    stages, e.g. the IAM policy fetched by check_projects and get_people_access.
+
+    scheduler (see security.scheduler) applies rate limits and retries to
+    every request.
+
+    profiler (see security.profiling) counts the requests, response bytes and
+    request time of every project.
+    """
+
+    def __init__(self, http_factory=None, workers=1, cache=None, scheduler=None, profiler=None):
+        self.http_factory = http_factory
+        self.workers = max(1, int(workers or 1))
+        self.cache = cache
+        self.scheduler = scheduler
+        self.profiler = profiler
+        self._local = threading.local()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _workers(self):
+        # Started on first use, kept until close()
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            return self._pool
+
+    def close(self):
+        """
+        Stop the worker threads, dropping their http objects
+        """
+
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def http(self):
+        """
+        Return the http object of the current thread
+        """
+
+        if self.http_factory is None:
+            return None
+
+        if not hasattr(self._local, 'http'):
+            self._local.http = self.http_factory()
+            if self.profiler is not None:
+                self._local.http = CountingHttp(self._local.http, self.profiler)
+
+        return self._local.http
+
+    def execute(self, request):
+        """
+        Execute a discovery request on the http object of the current thread
+        """
+
+        if self.profiler is None:
+            return self._execute(request)
+
+        start = time.time()
+        try:
+            return self._execute(request)
+        finally:
+            self.profiler.record_request(time.time() - start)
+
+    def _execute(self, request):
+        http = self.http()
+        if self.scheduler is not None:
+            return self.scheduler.execute(request, http)
+
+        if http is None:
+            return request.execute()
+
+        return request.execute(http=http)
+
+    def _set_project(self, project):
+        # Batches of projects (e.g. the IAM batch requests) are not attributed
+        if self.profiler is not None:
+            self.profiler.set_project(project if isinstance(project, basestring) else None)
+
+    def cached(self, kind, project, fetch, tag=None):
+        """
+        Return the cached response for (kind, project) or call fetch() and cache it
+
+        tag(response) returns the value that tells whether a refetched entry changed.
+        Errors raised by fetch are not cached.
+        """
+
+        if self.cache is None:
+            return fetch()
+
+        response = self.cache.get(kind, project)
+        if response is None:
+            response = fetch()
+            self.cache.set(kind, project, response, tag(response) if tag else None)
+
+        return response
+
+    def map(self, function, project_IDs, *args):
+        """
+        Call function(project, *args) for every project
+
+        Results are returned in the order of project_IDs, independent of the
+        number of workers, so reports stay comparable between runs.
+        """
+
+        project_IDs = list(project_IDs)
+
+        def call(project):
+            # Reset even if function fails, the thread runs the next project after it
+            self._set_project(project)
+            try:
+                return function(project, *args)
+            finally:
+                self._set_project(None)
+
+        if self.workers == 1 or len(project_IDs) < 2:
+            return [call(project) for project in project_IDs]
+
+        return self._workers().map(call, project_IDs, chunksize=1)
+
+    def imap_rows(self, function, project_IDs, *args):
+        """
+        Yield the rows of function(project, *args) project by project
+
+        function returns an iterable of rows. With one worker the rows are
+        streamed as they arrive. With more workers each project is read into a
+        list by its worker and at most a window of a few projects per worker is
+        held in memory at a time.
+        """
+
+        project_IDs = list(project_IDs)
+
+        if self.workers == 1 or len(project_IDs) < 2:
+            try:
+                for project in project_IDs:
+                    self._set_project(project)
+                    for row in function(project, *args):
+                        yield row
+            finally:
+                self._set_project(None)
+            return
+
+        def call(project):
+            self._set_project(project)
+            try:
+                return list(function(project, *args))
+            finally:
+                self._set_project(None)
+
+        window = 4 * self.workers
+        pool = self._workers()
+        for start in range(0, len(project_IDs), window):
+            for rows in pool.imap(call, project_IDs[start:start + window]):
+                for row in rows:
+                    yield row
+
+    def map_rows(self, function, project_IDs, *args):
+        """
+        Like imap_rows, but returns all rows in one list
+        """
+
+        return list(self.imap_rows(function, project_IDs, *args))
+
+# Sequential collector used when the caller does not pass one
+default_collector = Collector()
@@ -0,0 +1,378 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Compiles the watchdog.yaml: validates it once and normalizes its rules
+
+compile_config checks every key and value against SCHEMA and raises a
+ConfigError listing all problems (e.g. a misspelled rule field, which would
+otherwise silently disable the rule). Empty settings are dropped, so their
+defaults apply, and missing report sections are not printed.
+
+The rule sections are compiled into an immutable RuleSet (cfg['rules']), the
+only form of the rules that security.alerts reads: per table the ignore,
+notify and alert rules as (column, strings, regex) and the exposure rules.
+
+load_config keeps the normalized config next to the YAML file (.<file>.compiled,
+JSON after a line with the hash of the YAML content), so unchanged files are
+not parsed and checked again; only the rule regexes are compiled on load.
+
+"""
+
+import difflib
+import hashlib
+import json
+import os
+import re
+from collections import namedtuple
+
+import yaml
+
+# Bumped whenever the compiled form changes, so old compiled files are ignored
+COMPILER_VERSION = 2
+
+# Rule types in the order they are applied
+RULE_TYPES = ('ignore', 'notify', 'alert')
+
+# Rule sections (per rule type) and rule fields (per table column) of the watchdog.yaml
+PROJECT_RULES = {'ignore': 'ignore-projects', 'notify': 'notify-projects'}
+PROJECT_FIELDS = {'name': 'Name', 'project-ID': 'Project_ID'}
+
+ZONE_RULES = {'ignore': 'ignore-zones', 'notify': 'notify-zones'}
+ZONE_FIELDS = {'name': 'Name'}
+
+TABLE_RULES = {'ignore': 'ignore-rules', 'notify': 'notify-rules', 'alert': 'alert-rules'}
+INSTANCE_FIELDS = {'status': 'Status', 'machine-type': 'Machine_type', 'name': 'Instance'}
+IAM_FIELDS = {'name': 'Name', 'email': 'Email', 'account-type': 'Account_type', 'role': 'Role'}
+FIREWALL_FIELDS = {'name': 'Rule_name', 'range': 'Range', 'protocol': 'Protocol', 'port': 'Port'}
+
+# Old spellings of rule fields that are still accepted
+DEPRECATED_FIELDS = {'poject-ID': 'project-ID'}
+
+# A rule matches if one of its strings appears in the column value
+Rule = namedtuple('Rule', ['column', 'strings', 'regex'])
+
+# Rules of one table, a tuple of Rules per rule type and of ExposureRules
+TableRules = namedtuple('TableRules', ['ignore', 'notify', 'alert', 'exposure'])
+
+# Firewall rules opening ports to wide ranges (see security.exposure)
+ExposureRule = namedtuple('ExposureRule', ['max_prefix', 'ports', 'address'])
+
+# Rules of all tables, the tables by their config section
+RuleSet = namedtuple('RuleSet', ['projects', 'zones', 'compute', 'IAM', 'firewall'])
+
+class ConfigError(ValueError):
+    """
+    Raised for an invalid configuration file, with all problems found
+    """
+
+class Section(object):
+    """
+    Schema of a mapping with known keys
+    """
+
+    def __init__(self, fields, required=()):
+        self.fields = fields
+        self.required = required
+
+class MapOf(object):
+    """
+    Schema of a mapping with any keys and values of one schema
+    """
+
+    def __init__(self, values):
+        self.values = values
+
+class ListOf(object):
+    """
+    Schema of a list of items of one schema
+    """
+
+    def __init__(self, items):
+        self.items = items
+
+TEXT = basestring
+NUMBER = (int, long, float)
+
+# A rule field: empty, one string (or number) or a list of '- string:' items
+RULE = 'rule'
+
+# A port of an exposure rule: a number or a range, e.g. 22 or '1000-2000'
+PORT = 'port'
+
+def _rule_section(fields):
+    return Section(dict((field, RULE) for field in fields))
+
+def _table_section(fields, **extra):
+    schema = dict((section, _rule_section(fields)) for section in TABLE_RULES.values())
+    schema['print'] = bool
+    schema.update(extra)
+    return Section(schema, required=['print'])
+
+GENERAL_SCHEMA = Section({
+    'report-title': TEXT,
+    'watchdog-email': TEXT,
+    'receiver-email': ListOf(Section({'email': TEXT}, required=['email'])),
+    'concurrency': int,
+    'max-results': int,
+    'rate-limits': MapOf(NUMBER),
+    'retries': int,
+    'cache': Section({'path': TEXT, 'ttl': MapOf(NUMBER)}),
+    'snapshot-dir': TEXT,
+    'discovery-cache': TEXT,
+    'run-statistics': bool,
+    'report-processes': int,
+    'email-size-limit': int,
+    'daemon': Section({'host': TEXT, 'port': int, 'pull-interval': NUMBER,
+                       'intervals': Section(dict((kind, NUMBER) for kind in
+                                                 ['projects', 'compute', 'IAM', 'firewall']))}),
+    'history': Section({'path': TEXT, 'retention-days': NUMBER, 'compact-after-days': NUMBER}),
+    'notify-projects': _rule_section(list(PROJECT_FIELDS) + list(DEPRECATED_FIELDS)),
+    'ignore-projects': _rule_section(list(PROJECT_FIELDS) + list(DEPRECATED_FIELDS)),
+    'notify-zones': _rule_section(ZONE_FIELDS),
+    'ignore-zones': _rule_section(ZONE_FIELDS),
+}, required=['report-title', 'watchdog-email', 'receiver-email'])
+
+SCHEMA = Section({
+    'general': GENERAL_SCHEMA,
+    'compute': _table_section(INSTANCE_FIELDS),
+    'IAM': _table_section(IAM_FIELDS),
+    'firewall': _table_section(FIREWALL_FIELDS, **{
+        'exposure-rules': ListOf(Section({'max-prefix': int, 'ports': ListOf(PORT),
+                                          'address': TEXT}))}),
+}, required=['general'])
+
+def _type_name(schema):
+    if isinstance(schema, (Section, MapOf)):
+        return 'a mapping'
+    if isinstance(schema, ListOf):
+        return 'a list'
+    if schema is bool:
+        return 'True or False'
+    if schema in (int, NUMBER):
+        return 'a number'
+    return 'a string'
+
+def _check_rule(value, path, errors):
+    """
+    Return the strings of a rule field
+    """
+
+    if value is None:
+        return ()
+    if isinstance(value, (TEXT,) + NUMBER):
+        return (value if isinstance(value, TEXT) else str(value),)
+    if not isinstance(value, list):
+        errors.append("%s: expected a string or a list of '- string: ...' items" % path)
+        return ()
+
+    strings = []
+    for i, item in enumerate(value):
+        if not isinstance(item, dict) or set(item) != set(['string']):
+            errors.append("%s[%d]: expected '- string: ...', got %r" % (path, i, item))
+        elif item['string'] is not None:
+            strings.append(item['string'] if isinstance(item['string'], TEXT)
+                           else str(item['string']))
+    return tuple(strings)
+
+def _check_port(value, path, errors):
+    """
+    Return the [first, last] interval of an exposure rule port
+    """
+
+    first, _, last = str(value).strip().partition('-')
+    try:
+        if isinstance(value, (bool, float)):
+            raise ValueError(value)
+        first, last = int(first), int(last or first)
+    except ValueError:
+        errors.append("%s: expected a port or a range like 1000-2000, got %r" % (path, value))
+        return None
+
+    if not 0 <= first <= last <= 65535:
+        errors.append("%s: %r is not a port range within 0-65535" % (path, value))
+    return [first, last]
+
+def _check(value, schema, path, errors):
+    """
+    Return the value normalized to its schema, appending problems to errors
+    """
+
+    if schema is RULE:
+        return _check_rule(value, path, errors)
+    if schema is PORT:
+        return _check_port(value, path, errors)
+
+    if isinstance(schema, Section):
+        if not isinstance(value, dict):
+            errors.append("%s: expected %s, got %r" % (path, _type_name(schema), value))
+            return {}
+
+        normalized = {}
+        for key, item in sorted(value.items()):
+            key_path = '%s.%s' % (path, key) if path else str(key)
+            if key not in schema.fields:
+                hint = difflib.get_close_matches(str(key), list(schema.fields), 1)
+                errors.append("%s: unknown key%s (expected one of %s)" % (
+                    key_path, " (did you mean '%s'?)" % hint[0] if hint else '',
+                    ', '.join(sorted(schema.fields))))
+            elif item is None and schema.fields[key] is not RULE:
+                # Empty settings take their default
+                continue
+            else:
+                normalized[key] = _check(item, schema.fields[key], key_path, errors)
+
+        for key in schema.required:
+            if key not in normalized:
+                errors.append("%s: missing" % ('%s.%s' % (path, key) if path else key))
+
+        return normalized
+
+    if isinstance(schema, MapOf):
+        if not isinstance(value, dict):
+            errors.append("%s: expected a mapping, got %r" % (path, value))
+            return {}
+        return dict((key, _check(item, schema.values, '%s.%s' % (path, key), errors))
+                    for key, item in value.items())
+
+    if isinstance(schema, ListOf):
+        if not isinstance(value, list):
+            errors.append("%s: expected a list, got %r" % (path, value))
+            return []
+        return [_check(item, schema.items, '%s[%d]' % (path, i), errors)
+                for i, item in enumerate(value)]
+
+    if not isinstance(value, schema) or (schema is not bool and isinstance(value, bool)):
+        errors.append("%s: expected %s, got %r" % (path, _type_name(schema), value))
+    return value
+
+def compile_rules(cfg, sections, fields):
+    """
+    Compile the rules of one table from its normalized config section
+
+    sections maps a rule type to its section in cfg, e.g. {'ignore': 'ignore-rules'}
+    fields maps a rule field to its table column, e.g. {'name': 'Instance'}
+
+    The strings of one rule and column are escaped and combined into one regex.
+    """
+
+    rules = dict((rule_type, []) for rule_type in RULE_TYPES)
+
+    for rule_type, section in sections.items():
+        section_cfg = cfg.get(section) or {}
+
+        for field in sorted(fields):
+            strings = tuple(section_cfg.get(field) or ())
+            if strings:
+                pattern = '|'.join(re.escape(string) for string in strings)
+                rules[rule_type].append(Rule(fields[field], strings, re.compile(pattern)))
+
+    exposure = tuple(ExposureRule(rule.get('max-prefix', 0),
+                                  tuple(tuple(port) for port in rule.get('ports') or ()),
+                                  rule.get('address'))
+                     for rule in cfg.get('exposure-rules') or [])
+
+    return TableRules(tuple(rules['ignore']), tuple(rules['notify']), tuple(rules['alert']),
+                      exposure)
+
+def normalize_config(raw, name='config'):
+    """
+    Return the validated and normalized config (JSON serializable, without 'rules')
+
+    Raises a ConfigError with all problems of the config. Warnings (deprecated
+    keys) are returned in cfg['warnings'].
+    """
+
+    errors = []
+    cfg = _check(raw if raw is not None else {}, SCHEMA, '', errors)
+    if errors:
+        raise ConfigError("invalid configuration %s:\n  %s" % (name, '\n  '.join(errors)))
+
+    warnings = []
+    general = cfg['general']
+    for section in PROJECT_RULES.values():
+        rules = general.get(section) or {}
+        for old, new in DEPRECATED_FIELDS.items():
+            if old in rules:
+                warnings.append("%s: general.%s.%s is deprecated, use %s" % (name, section, old,
+                                                                             new))
+                rules[new] = rules.get(new, ()) + rules.pop(old)
+
+    for kind in ['compute', 'IAM', 'firewall']:
+        cfg.setdefault(kind, {'print': False})
+
+    cfg['warnings'] = warnings
+    return cfg
+
+def compile_ruleset(cfg):
+    """
+    Return the RuleSet of a normalized config
+    """
+
+    general = cfg['general']
+    return RuleSet(compile_rules(general, PROJECT_RULES, PROJECT_FIELDS),
+                   compile_rules(general, ZONE_RULES, ZONE_FIELDS),
+                   compile_rules(cfg['compute'], TABLE_RULES, INSTANCE_FIELDS),
+                   compile_rules(cfg['IAM'], TABLE_RULES, IAM_FIELDS),
+                   compile_rules(cfg['firewall'], TABLE_RULES, FIREWALL_FIELDS))
+
+def compile_config(raw, name='config'):
+    """
+    Return the validated and normalized config with its compiled RuleSet in 'rules'
+
+    Raises a ConfigError with all problems of the config (see normalize_config).
+    """
+
+    cfg = normalize_config(raw, name)
+    cfg['rules'] = compile_ruleset(cfg)
+    return cfg
+
+def compiled_path(path):
+    """
+    Return the path of the compiled config of a YAML file
+    """
+
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.%s.compiled' % name)
+
+def load_config(path):
+    """
+    Return the compiled config of a YAML file, from its compiled file if unchanged
+    """
+
+    with open(path, 'rb') as the_file:
+        text = the_file.read()
+    key = hashlib.sha1('%d\n%s' % (COMPILER_VERSION, text)).hexdigest()
+
+    compiled = compiled_path(path)
+    cfg = None
+    try:
+        with open(compiled, 'rb') as the_file:
+            # Only a file written for this content and compiler version is parsed
+            if the_file.readline().strip() == key:
+                cfg = json.load(the_file)
+    except (IOError, ValueError):
+        # Missing, unreadable or half written: checked again
+        pass
+
+    if cfg is None:
+        try:
+            raw = yaml.safe_load(text)
+        except yaml.YAMLError as error:
+            raise ConfigError("invalid YAML in %s: %s" % (path, error))
+        cfg = normalize_config(raw, path)
+
+        try:
+            # Written next to the final file first, so a concurrent run never reads half of it
+            tmp_path = '%s.%d.tmp' % (compiled, os.getpid())
+            with open(tmp_path, 'wb') as the_file:
+                the_file.write(key + '\n')
+                json.dump(cfg, the_file)
+            os.rename(tmp_path, compiled)
+        except (IOError, OSError):
+            # e.g. a read-only config directory, the config is checked on every run
+            pass
+
+    cfg['rules'] = compile_ruleset(cfg)
+    return cfg
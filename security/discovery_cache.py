@@ -0,0 +1,86 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Builds the discovery clients from locally cached discovery documents
+
+discovery.build downloads the discovery document of an API on every run
+(its own file cache doesn't work with oauth2client >= 4). The documents are
+kept in a directory and only downloaded again when they are older than the TTL.
+
+"""
+
+import os
+import time
+
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/%s/%s/rest'
+
+# Seconds a cached discovery document is used before it is downloaded again
+DEFAULT_TTL = 7 * 24 * 3600
+
+def _fetch_document(api, version):
+    """
+    Return the discovery document of an API or None if it can't be downloaded
+    """
+
+    import httplib2
+
+    try:
+        resp, content = httplib2.Http().request(DISCOVERY_URL % (api, version))
+    except (httplib2.HttpLib2Error, IOError):
+        return None
+
+    if resp.status != 200:
+        return None
+
+    return content
+
+def _store(path, document):
+    """
+    Write a discovery document to the cache
+    """
+
+    cache_dir = os.path.dirname(path)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Write next to the old document first, so parallel runs never read half a file
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as the_file:
+        the_file.write(document)
+    os.rename(tmp_path, path)
+
+def build_client(api, version, credentials, cache_dir, ttl=DEFAULT_TTL, http=None):
+    """
+    Return the discovery client of an API, using the document cached in cache_dir
+
+    Clients of offline transports (see security.replay) get their http
+    object instead of credentials.
+    """
+
+    from googleapiclient import discovery
+
+    path = os.path.join(cache_dir, '%s.%s.json' % (api, version))
+
+    document = None
+    if os.path.exists(path) and time.time() - os.path.getmtime(path) < ttl:
+        with open(path, 'r') as the_file:
+            document = the_file.read()
+
+    if document is None:
+        document = _fetch_document(api, version)
+
+        if document is None and os.path.exists(path):
+            # Expired documents are still better than no client
+            with open(path, 'r') as the_file:
+                document = the_file.read()
+
+        elif document is None:
+            # Let discovery.build report the error
+            return discovery.build(api, version, credentials=credentials, http=http)
+
+        else:
+            _store(path, document)
+
+    return discovery.build_from_document(document, credentials=credentials, http=http)
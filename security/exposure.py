@@ -0,0 +1,239 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Firewall exposure analysis: which rules open which ports to which addresses
+
+Every source range of the firewall table is parsed into an integer interval
+(network, broadcast, prefix length) and every port span into a port interval,
+once per distinct Range and Port string. Queries such as "a range of /16 or
+wider allowing 22 or 3389" are then numpy operations over all rules of all
+projects at once.
+
+Address lookups use a radix index: the ranges are grouped by prefix length
+and each group is sorted by network address, so finding the ranges that
+contain an address is one binary search per prefix length.
+
+IPv6 ranges are indexed by their upper 64 bits, which is exact for prefixes
+up to /64.
+
+"""
+
+import socket
+import struct
+
+import numpy as np
+import pandas as pd
+
+# Protocols whose rules can open ports
+PORT_PROTOCOLS = set(['tcp', 'udp', 'sctp', 'all'])
+
+def parse_cidr(text):
+    """
+    Return (family, first address, last address, prefix length) of a CIDR range
+
+    Addresses are integers: IPv4 addresses, or the upper 64 bits of IPv6 addresses.
+    """
+
+    text = text.strip()
+    address, _, prefix = text.partition('/')
+
+    if ':' in address:
+        high, _ = struct.unpack('!QQ', socket.inet_pton(socket.AF_INET6, address))
+        prefix = int(prefix) if prefix else 128
+        bits = 64 - min(prefix, 64)
+        return 6, (high >> bits) << bits, high | ((1 << bits) - 1), prefix
+
+    value = struct.unpack('!I', socket.inet_aton(address))[0]
+    prefix = int(prefix) if prefix else 32
+    bits = 32 - prefix
+    return 4, (value >> bits) << bits, value | ((1 << bits) - 1), prefix
+
+def parse_address(text):
+    """
+    Return (family, address) of an IP address (see parse_cidr)
+    """
+
+    family, first, _, _ = parse_cidr(text.partition('/')[0])
+    return family, first
+
+def parse_ports(text, protocol):
+    """
+    Return the (first, last) port intervals of a Port cell
+
+    Rules without ports open all ports of their protocol, rules of other
+    protocols (e.g. icmp) open none.
+    """
+
+    if str(protocol).lower() not in PORT_PROTOCOLS:
+        return []
+
+    if text is None or str(text).strip() in ('', 'None', 'nan'):
+        return [(0, 65535)]
+
+    intervals = []
+    for span in str(text).split(','):
+        first, _, last = span.strip().partition('-')
+        intervals.append((int(first), int(last or first)))
+
+    return intervals
+
+def _explode(codes, parsed):
+    """
+    Return the row numbers and ids of the lists of ids parsed per unique value
+
+    codes maps every row to its unique value (-1 for missing values), parsed
+    holds the list of ids of every unique value. A row gets one entry per id
+    of its value.
+    """
+
+    counts = np.array([len(ids) for ids in parsed], dtype=np.int64)
+    ids = np.array([i for value_ids in parsed for i in value_ids], dtype=np.int64)
+    offsets = np.cumsum(counts) - counts
+
+    rows = np.flatnonzero(codes >= 0)
+    row_counts = counts[codes[rows]]
+    row_offsets = offsets[codes[rows]]
+
+    # Position of every entry in ids: offset of its unique value + its number within the row
+    entry_rows = np.repeat(rows, row_counts)
+    firsts = np.cumsum(row_counts) - row_counts
+    positions = np.repeat(row_offsets - firsts, row_counts) + np.arange(len(entry_rows))
+
+    return entry_rows, ids[positions]
+
+class FirewallIndex(object):
+    """
+    Interval index over the source ranges and ports of a firewall table
+
+    The table needs the columns Range, Protocol and Port. Masks returned by
+    the queries are aligned with its rows.
+    """
+
+    def __init__(self, firewalls):
+        self.size = len(firewalls)
+
+        # Source ranges, split once per distinct Range cell and parsed once per distinct CIDR
+        codes, uniques = pd.factorize(firewalls['Range'])
+        cells = [[cidr.strip() for cidr in str(value).split(',') if cidr.strip()]
+                 for value in uniques]
+        cidr_ids, cidrs = pd.factorize([cidr for cell in cells for cidr in cell])
+        parsed = np.array([parse_cidr(cidr) for cidr in cidrs], dtype=np.uint64).reshape(-1, 4)
+
+        cell_ids, start = [], 0
+        for cell in cells:
+            cell_ids.append(cidr_ids[start:start + len(cell)])
+            start += len(cell)
+
+        self.range_rows, ids = _explode(codes, cell_ids)
+        self.range_family, self.range_first, self.range_last, self.range_prefix = parsed[ids].T
+
+        # Ports, parsed once per distinct pair of protocol and Port cell
+        protocol_codes, protocols = pd.factorize(firewalls['Protocol'])
+        port_codes, ports = pd.factorize(firewalls['Port'])
+        width = len(ports) + 1
+        codes, uniques = pd.factorize((protocol_codes.astype(np.int64) + 1) * width + port_codes + 1)
+        intervals, key_ids = [], []
+        for key in uniques:
+            protocol_code, port_code = key // width - 1, key % width - 1
+            spans = parse_ports(ports[port_code] if port_code >= 0 else None,
+                                protocols[protocol_code] if protocol_code >= 0 else None)
+            key_ids.append(range(len(intervals), len(intervals) + len(spans)))
+            intervals.extend(spans)
+
+        self.port_rows, ids = _explode(codes, key_ids)
+        intervals = np.array(intervals, dtype=np.uint64).reshape(-1, 2)
+        self.port_first, self.port_last = intervals[ids].T
+
+        self._radix = None
+
+    def _rows(self, rows, selected):
+        mask = np.zeros(self.size, dtype=bool)
+        mask[rows[selected]] = True
+        return mask
+
+    def wide_ranges(self, max_prefix, family=None):
+        """
+        Return the rows with a source range of max_prefix or wider (e.g. 16 for /16)
+        """
+
+        selected = self.range_prefix <= max_prefix
+        if family is not None:
+            selected &= self.range_family == family
+        return self._rows(self.range_rows, selected)
+
+    def open_ports(self, ports):
+        """
+        Return the rows that allow any of the given ports (numbers or (first, last))
+        """
+
+        selected = np.zeros(len(self.port_rows), dtype=bool)
+        for port in ports:
+            first, last = port if isinstance(port, (tuple, list)) else (port, port)
+            selected |= (self.port_first <= last) & (self.port_last >= first)
+        return self._rows(self.port_rows, selected)
+
+    def _radix_index(self):
+        # (family, prefix length) -> (sorted first addresses, their range numbers)
+        if self._radix is None:
+            self._radix = {}
+            keys = self.range_family * np.uint64(256) + self.range_prefix
+            order = np.lexsort((self.range_first, keys))
+            bounds = np.flatnonzero(np.diff(keys[order])) + 1
+            for group in np.split(order, bounds):
+                if len(group):
+                    key = (int(self.range_family[group[0]]), int(self.range_prefix[group[0]]))
+                    self._radix[key] = (self.range_first[group], group)
+        return self._radix
+
+    def containing(self, address):
+        """
+        Return the rows with a source range that contains an address (e.g. '8.8.8.8')
+        """
+
+        family, value = parse_address(address)
+        bits = 32 if family == 4 else 64
+
+        selected = np.zeros(len(self.range_rows), dtype=bool)
+        for (range_family, prefix), (firsts, numbers) in self._radix_index().items():
+            if range_family != family:
+                continue
+
+            # The network address of the address at this prefix length
+            shift = bits - min(prefix, bits)
+            network = np.uint64((value >> shift) << shift)
+            start = np.searchsorted(firsts, network, side='left')
+            end = np.searchsorted(firsts, network, side='right')
+            selected[numbers[start:end]] = True
+
+        return self._rows(self.range_rows, selected)
+
+    def exposed(self, max_prefix=0, ports=None, address=None):
+        """
+        Return the rows open to a range of max_prefix or wider (or containing
+        address) on any of the given ports (all ports if None)
+        """
+
+        mask = self.containing(address) if address else self.wide_ranges(max_prefix)
+        if ports:
+            mask &= self.open_ports(ports)
+        return mask
+
+def exposure_highlight(firewalls, exposure_rules):
+    """
+    Return the rows of a firewall table that match any exposure rule
+
+    A rule is a compiled ExposureRule (see security.config) with max_prefix
+    (0 matches only 0.0.0.0/0 and ::/0) or address, and ports (all if empty).
+    """
+
+    if not exposure_rules or not len(firewalls):
+        return np.zeros(len(firewalls), dtype=bool)
+
+    index = FirewallIndex(firewalls)
+    mask = np.zeros(len(firewalls), dtype=bool)
+    for rule in exposure_rules:
+        mask |= index.exposed(rule.max_prefix, rule.ports or None, rule.address)
+
+    return mask
@@ -0,0 +1,210 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Writes DataFrames as data files: Parquet with pyarrow, gzipped JSON without
+
+The dtype of every column (categories, datetimes, hashes, lists of strings)
+is written next to the data, so a frame reads back as it was written. Unlike
+a pickle, reading a file never runs code stored in it. The index is not
+written, callers keep a meaningful index as a column.
+
+"""
+
+import glob
+import gzip
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+PARQUET = '.parquet'
+JSON = '.json.gz'
+
+# Key of the dtypes in the Parquet schema metadata
+_DTYPES_KEY = b'watchdog.dtypes'
+
+def frame_extension():
+    """
+    Return the extension new frames are written with
+    """
+
+    return PARQUET if pyarrow is not None else JSON
+
+def _is_list_column(values):
+    return values.dtype == object and values.map(lambda value: isinstance(value, list)).any()
+
+def _dtypes(frame):
+    return [[column, 'list' if _is_list_column(frame[column]) else str(frame[column].dtype)]
+            for column in frame.columns]
+
+def _text(value):
+    """
+    Return text read back as str, or as unicode if it is not ASCII (like the API responses)
+    """
+
+    if isinstance(value, unicode):
+        try:
+            return str(value)
+        except UnicodeEncodeError:
+            return value
+    if isinstance(value, str):
+        # pyarrow returns UTF-8 bytes
+        try:
+            value.decode('ascii')
+            return value
+        except UnicodeDecodeError:
+            return value.decode('utf-8')
+    if isinstance(value, list):
+        return [_text(item) for item in value]
+    return value
+
+def _restore(frame, dtypes):
+    """
+    Return the frame with the written dtypes and Python values in object columns
+    """
+
+    columns = {}
+    for column, dtype in dtypes:
+        values = frame[column]
+        if dtype == 'category':
+            values = values.astype('category')
+            values = values.cat.rename_categories([_text(category) for category in
+                                                   values.cat.categories])
+        elif dtype == 'list':
+            values = values.map(lambda value: _text(list(value)) if value is not None and
+                                not isinstance(value, float) else value)
+        elif dtype == 'object':
+            values = values.map(_text)
+        elif str(values.dtype) != dtype:
+            values = values.astype(dtype)
+        columns[column] = values
+
+    return pd.DataFrame(columns, columns=[column for column, _ in dtypes])
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("%r is not JSON serializable" % value)
+
+def _encode_column(values, dtype):
+    if dtype == 'category':
+        return {'categories': values.cat.categories.tolist(),
+                'codes': values.cat.codes.tolist()}
+    if dtype.startswith('datetime64'):
+        # Nanoseconds since the epoch, NaT is the smallest int64
+        return values.values.astype('datetime64[ns]').view('int64').tolist()
+    if values.dtype == object:
+        return list(values.values)
+    return values.values.tolist()
+
+def _decode_column(data, dtype):
+    if dtype == 'category':
+        return pd.Categorical.from_codes(data['codes'],
+                                         [_text(category) for category in data['categories']])
+    if dtype.startswith('datetime64'):
+        return np.array(data, dtype='int64').view('datetime64[ns]')
+    if dtype in ('object', 'list'):
+        values = np.empty(len(data), dtype=object)
+        values[:] = [_text(value) for value in data]
+        return values
+    return np.array(data, dtype=dtype)
+
+def _write_json(frame, path):
+    dtypes = _dtypes(frame)
+    document = {'rows': len(frame), 'dtypes': dtypes,
+                'columns': [_encode_column(frame[column], dtype) for column, dtype in dtypes]}
+    with gzip.open(path, 'wb') as the_file:
+        the_file.write(json.dumps(document, default=_json_default))
+
+def _read_json(path):
+    with gzip.open(path, 'rb') as the_file:
+        document = json.load(the_file)
+
+    dtypes = [(str(column), str(dtype)) for column, dtype in document['dtypes']]
+    return pd.DataFrame(dict((column, _decode_column(data, dtype)) for (column, dtype), data
+                             in zip(dtypes, document['columns'])),
+                        index=pd.RangeIndex(document['rows']),
+                        columns=[column for column, _ in dtypes])
+
+def _write_parquet(frame, path):
+    table = pyarrow.Table.from_pandas(frame, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[_DTYPES_KEY] = json.dumps(_dtypes(frame))
+    pyarrow.parquet.write_table(table.replace_schema_metadata(metadata), path)
+
+def _read_parquet(path):
+    if pyarrow is None:
+        raise ImportError("Reading %s needs pyarrow (pip install pyarrow)" % path)
+
+    table = pyarrow.parquet.read_table(path)
+    dtypes = [(str(column), str(dtype)) for column, dtype
+              in json.loads(table.schema.metadata[_DTYPES_KEY])]
+    return _restore(table.to_pandas(), dtypes)
+
+def write_frame(frame, path):
+    """
+    Write a frame to path plus the extension of the format, return the file name
+    """
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # Write next to the final file first, so an interrupted run keeps the old one
+    extension = frame_extension()
+    if pyarrow is not None:
+        _write_parquet(frame, path + extension + '.tmp')
+    else:
+        _write_json(frame, path + extension + '.tmp')
+    os.rename(path + extension + '.tmp', path + extension)
+
+    # A frame written before pyarrow was installed (or removed) is replaced
+    for other in [PARQUET, JSON]:
+        if other != extension and os.path.exists(path + other):
+            os.remove(path + other)
+    return path + extension
+
+def read_frame(path):
+    """
+    Return the frame of a file written by write_frame
+    """
+
+    if path.endswith(PARQUET):
+        return _read_parquet(path)
+    return _read_json(path)
+
+def frame_file(path):
+    """
+    Return the file of the frame written to path, or None
+    """
+
+    for extension in [PARQUET, JSON]:
+        if os.path.exists(path + extension):
+            return path + extension
+    return None
+
+def frame_files(pattern):
+    """
+    Return the files of the frames whose path matches a glob pattern, sorted
+    """
+
+    return sorted(glob.glob(pattern + PARQUET) + glob.glob(pattern + JSON))
+
+def frame_base(path):
+    """
+    Return the path of a frame file without its extension
+    """
+
+    for extension in [PARQUET, JSON]:
+        if path.endswith(extension):
+            return path[:-len(extension)]
+    return path
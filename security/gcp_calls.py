@@ -7,94 +7,344 @@ This contains calls through the gcloud compute and ressourcemanager API
 
 """
 
-from gcloud import resource_manager
+from googleapiclient.errors import HttpError
 
-def get_projects(credentials=None):
+from security.cache import fingerprint
+from security.collector import default_collector
+from security.scheduler import is_quota_error
+
+def get_projects(project_rm, collector=default_collector, max_results=None):
     """
-    Get list of all projects on GCP the service account has access to
+    Get list of all projects on GCP the service account has access to (needs ressource manager)
+
+    The pages are requested through the collector, so they are rate limited
+    and retried like every other call.
     """
 
-    data = []
-    client = resource_manager.Client(credentials=credentials)
-    projects = list(client.list_projects())
-    data = map(lambda x: [str(x.name), str(x.project_id)], projects)
+    def fetch():
+        projects = []
+        for page in paginate(project_rm.projects(), 'list', collector, pageSize=max_results):
+            projects.extend([str(project.get('name', project['projectId'])),
+                             str(project['projectId'])]
+                            for project in page.get('projects', []))
+        return projects
 
-    return data
+    return collector.cached('projects', '', fetch)
 
-def get_gcp_zones(compute, project):
+def paginate(collection, method, collector=default_collector, **kwargs):
     """
-    Get all zones in GCP (needs compute engine)
+    Yield every response page of a list call, following nextPageToken
+    """
+
+    request = getattr(collection, method)(**kwargs)
+    while request is not None:
+        response = collector.execute(request)
+        yield response
+
+        request = getattr(collection, method + '_next')(previous_request=request,
+                                                       previous_response=response)
+
+def get_zone_items(compute, project, collector=default_collector, max_results=None):
     """
+    Get the zone resources of a project (needs compute engine), cached per project
+    """
+
+    def fetch():
+        items = []
+        for details in paginate(compute.zones(), 'list', collector,
+                                project=str(project), maxResults=max_results):
+            items.extend(details.get('items', []))
+        return items
 
-    zones = []
-    details = compute.zones().list(project=str(project)).execute()
-    if details.has_key('items'):
-        for item in details['items']:
-            zones.append(str(item['name']))
+    return collector.cached('zones', project, fetch)
+
+def get_iam_policy(project_rm, project, collector=default_collector):
+    """
+    Get the IAM policy of a project (needs ressource manager), cached per project
+    """
 
-    return zones
+    return collector.cached('iam', project, lambda: collector.execute(
+        project_rm.projects().getIamPolicy(body={}, resource=str(project))),
+                            tag=lambda policy: policy.get('etag'))
 
-def get_instance_data(compute, project_IDs, zones):
+def get_firewall_items(compute, project, collector=default_collector, max_results=None):
+    """
+    Get the firewall resources of a project (needs compute engine), cached per project
+    """
+
+    def fetch():
+        items = []
+        for response in paginate(compute.firewalls(), 'list', collector,
+                                 project=str(project), maxResults=max_results):
+            items.extend(response.get('items', []))
+        return items
+
+    return collector.cached('firewalls', project, fetch, tag=fingerprint)
+
+def get_gcp_zones(compute, project, collector=default_collector, max_results=None):
+    """
+    Get all zones in GCP (needs compute engine)
+    """
+
+    return [str(item['name']) for item in get_zone_items(compute, project, collector, max_results)]
+
+def get_instance_data(compute, project_IDs, zones, aggregated=True,
+                      collector=default_collector, max_results=None):
     """
     Get info on instances (needs compute engine)
     """
 
-    data = []
-    #loop over all projects
-    for project in project_IDs:
-        #loop over all zones
-        for zone in zones:
-            response = compute.instances().list(project=str(project), zone=zone).execute()
-            if response.has_key('items'):
-                for item in response['items']:
-                    data.append([str(item['name']), str(item['status']),
-                                 str(item['machineType']).split('/')[-1], str(project), zone])
+    return list(iter_instance_data(compute, project_IDs, zones, aggregated,
+                                   collector, max_results))
 
-    return data
+def iter_instance_data(compute, project_IDs, zones, aggregated=True,
+                       collector=default_collector, max_results=None):
+    """
+    Yield info on instances row by row (needs compute engine)
+
+    On default one aggregatedList stream is read per project and the zones are
+    filtered on the client side. With aggregated=False every (project, zone)
+    pair is listed separately.
+    """
+
+    if aggregated:
+        return collector.imap_rows(_iter_project_instances_aggregated, project_IDs,
+                                   compute, zones, collector, max_results)
+
+    return collector.imap_rows(_iter_project_instances_zonal, project_IDs,
+                               compute, zones, collector, max_results)
+
+def _iter_project_instances_zonal(project, compute, zones, collector, max_results):
+    """
+    Yield info on instances of one project with one list stream per zone
+    """
+
+    #loop over all zones
+    for zone in zones:
+        for response in paginate(compute.instances(), 'list', collector, project=str(project),
+                                 zone=zone, maxResults=max_results):
+            for item in response.get('items', []):
+                yield instance_row(project, zone, item)
+
+def _iter_project_instances_aggregated(project, compute, zones, collector, max_results):
+    """
+    Yield info on instances of one project with one aggregatedList stream
+    """
+
+    # Rows are bucketed per zone so they come out in the same order as the zonal calls
+    zone_rows = dict((zone, []) for zone in zones)
 
-def get_firewall_data(compute, project_IDs):
+    for response in paginate(compute.instances(), 'aggregatedList', collector,
+                             project=str(project), maxResults=max_results):
+        for scope, scoped_list in response.get('items', {}).items():
+            # scope looks like 'zones/europe-west1-b'
+            zone = str(scope).split('/')[-1]
+            if zone not in zone_rows:
+                continue
+
+            for item in scoped_list.get('instances', []):
+                zone_rows[zone].append(instance_row(project, zone, item))
+
+    for zone in zones:
+        for row in zone_rows.pop(zone):
+            yield row
+
+def get_firewall_data(compute, project_IDs, collector=default_collector, max_results=None):
     """
     Get firwall rules (needs compute engine)
     """
+
+    return list(iter_firewall_data(compute, project_IDs, collector, max_results))
+
+def iter_firewall_data(compute, project_IDs, collector=default_collector, max_results=None):
+    """
+    Yield firewall rules row by row (needs compute engine)
+    """
+
+    return collector.imap_rows(_iter_project_firewalls, project_IDs,
+                               compute, collector, max_results)
+
+def _iter_project_firewalls(project, compute, collector, max_results):
+    """
+    Yield firwall rules of one project
+    """
+
+    for item in get_firewall_items(compute, project, collector, max_results):
+        for row in firewall_rows(project, item):
+            yield row
+
+def instance_row(project, zone, item):
+    """
+    Return the table row of an instance resource
+    """
+
+    return [str(item['name']), str(item['status']),
+            str(item['machineType']).split('/')[-1], str(project), zone]
+
+def firewall_rows(project, item):
+    """
+    Return the table rows of a firewall resource, one per allowed protocol
+
+    All source ranges and ports are kept, comma separated (see security.exposure)
+    """
+
     data = []
-    #loop over all projects
+    if item.has_key('allowed'):
+        source_ranges = ', '.join(str(source) for source in item.get('sourceRanges', []))
+        for allowed in item['allowed']:
+            data.append([str(project), str(item['name']), source_ranges,
+                         str(allowed['IPProtocol']),
+                         ', '.join(str(port) for port in allowed['ports'])
+                         if allowed.has_key('ports') else None,
+                         str(item.get('kind', 'compute#firewall'))])
+    return data
+
+def get_iam_policies(project_rm, project_IDs, collector=default_collector, batch_size=100):
+    """
+    Get the IAM policies of many projects with batch HTTP requests (needs ressource manager)
+
+    Returns a dict mapping each project to its policy, or to the HttpError of
+    its request. Cached policies are reused and new ones are added to the cache.
+    """
+
+    policies = {}
+    missing = []
     for project in project_IDs:
-        response = compute.firewalls().list(project=str(project)).execute()
-
-        if response.has_key('items'):
-            for item in response['items']:
-                if item.has_key('allowed'):
-                    for allowed in item['allowed']:
-                        data.append([str(project), str(item['name']),
-                                     str(item['sourceRanges'][0]) if item.has_key('sourceRanges') else '', 
-                                     str(allowed['IPProtocol']),
-                                     allowed['ports'][0] if allowed.has_key('ports')
-                                     else None, str(item['kind'])])
+        policy = collector.cache.get('iam', project) if collector.cache is not None else None
+        if policy is None:
+            missing.append(str(project))
+        else:
+            policies[str(project)] = policy
 
-    return data
+    batches = [missing[start:start + batch_size] for start in range(0, len(missing), batch_size)]
+    for results in collector.map(_get_iam_policy_batch, batches, project_rm, collector):
+        for project, policy in results.items():
+            if is_quota_error(policy):
+                # Requests of a batch are not retried individually by the scheduler
+                try:
+                    policy = collector.execute(
+                        project_rm.projects().getIamPolicy(body={}, resource=project))
+                except HttpError as error:
+                    policy = error
+
+            policies[project] = policy
+            if collector.cache is not None and isinstance(policy, dict):
+                collector.cache.set('iam', project, policy, policy.get('etag'))
 
-def get_people_access(project_rm, project_IDs):
+    return policies
+
+def _get_iam_policy_batch(batch_projects, project_rm, collector):
+    """
+    Get the IAM policies of up to batch_size projects with one batch request
+    """
+
+    results = {}
+
+    def callback(request_id, response, exception):
+        results[request_id] = exception if exception is not None else response
+
+    batch = project_rm.new_batch_http_request(callback=callback)
+    for project in batch_projects:
+        batch.add(project_rm.projects().getIamPolicy(body={}, resource=project),
+                  request_id=project)
+    collector.execute(batch)
+
+    return results
+
+def parse_member(member, members=None):
+    """
+    Return (name, email, email suffix, account type) of an IAM member, e.g. 'user:jane.doe@x.com'
+
+    members is a dict of the members parsed so far in a crawl (members repeat
+    across the organisation), so every member is only split once per crawl
+    and repeated values share one interned string object. It is dropped with
+    the crawl, so a long running daemon doesn't keep every member ever seen.
+    """
+
+    parsed = members.get(member) if members is not None else None
+    if parsed is None:
+        key = member
+        member = str(member)
+        account_type, _, email = member.partition(':')
+        if not email:
+            # e.g. 'allUsers'
+            account_type, email = member, member
+
+        name, _, suffix = email.partition('@')
+        parsed = (intern(name.replace('.', ' ')), intern(email), intern(suffix.split('@')[-1]),
+                  intern(account_type))
+        if members is not None:
+            members[key] = parsed
+
+    return parsed
+
+def get_people_access(project_rm, project_IDs, collector=default_collector):
     """
     Get access rights of users (needs ressource manager)
     """
 
-    data = []
-    #loop over all projects
+    return list(iter_people_access(project_rm, project_IDs, collector))
+
+def iter_people_access(project_rm, project_IDs, collector=default_collector):
+    """
+    Yield access rights of users row by row, one row per member and role (needs ressource manager)
+
+    getIamPolicy returns the whole policy at once, there are no pages to follow.
+    """
+
+    policies = get_iam_policies(project_rm, project_IDs, collector)
+    members = {}
+
+    for project in project_IDs:
+        for member, roles in _member_roles(policies[str(project)]):
+            name, email, suffix, account_type = parse_member(member, members)
+            for role in roles:
+                yield [str(project), name, email, suffix, account_type, role]
+
+def iter_iam_members(project_rm, project_IDs, collector=default_collector):
+    """
+    Yield access rights of users, one row per project and member with the list of its roles
+
+    The rows are [Project_ID, Name, Email, Email_suffix, Account_type, Role].
+    """
+
+    policies = get_iam_policies(project_rm, project_IDs, collector)
+    members = {}
+
     for project in project_IDs:
-        response = project_rm.projects().getIamPolicy(body={}, resource=str(project)).execute()
+        for row in iam_member_rows(project, policies[str(project)], members):
+            yield row
+
+def iam_member_rows(project, policy, members=None):
+    """
+    Return the table rows of an IAM policy, one per member with the list of its roles
+
+    members is the parsed members cache of the crawl (see parse_member).
+    """
+
+    return [[str(project)] + list(parse_member(member, members)) + [roles]
+            for member, roles in _member_roles(policy)]
+
+def _member_roles(policy):
+    """
+    Return (member, roles) pairs of a policy, members in order of appearance
+    """
 
-        if response.has_key('bindings'):
-            for binding in response['bindings']:
+    if not isinstance(policy, dict):
+        # Failed request
+        raise policy
 
-                if binding.has_key('role'):
-                    role = binding['role']
+    members = []
+    roles = {}
+    for binding in policy.get('bindings', []):
 
-                if binding.has_key('members'):
-                    for member in binding['members']:
+        # 'roles/owner' -> 'owner'
+        role = intern(str(binding.get('role', ''))[6:])
 
-                        account_type = str(member).split(':')[0]
-                        email = str(member).split(':')[1]
+        for member in binding.get('members', []):
+            if member not in roles:
+                members.append(member)
+                roles[member] = []
+            roles[member].append(role)
 
-                        data.append([str(project), str(email.split('@')[0]).replace('.', ' '),
-                                     email, email.rsplit('@')[1], account_type, str(role)[6:]])
-    return data
\ No newline at end of file
+    return [(member, roles[member]) for member in members]
@@ -0,0 +1,434 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Keeps the history of the report tables and answers point-in-time queries
+
+Every run appends the rows that appeared and disappeared since the previous
+run ('added' and 'removed' events) to a partition of its day, e.g.
+
+    <path>/iam/2016-10-18/083000-000000/b07.parquet
+
+A partition is a directory of BUCKETS data files (see security.frames), a
+project's rows are in bucket crc32(project ID) % BUCKETS, so a query for a
+few projects only reads their buckets. Rows are identified by a hash of all
+their columns, so a changed row is a removed and an added version. Unchanged
+tables only add a line to runs.txt. The buckets are categorical DataFrames
+sorted by the key columns of the table (see snapshot.DIFF_KEYS).
+
+A query turns the events into intervals: every row version with the run it
+was first seen in (Since), the last run it was seen in (Last_seen) and the
+first run it was missing from (Until, NaT while it still exists).
+
+Compaction merges the daily partitions of a month into one partition,
+retention folds the events older than the retention period into base/ (the
+rows that existed at that time), so years of hourly runs stay small.
+
+"""
+
+import datetime
+import glob
+import os
+import shutil
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from security.frames import write_frame, read_frame, frame_file, frame_files
+from security.snapshot import DIFF_KEYS, _row_hashes
+
+# Files per partition, the rows of a project are in one of them
+BUCKETS = 16
+
+# Columns added to the rows of a table by the store
+EVENT_COLUMNS = ['Row_hash', 'Run', 'Event']
+INTERVAL_COLUMNS = ['Since', 'Last_seen', 'Until']
+
+def _table_dir(title):
+    return title.lower().replace(' ', '_')
+
+def _keys(title):
+    """
+    Return the key columns of a table given by its title or directory name
+    """
+
+    for diff_title, keys in DIFF_KEYS.items():
+        if _table_dir(diff_title) == _table_dir(title):
+            return keys
+    return []
+
+def _compact(frame):
+    """
+    Return a frame with its text columns dictionary encoded (lists stay objects)
+    """
+
+    for column in frame.columns:
+        values = frame[column]
+        if values.dtype == object and not values.map(lambda v: isinstance(v, list)).any():
+            frame[column] = values.astype('category')
+        elif hasattr(values, 'cat'):
+            frame[column] = values.cat.remove_unused_categories()
+    return frame
+
+def _bucket(project):
+    return (zlib.crc32(str(project)) & 0xffffffff) % BUCKETS
+
+def _buckets(table):
+    """
+    Return the bucket of every row of a table (0 without Project_ID)
+    """
+
+    if 'Project_ID' not in table.columns:
+        return np.zeros(len(table), dtype=int)
+
+    codes, projects = pd.factorize(table['Project_ID'].astype(object))
+    # A missing project (code -1) gets the appended bucket 0
+    return np.append([_bucket(project) for project in projects], 0).astype(int)[codes]
+
+def _matches(table, projects=None, match=None):
+    """
+    Return the rows of the given projects whose columns contain the match strings
+    """
+
+    rows = np.ones(len(table), dtype=bool)
+    if projects:
+        rows &= table['Project_ID'].isin(projects).values
+
+    for column, string in (match or {}).items():
+        values = table[column].astype(object).map(
+            lambda value: ', '.join(value) if isinstance(value, list) else value)
+        rows &= values.str.contains(string, regex=False).fillna(False).values.astype(bool)
+
+    return rows
+
+class HistoryStore(object):
+    """
+    Append-only history of the tables in a directory
+
+    retention_days: events older than this are folded into the base (None: keep all)
+    compact_after_days: daily partitions older than this are merged per month
+    """
+
+    def __init__(self, directory, retention_days=None, compact_after_days=7):
+        self.directory = directory
+        self.retention_days = retention_days
+        self.compact_after_days = compact_after_days
+
+    def _path(self, title, *parts):
+        return os.path.join(self.directory, _table_dir(title), *parts)
+
+    @staticmethod
+    def _write(events, path):
+        """
+        Replace the partition in directory path with the events, one file per bucket
+        """
+
+        # Write next to the final directory first, so an interrupted run keeps the old one
+        if os.path.isdir(path + '.tmp'):
+            shutil.rmtree(path + '.tmp')
+        os.makedirs(path + '.tmp')
+
+        # Encoded once, the buckets only drop the categories of other buckets
+        events = _compact(events.copy())
+        buckets = _buckets(events)
+        for bucket in np.unique(buckets):
+            write_frame(_compact(events.loc[buckets == bucket].reset_index(drop=True)),
+                        os.path.join(path + '.tmp', 'b%02d' % bucket))
+
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(path + '.tmp', path)
+
+    @staticmethod
+    def _read(path, projects=None):
+        """
+        Return the frames of a partition, only the buckets of the projects if given
+        """
+
+        if projects:
+            paths = [frame_file(os.path.join(path, 'b%02d' % bucket))
+                     for bucket in sorted(set(_bucket(project) for project in projects))]
+        else:
+            paths = frame_files(os.path.join(path, 'b??'))
+        return [read_frame(name) for name in paths if name is not None]
+
+    def titles(self):
+        """
+        Return the directory names of the recorded tables
+        """
+
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory)
+                      if os.path.exists(os.path.join(self.directory, name, 'runs.txt')))
+
+    def columns(self, title):
+        """
+        Return the columns of a table, without the columns of the history
+        """
+
+        state = self._state(title)
+        if state is None:
+            return []
+        return [column for column in state.columns if column not in EVENT_COLUMNS]
+
+    def runs(self, title):
+        """
+        Return the times of all runs of a table (after retention)
+        """
+
+        path = self._path(title, 'runs.txt')
+        if not os.path.exists(path):
+            return pd.DatetimeIndex([])
+
+        with open(path, 'r') as the_file:
+            return pd.DatetimeIndex([line.strip() for line in the_file if line.strip()])
+
+    def _partitions(self, title):
+        """
+        Return (start, end, path) of every partition (monthly and daily), oldest first
+        """
+
+        partitions = []
+        for path in glob.glob(self._path(title, '????-??')):
+            start = pd.Timestamp(os.path.basename(path) + '-01')
+            partitions.append((start, start + pd.DateOffset(months=1), path))
+
+        for path in glob.glob(self._path(title, '????-??-??', '??????-??????')):
+            start = pd.Timestamp(os.path.basename(os.path.dirname(path)))
+            partitions.append((start, start + pd.Timedelta(days=1), path))
+
+        return sorted(partitions)
+
+    def events(self, title, until=None, projects=None, match=None):
+        """
+        Return the events of a table up to a time (base rows are 'added' events)
+        """
+
+        paths = [self._path(title, 'base')] if os.path.isdir(self._path(title, 'base')) else []
+        paths += [path for start, _, path in self._partitions(title)
+                  if until is None or start <= until]
+
+        parts = []
+        for path in paths:
+            for events in self._read(path, projects):
+                rows = _matches(events, projects, match)
+                if until is not None:
+                    rows &= (events['Run'] <= until).values
+                parts.append(events.loc[rows])
+
+        if not parts:
+            return None
+
+        return pd.concat(parts, ignore_index=True)
+
+    def intervals(self, title, start=None, end=None, projects=None, match=None):
+        """
+        Return the row versions of a table that existed between start and end
+
+        The rows get the columns Since, Last_seen and Until (see module doc).
+        """
+
+        events = self.events(title, end, projects, match)
+        if events is None or not len(events):
+            return None
+
+        # Events of one row version alternate: added, removed, added, ...
+        events = events.sort_values(['Row_hash', 'Run'], kind='mergesort').reset_index(drop=True)
+        hashes = events['Row_hash'].values
+        runs = events['Run'].values
+        removal = (events['Event'] == 'removed').values
+
+        closed = np.append((hashes[1:] == hashes[:-1]) & removal[1:], False)
+        until = np.where(closed, np.append(runs[1:], np.datetime64('NaT')),
+                         np.datetime64('NaT')).astype('datetime64[ns]')
+
+        intervals = events.loc[~removal].drop(EVENT_COLUMNS, axis=1)
+        intervals['Since'] = runs[~removal]
+        intervals['Until'] = until[~removal]
+
+        # The last run before Until (or the last run) is the last one that saw the row
+        all_runs = np.sort(self.runs(title).values)
+        last = np.searchsorted(all_runs, np.where(pd.isnull(intervals['Until']),
+                                                  np.datetime64('2262-01-01'),
+                                                  intervals['Until'].values)) - 1
+        intervals['Last_seen'] = all_runs[np.maximum(last, 0)] if len(all_runs) else pd.NaT
+
+        rows = np.ones(len(intervals), dtype=bool)
+        if start is not None:
+            rows &= (pd.isnull(intervals['Until']) | (intervals['Until'] > start)).values
+        if end is not None:
+            rows &= (intervals['Since'] <= end).values
+
+        intervals = intervals.loc[rows].sort_values(_keys(title) + ['Since'], kind='mergesort')
+        columns = [column for column in intervals.columns if column not in INTERVAL_COLUMNS]
+        return intervals[columns + INTERVAL_COLUMNS].reset_index(drop=True)
+
+    def at(self, title, when, projects=None, match=None):
+        """
+        Return the rows of a table as they were at a time (with Since)
+        """
+
+        intervals = self.intervals(title, when, when, projects, match)
+        if intervals is None:
+            return None
+
+        return intervals.drop(['Last_seen', 'Until'], axis=1)
+
+    def _state(self, title):
+        """
+        Return the rows of the last run with Row_hash and Run (the run they appeared in)
+        """
+
+        path = frame_file(self._path(title, 'state'))
+        if path is not None:
+            return read_frame(path)
+
+        # Rebuilt from the events if the state file is lost
+        intervals = self.intervals(title)
+        if intervals is None:
+            return None
+
+        current = intervals.loc[pd.isnull(intervals['Until'])]
+        current = current.drop(['Last_seen', 'Until'], axis=1).rename(columns={'Since': 'Run'})
+        current.insert(len(current.columns) - 1, 'Row_hash',
+                       _row_hashes(current, [c for c in current.columns if c != 'Run']))
+        return current.reset_index(drop=True)
+
+    def record(self, title, table, when):
+        """
+        Append the changes of a table since the previous run
+        """
+
+        columns = list(table.columns)
+        keys = _keys(title) or columns[:1]
+
+        table = table.reset_index(drop=True)
+        hashes = _row_hashes(table, columns)
+        unique = ~pd.Index(hashes).duplicated()
+        table, hashes = table.loc[unique].reset_index(drop=True), hashes[unique]
+
+        state = self._state(title)
+        if state is None:
+            state = pd.DataFrame([], columns=columns + ['Row_hash', 'Run'])
+            state['Row_hash'] = state['Row_hash'].astype(np.uint64)
+
+        added = ~pd.Index(hashes).isin(state['Row_hash'].values)
+        removed = ~pd.Index(state['Row_hash'].values).isin(hashes)
+
+        new_rows = table.loc[added].copy()
+        new_rows['Row_hash'] = hashes[added]
+        new_rows['Run'] = pd.Timestamp(when)
+
+        if added.any() or removed.any():
+            gone = state.loc[removed].copy()
+            gone['Run'] = pd.Timestamp(when)
+            gone['Event'] = 'removed'
+            new_events = new_rows.copy()
+            new_events['Event'] = 'added'
+
+            events = pd.concat([new_events, gone], ignore_index=True)[columns + EVENT_COLUMNS]
+            events = events.sort_values(keys, kind='mergesort').reset_index(drop=True)
+            self._write(events, self._path(
+                title, when.strftime('%Y-%m-%d'), when.strftime('%H%M%S-%f')))
+
+            state = pd.concat([state.loc[~removed], new_rows], ignore_index=True)
+            write_frame(_compact(state[columns + ['Row_hash', 'Run']]), self._path(title, 'state'))
+
+        elif frame_file(self._path(title, 'state')) is None:
+            write_frame(state, self._path(title, 'state'))
+
+        with open(self._path(title, 'runs.txt'), 'a') as the_file:
+            the_file.write(pd.Timestamp(when).isoformat() + '\n')
+
+    def compact(self, title, now):
+        """
+        Merge the daily partitions older than compact_after_days into monthly ones
+        """
+
+        cutoff = pd.Timestamp(now) - pd.Timedelta(days=self.compact_after_days)
+        days = {}
+        for path in glob.glob(self._path(title, '????-??-??')):
+            day = pd.Timestamp(os.path.basename(path))
+            if day + pd.Timedelta(days=1) <= cutoff:
+                days.setdefault(os.path.basename(path)[:7], []).append(path)
+
+        for month, day_dirs in sorted(days.items()):
+            month_path = self._path(title, month)
+            paths = [month_path] if os.path.isdir(month_path) else []
+            for day_dir in sorted(day_dirs):
+                paths.extend(sorted(glob.glob(os.path.join(day_dir, '??????-??????'))))
+
+            # Categories of the partitions differ, the merged columns are encoded again
+            events = pd.concat([frame for path in paths for frame in self._read(path)],
+                               ignore_index=True)
+            events = events.sort_values(_keys(title) + ['Run'], kind='mergesort')\
+                .reset_index(drop=True)
+            self._write(events, month_path)
+
+            for day_dir in day_dirs:
+                shutil.rmtree(day_dir)
+
+    def expire(self, title, now):
+        """
+        Fold the partitions older than retention_days into the base
+        """
+
+        if not self.retention_days:
+            return
+
+        cutoff = pd.Timestamp(now) - pd.Timedelta(days=self.retention_days)
+        # A partition expires when its whole day (or month) is older than the cutoff
+        expired = [(end, path) for _, end, path in self._partitions(title) if end <= cutoff]
+
+        if not expired:
+            return
+
+        # The rows that existed at the end of the expired partitions become the base
+        last = max(end for end, _ in expired)
+        base = self.at(title, last - pd.Timedelta(microseconds=1))
+        base_path = self._path(title, 'base')
+        if base is None or not len(base):
+            if os.path.isdir(base_path):
+                shutil.rmtree(base_path)
+        else:
+            base = base.rename(columns={'Since': 'Run'})
+            columns = [column for column in base.columns if column != 'Run']
+            base['Row_hash'] = _row_hashes(base, columns)
+            base['Event'] = 'added'
+            self._write(base[columns + EVENT_COLUMNS], base_path)
+
+        for _, path in expired:
+            shutil.rmtree(path)
+            if not os.listdir(os.path.dirname(path)):
+                os.rmdir(os.path.dirname(path))
+
+        runs = self.runs(title)
+        with open(self._path(title, 'runs.txt.tmp'), 'w') as the_file:
+            for run in runs[runs >= last]:
+                the_file.write(run.isoformat() + '\n')
+        os.rename(self._path(title, 'runs.txt.tmp'), self._path(title, 'runs.txt'))
+
+    def maintain(self, now):
+        """
+        Apply compaction and retention to all tables
+        """
+
+        for title in self.titles():
+            self.compact(title, now)
+            self.expire(title, now)
+
+def record_sections(sections, store, when=None):
+    """
+    Record the tables of the DIFF_KEYS sections while they pass by
+    """
+
+    when = when or datetime.datetime.now()
+    for title, table, highlight in sections:
+        if title in DIFF_KEYS:
+            store.record(title, table, when)
+        yield title, table, highlight
+
+    store.maintain(when)
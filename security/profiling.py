@@ -0,0 +1,224 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Records where a run spends its time
+
+Per stage: wall time, API calls, bytes received, rows produced and the peak
+RSS of the process at the end of the stage. Per project: API calls, bytes and
+the time spent waiting for its requests, to find slow projects.
+
+"""
+
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size of the process in MB
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+class CountingHttp(object):
+    """
+    Wraps an http object and counts the bytes of the responses
+    """
+
+    def __init__(self, http, profiler):
+        self._http = http
+        self._profiler = profiler
+
+    def request(self, *args, **kwargs):
+        resp, content = self._http.request(*args, **kwargs)
+        self._profiler.record_bytes(len(content or ''))
+        return resp, content
+
+    def __getattr__(self, name):
+        return getattr(self._http, name)
+
+# Statistics that are summed up per stage and per project
+STAGE_COUNTS = ('seconds', 'api_calls', 'bytes', 'rows')
+PROJECT_COUNTS = ('seconds', 'api_calls', 'bytes')
+
+class Profiler(object):
+    """
+    Collects the statistics of one run (thread-safe)
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Drop all statistics, e.g. before every poll of the daemon
+        """
+
+        with self._lock:
+            self.stages = []
+            self.projects = {}
+            self.api_calls = 0
+            self.bytes = 0
+            self._stages = {}
+
+    def _stage(self, name):
+        if name not in self._stages:
+            self._stages[name] = {'stage': name, 'seconds': 0.0, 'api_calls': 0,
+                                  'bytes': 0, 'rows': 0, 'peak_rss_mb': 0.0}
+            self.stages.append(self._stages[name])
+        return self._stages[name]
+
+    def _project(self, project):
+        if project not in self.projects:
+            self.projects[project] = {'project': project, 'seconds': 0.0,
+                                      'api_calls': 0, 'bytes': 0}
+        return self.projects[project]
+
+    def _add(self, name, start, api_calls, nbytes, rows=0):
+        with self._lock:
+            stage = self._stage(name)
+            stage['seconds'] += time.time() - start
+            stage['api_calls'] += self.api_calls - api_calls
+            stage['bytes'] += self.bytes - nbytes
+            stage['rows'] += rows
+            stage['peak_rss_mb'] = round(peak_rss_mb(), 1)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Record a stage. Yields a dict in which the caller can set 'rows'.
+
+        Stages that are entered several times are summed up.
+        """
+
+        result = {'rows': 0}
+        start, api_calls, nbytes = time.time(), self.api_calls, self.bytes
+        try:
+            yield result
+        finally:
+            self._add(name, start, api_calls, nbytes, result['rows'])
+
+    def timed(self, name, iterable):
+        """
+        Yield from iterable, adding the time spent producing the items to a stage
+        """
+
+        iterator = iter(iterable)
+        while True:
+            start, api_calls, nbytes = time.time(), self.api_calls, self.bytes
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self._add(name, start, api_calls, nbytes)
+                return
+
+            self._add(name, start, api_calls, nbytes)
+            yield item
+
+    def set_project(self, project):
+        """
+        Attribute the requests of the current thread to a project (None for none)
+        """
+
+        self._local.project = project
+
+    def record_request(self, seconds):
+        """
+        Count one API request of the current thread's project
+        """
+
+        project = getattr(self._local, 'project', None)
+        with self._lock:
+            self.api_calls += 1
+            if project is not None:
+                stats = self._project(project)
+                stats['api_calls'] += 1
+                stats['seconds'] += seconds
+
+    def record_bytes(self, nbytes):
+        """
+        Count received bytes of the current thread's project
+        """
+
+        project = getattr(self._local, 'project', None)
+        with self._lock:
+            self.bytes += nbytes
+            if project is not None:
+                self._project(project)['bytes'] += nbytes
+
+    def slowest_projects(self, n=10):
+        """
+        Return the statistics of the n projects with the most request time
+        """
+
+        with self._lock:
+            projects = sorted(self.projects.values(), key=lambda p: -p['seconds'])
+        return projects[:n]
+
+    def to_dict(self):
+        """
+        Return all statistics as JSON serializable dict
+        """
+
+        with self._lock:
+            return {'stages': [dict(stage) for stage in self.stages],
+                    'projects': sorted([dict(p) for p in self.projects.values()],
+                                       key=lambda p: -p['seconds'])}
+
+    def since(self, before):
+        """
+        Return the statistics added since before (an earlier to_dict() of this profiler)
+        """
+
+        stats = self.to_dict()
+        old_stages = dict((stage['stage'], stage) for stage in before['stages'])
+        old_projects = dict((p['project'], p) for p in before['projects'])
+
+        for stage in stats['stages']:
+            for key in STAGE_COUNTS:
+                stage[key] -= old_stages.get(stage['stage'], {}).get(key, 0)
+        for project in stats['projects']:
+            for key in PROJECT_COUNTS:
+                project[key] -= old_projects.get(project['project'], {}).get(key, 0)
+
+        stats['stages'] = [stage for stage in stats['stages']
+                           if any(stage[key] for key in STAGE_COUNTS)]
+        stats['projects'] = [project for project in stats['projects']
+                             if any(project[key] for key in PROJECT_COUNTS)]
+        return stats
+
+    def merge(self, stats):
+        """
+        Add the statistics of another profiler (see to_dict), e.g. of a worker process
+
+        The seconds of stages that ran in parallel processes are summed up.
+        """
+
+        with self._lock:
+            for other in stats['stages']:
+                stage = self._stage(other['stage'])
+                for key in STAGE_COUNTS:
+                    stage[key] += other[key]
+                stage['peak_rss_mb'] = max(stage['peak_rss_mb'], other['peak_rss_mb'])
+
+            for other in stats['projects']:
+                project = self._project(other['project'])
+                for key in PROJECT_COUNTS:
+                    project[key] += other[key]
+
+    def dump(self, path):
+        """
+        Write the statistics as JSON
+        """
+
+        with open(path, 'w') as the_file:
+            json.dump(self.to_dict(), the_file, indent=2)
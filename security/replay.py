@@ -0,0 +1,153 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Records the HTTP responses of a crawl as fixtures and replays them offline
+
+RecordingHttp and ReplayHttp stand in for the authorized http objects of the
+collector (see security.collector), so the discovery clients, gcp_calls and
+the rest of the watchdog run unchanged against recorded responses.
+
+Every response is kept in one JSON file per request, named by a hash of the
+method, the URI (with sorted query parameters) and the body. Bodies of batch
+requests are normalized first: their MIME boundary, the random Content-ID
+base and the access tokens of the parts change from run to run.
+
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+from urllib import urlencode
+from urlparse import urlsplit, urlunsplit, parse_qsl
+
+import httplib2
+
+_boundary_pattern = re.compile(r'boundary="?([^";]+)"?')
+_content_id_pattern = re.compile(r'Content-ID: <[^ >]+ \+ ')
+_authorization_pattern = re.compile(r'^authorization: .*$\n?', re.IGNORECASE | re.MULTILINE)
+
+class MissingFixture(Exception):
+    """
+    Raised when a replayed request was not recorded
+    """
+
+def normalize_uri(uri):
+    """
+    Return the URI with its query parameters sorted
+    """
+
+    scheme, netloc, path, query, fragment = urlsplit(uri)
+    return urlunsplit((scheme, netloc, path, urlencode(sorted(parse_qsl(query, True))), fragment))
+
+def normalize_body(body, headers=None):
+    """
+    Return the parts of a request body that are the same in every run
+    """
+
+    if not body:
+        return ''
+
+    content_type = dict((key.lower(), value) for key, value in (headers or {}).items())\
+        .get('content-type', '')
+    if content_type.startswith('multipart/'):
+        match = _boundary_pattern.search(content_type)
+        if match:
+            body = body.replace(match.group(1), 'BOUNDARY')
+        body = _content_id_pattern.sub('Content-ID: <BATCH + ', body)
+        body = _authorization_pattern.sub('', body)
+
+    return body
+
+def request_key(uri, method='GET', body=None, headers=None):
+    """
+    Return the fixture name of a request
+    """
+
+    text = '\n'.join([method.upper(), normalize_uri(uri), normalize_body(body, headers)])
+    return hashlib.sha1(text).hexdigest()
+
+class FixtureStore(object):
+    """
+    Directory of recorded responses (thread-safe)
+
+    The discovery documents of the recorded APIs are kept in its 'discovery'
+    subdirectory (see security.discovery_cache).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.discovery_dir = os.path.join(directory, 'discovery')
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        """
+        Return the recorded (response headers, content) of a request or None
+        """
+
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'r') as the_file:
+            fixture = json.load(the_file)
+
+        headers = dict((str(name), str(value)) for name, value in fixture['headers'].items())
+        return headers, fixture['content'].encode('utf-8')
+
+    def put(self, key, uri, method, headers, content):
+        """
+        Record the response of a request
+        """
+
+        fixture = {'uri': uri, 'method': method, 'headers': dict(headers),
+                   'content': content.decode('utf-8')}
+
+        with self._lock:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+            # Write next to the final file first, so a replay never reads half a fixture
+            tmp_path = '%s.%d.tmp' % (self._path(key), os.getpid())
+            with open(tmp_path, 'w') as the_file:
+                json.dump(fixture, the_file, indent=1, sort_keys=True)
+            os.rename(tmp_path, self._path(key))
+
+class RecordingHttp(object):
+    """
+    Wraps an http object and records all its responses in a FixtureStore
+    """
+
+    def __init__(self, http, store):
+        self._http = http
+        self._store = store
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        resp, content = self._http.request(uri, method, body, headers, *args, **kwargs)
+        self._store.put(request_key(uri, method, body, headers), uri, method, resp, content or '')
+        return resp, content
+
+    def __getattr__(self, name):
+        return getattr(self._http, name)
+
+class ReplayHttp(object):
+    """
+    Answers requests with the responses recorded in a FixtureStore
+    """
+
+    def __init__(self, store):
+        self._store = store
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        fixture = self._store.get(request_key(uri, method, body, headers))
+        if fixture is None:
+            raise MissingFixture("no recorded response for %s %s" % (method, uri))
+
+        headers, content = fixture
+        return httplib2.Response(headers), content
@@ -0,0 +1,103 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Evaluates the compiled rules of the watchdog.yaml (see security.config) on a table
+
+Every rule matches if the configured string appears in the column value. The
+strings of one rule and column are combined into one regex, which is
+evaluated once per distinct column value (once per category of the
+categorical tables).
+
+"""
+
+import numpy as np
+import pandas as pd
+
+from security.config import RULE_TYPES
+
+def _as_text(value):
+    """
+    Return a column value as string (lists are joined, e.g. the IAM roles)
+    """
+
+    if isinstance(value, (list, tuple)):
+        return ', '.join(str(v) for v in value)
+
+    return value if isinstance(value, basestring) else str(value)
+
+def _factorize(column):
+    """
+    Return the codes of a column and its distinct values as strings
+    """
+
+    if hasattr(column, 'cat'):
+        # Categorical tables (see security.tables) are already factorized
+        return column.cat.codes.values, [_as_text(value) for value in column.cat.categories]
+
+    try:
+        codes, uniques = pd.factorize(column)
+    except TypeError:
+        # Unhashable values (the lists of IAM roles) are compared by their text,
+        # joined inline since this runs once per row
+        codes, uniques = pd.factorize(np.array(
+            [', '.join(value) if isinstance(value, list) else value
+             for value in column.values], dtype=object))
+
+    return codes, [_as_text(value) for value in uniques]
+
+def _match(factorized, regex):
+    """
+    Return a boolean array, True where the regex is found in the value
+    """
+
+    codes, uniques = factorized
+    hits = np.array([regex.search(value) is not None for value in uniques] + [False],
+                    dtype=bool)
+
+    # Missing values have the code -1, which picks the trailing False
+    return hits[codes]
+
+def evaluate_rules(table, rules):
+    """
+    Evaluate all rules of a table (its TableRules) in one pass
+
+    Returns (keep, highlight) boolean arrays: keep is False for rows removed by
+    an ignore rule or not matched by all notify rules, highlight is True for
+    kept rows matched by any alert rule.
+    """
+
+    keep = np.ones(len(table), dtype=bool)
+    alert = np.zeros(len(table), dtype=bool)
+    factorized = {}
+
+    for rule_type in RULE_TYPES:
+        for column, _, regex in getattr(rules, rule_type):
+            if column not in factorized:
+                factorized[column] = _factorize(table[column])
+
+            matches = _match(factorized[column], regex)
+
+            if rule_type == 'ignore':
+                keep &= ~matches
+            elif rule_type == 'notify':
+                keep &= matches
+            elif rule_type == 'alert':
+                alert |= matches
+
+    return keep, keep & alert
+
+def apply_rules(table, rules):
+    """
+    Filter a table with its compiled rules (TableRules)
+
+    Returns the kept rows, indexed from 1, and their highlight mask
+    """
+
+    keep, highlight = evaluate_rules(table, rules)
+
+    table = table.loc[keep].reset_index(drop=True)
+    table.index += 1
+
+    return table, highlight[keep]
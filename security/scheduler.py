@@ -0,0 +1,207 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Schedules the GCP requests per API: rate limits, adaptive concurrency and retries
+
+Every API (compute, cloudresourcemanager, ...) gets a token bucket for its
+requests per second and a concurrency limit that is halved on every quota
+error and grows back by one per window of successful requests (AIMD).
+Quota errors (429, 403 rateLimitExceeded), server errors and connection
+errors (resets, timeouts) are retried with jittered exponential backoff,
+permission errors are raised immediately.
+
+"""
+
+import httplib
+import json
+import random
+import socket
+import threading
+import time
+from urlparse import urlparse
+
+from httplib2 import HttpLib2Error
+from googleapiclient.errors import HttpError
+
+# Errors of the connection, not of the request (socket.timeout is a socket.error)
+TRANSPORT_ERRORS = (socket.error, HttpLib2Error, httplib.HTTPException)
+
+# Reasons of 403 errors that are quota errors and not permission errors
+QUOTA_REASONS = set(['rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded',
+                     'RATE_LIMIT_EXCEEDED', 'RESOURCE_EXHAUSTED'])
+
+def is_quota_error(error):
+    """
+    Return True if an HttpError is caused by a rate limit or quota and not by permissions
+    """
+
+    if not isinstance(error, HttpError):
+        return False
+
+    status = int(error.resp.status)
+    if status == 429:
+        return True
+    if status != 403:
+        return False
+
+    try:
+        details = json.loads(error.content).get('error', {})
+    except (ValueError, TypeError, AttributeError):
+        return False
+
+    reasons = set([details.get('status')])
+    reasons.update(e.get('reason') for e in details.get('errors', []))
+    return bool(reasons & QUOTA_REASONS)
+
+def _is_retryable(error):
+    return is_quota_error(error) or isinstance(error, TRANSPORT_ERRORS) or (
+        isinstance(error, HttpError) and int(error.resp.status) in (500, 502, 503, 504))
+
+def api_name(request):
+    """
+    Return the API a request belongs to, e.g. 'compute' or 'cloudresourcemanager'
+    """
+
+    uri = getattr(request, 'uri', None) or getattr(request, '_batch_uri', None)
+    if not uri:
+        return 'default'
+
+    parsed = urlparse(uri)
+    if parsed.netloc == 'www.googleapis.com':
+        # e.g. https://www.googleapis.com/compute/v1/projects/...
+        return parsed.path.split('/')[1]
+
+    return parsed.netloc.split('.')[0]
+
+class TokenBucket(object):
+    """
+    Allows `rate` requests per second with bursts of up to `rate` requests
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, sleeping until it is available. Returns the seconds slept.
+        """
+
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+class _Api(object):
+    """
+    Rate limit, concurrency limit and statistics of one API
+    """
+
+    def __init__(self, rate, max_concurrency):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.stats = {'requests': 0, 'retries': 0, 'quota_errors': 0, 'transport_errors': 0,
+                      'throttled_seconds': 0.0}
+
+class Scheduler(object):
+    """
+    Executes discovery requests with per-API rate limits, AIMD concurrency and retries
+
+    rates maps an API name to its requests per second (no limit if missing).
+    """
+
+    def __init__(self, rates=None, max_concurrency=1, retries=5, backoff=1.0):
+        self.rates = dict(rates or {})
+        self.max_concurrency = max(1, int(max_concurrency or 1))
+        self.retries = retries
+        self.backoff = backoff
+        self._apis = {}
+        self._lock = threading.Lock()
+
+    def _api(self, name):
+        with self._lock:
+            if name not in self._apis:
+                self._apis[name] = _Api(self.rates.get(name), self.max_concurrency)
+            return self._apis[name]
+
+    def _acquire(self, api):
+        start = time.time()
+        with api.condition:
+            while api.in_flight >= int(api.limit):
+                api.condition.wait()
+            api.in_flight += 1
+
+        waited = time.time() - start
+        if api.bucket is not None:
+            waited += api.bucket.acquire()
+        return waited
+
+    def _release(self, api, quota_error):
+        with api.condition:
+            api.in_flight -= 1
+            if quota_error:
+                api.limit = max(1.0, api.limit / 2)
+            else:
+                api.limit = min(float(api.max_concurrency), api.limit + 1.0 / api.limit)
+            api.condition.notify_all()
+
+    def execute(self, request, http=None):
+        """
+        Execute a request (on http, if given), retrying quota, server and connection errors
+        """
+
+        api = self._api(api_name(request))
+
+        for attempt in range(self.retries + 1):
+            throttled = self._acquire(api)
+            error = None
+            try:
+                if http is None:
+                    return request.execute()
+                return request.execute(http=http)
+
+            except (HttpError,) + TRANSPORT_ERRORS as e:
+                error = e
+                if attempt == self.retries or not _is_retryable(e):
+                    raise
+
+            finally:
+                quota_error = error is not None and is_quota_error(error)
+                self._release(api, quota_error)
+
+                with api.condition:
+                    api.stats['requests'] += 1
+                    api.stats['throttled_seconds'] += throttled
+                    if quota_error:
+                        api.stats['quota_errors'] += 1
+                    if isinstance(error, TRANSPORT_ERRORS):
+                        api.stats['transport_errors'] += 1
+
+            # Exponential backoff with jitter before the retry
+            delay = self.backoff * (2 ** attempt) * random.random()
+            time.sleep(delay)
+
+            with api.condition:
+                api.stats['retries'] += 1
+                api.stats['throttled_seconds'] += delay
+
+    def stats(self):
+        """
+        Return a dict mapping each API name to its request statistics
+        """
+
+        with self._lock:
+            return dict((name, dict(api.stats)) for name, api in self._apis.items())
@@ -0,0 +1,144 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Keeps the tables of the previous run and computes what changed since then
+
+Rows are matched by a hash of their key columns (Project_ID and the resource
+name) and compared by a hash of all columns, so the diff is a hash join and
+scales linearly with the number of rows.
+
+"""
+
+import os
+
+import pandas as pd
+
+from security.frames import write_frame, read_frame, frame_file
+
+# Key columns of the tables that are diffed, by report section
+DIFF_KEYS = {'Instances': ['Project_ID', 'Zone', 'Instance'],
+             'IAM': ['Project_ID', 'Email'],
+             'Firewalls': ['Project_ID', 'Rule_name', 'Protocol']}
+
+class SnapshotStore(object):
+    """
+    Stores one snapshot per table in a directory, as a data file (see security.frames)
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, title):
+        return os.path.join(self.directory, title.lower().replace(' ', '_'))
+
+    def load(self, title):
+        """
+        Return the table of the previous run or None
+        """
+
+        path = frame_file(self._path(title))
+        if path is None:
+            return None
+
+        return read_frame(path)
+
+    def save(self, title, table):
+        """
+        Replace the snapshot of a table
+        """
+
+        # write_frame replaces the old snapshot only once the new one is complete
+        write_frame(table.reset_index(drop=True), self._path(title))
+
+def _hashable(table):
+    """
+    Return the table with lists (the IAM roles) turned into strings
+    """
+
+    table = table.copy()
+    for column in table.columns:
+        if table[column].dtype == object:
+            table[column] = table[column].map(
+                lambda value: ', '.join(value) if isinstance(value, list) else value)
+
+    return table
+
+def _row_hashes(table, columns):
+    return pd.util.hash_pandas_object(_hashable(table[columns]), index=False).values
+
+def alert_keys(table, highlight):
+    """
+    Return the set of hashes of the highlighted rows of a table
+    """
+
+    if highlight is None or not len(table):
+        return set()
+
+    alerts = table.loc[pd.Series(list(highlight), index=table.index).astype(bool)]
+    return set(_row_hashes(alerts, list(alerts.columns)))
+
+def diff_tables(old, new, keys):
+    """
+    Return the added, removed and changed rows of a table
+
+    The result has the columns of new plus a leading 'Change' column
+    ('added', 'changed' or 'removed'). Added and changed rows come from new,
+    removed rows from old.
+    """
+
+    columns = [column for column in new.columns if column != 'highlighted']
+
+    if old is None:
+        old = pd.DataFrame([], columns=new.columns)
+
+    new_keys = pd.Index(_row_hashes(new, keys))
+    old_keys = pd.Index(_row_hashes(old, keys))
+    old_rows = pd.Series(_row_hashes(old, columns), index=old_keys)
+    old_rows = old_rows[~old_keys.duplicated(keep='last')]
+
+    in_old = new_keys.isin(old_keys)
+    added = ~in_old
+    changed = in_old & (old_rows.reindex(new_keys).values != _row_hashes(new, columns))
+    removed = ~old_keys.isin(new_keys)
+
+    parts = []
+    for rows, change in [(new.loc[added], 'added'), (new.loc[changed], 'changed'),
+                         (old.loc[removed], 'removed')]:
+        rows = rows.copy()
+        rows.insert(0, 'Change', change)
+        parts.append(rows)
+
+    diff = pd.concat(parts, ignore_index=True)[['Change'] + list(new.columns)]
+    diff.index += 1
+    return diff
+
+def diff_sections(sections, store, diff=True):
+    """
+    Save the tables of the DIFF_KEYS sections and, with diff=True, replace them by their changes
+
+    sections yields (title, table, highlight). The highlight is stored with the
+    table, so removed rows keep the highlight they had in the previous run.
+    """
+
+    for title, table, highlight in sections:
+        if title not in DIFF_KEYS:
+            yield title, table, highlight
+            continue
+
+        current = table.copy()
+        current['highlighted'] = list(highlight) if highlight is not None else False
+
+        if diff:
+            changes = diff_tables(store.load(title), current, DIFF_KEYS[title])
+            changes_highlight = changes.pop('highlighted').astype(bool).values
+
+        store.save(title, current)
+
+        if diff:
+            yield title + ' (changes)', changes, changes_highlight
+        else:
+            yield title, table, highlight
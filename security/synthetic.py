@@ -0,0 +1,278 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Generates a synthetic GCP organization and serves it like the GCP APIs
+
+SyntheticHttp stands in for the authorized http objects of the collector
+(see security.replay), so the watchdog can be run and timed against
+organizations of any size without credentials, e.g.
+
+    gcp-watchdog --synthetic projects=100000,instances=5 --profile profile.json
+
+The organization is derived from the project numbers, so the same sizes
+always give the same inventory and no response is held in memory.
+
+"""
+
+import json
+import re
+from urlparse import urlsplit, parse_qsl
+
+import httplib2
+
+# Default size of every project
+DEFAULT_SIZES = {'projects': 10, 'zones': 8, 'instances': 3, 'bindings': 4, 'firewalls': 3,
+                 'denied': 0}
+
+REGIONS = ['europe-west1', 'us-central1', 'us-east1', 'asia-east1', 'europe-west2',
+           'us-west1', 'asia-northeast1', 'australia-southeast1']
+MACHINE_TYPES = ['n1-standard-1', 'n1-standard-4', 'n1-highmem-8', 'f1-micro', 'g1-small']
+ROLES = ['roles/owner', 'roles/editor', 'roles/viewer', 'roles/compute.admin',
+         'roles/storage.objectViewer']
+DOMAINS = ['my.company.com', 'my.company.com', 'my.company.com', 'partner.com', 'others.com']
+SOURCE_RANGES = [['0.0.0.0/0'], ['10.0.0.0/8'], ['35.191.0.0/16', '130.211.0.0/22'],
+                 ['192.168.0.0/24'], ['0.0.0.0/0', '::/0']]
+ALLOWED = [[{'IPProtocol': 'tcp', 'ports': ['22']}],
+           [{'IPProtocol': 'tcp', 'ports': ['80', '443']}],
+           [{'IPProtocol': 'tcp', 'ports': ['3389']}, {'IPProtocol': 'udp', 'ports': ['53']}],
+           [{'IPProtocol': 'icmp'}],
+           [{'IPProtocol': 'tcp', 'ports': ['8000-9000']}]]
+
+# Page size of the list calls without maxResults
+PAGE_SIZE = 500
+
+def parse_sizes(text):
+    """
+    Return the sizes of an organization given as e.g. '1000' or 'projects=1000,instances=5'
+    """
+
+    sizes = dict(DEFAULT_SIZES)
+    for item in text.split(','):
+        name, _, value = item.strip().rpartition('=')
+        name = name or 'projects'
+        if name not in sizes:
+            raise ValueError("unknown size '%s' (choose from %s)" % (
+                name, ', '.join(sorted(DEFAULT_SIZES))))
+        sizes[name] = int(value)
+
+    return sizes
+
+class SyntheticOrg(object):
+    """
+    Organization of projects with zones, instances, IAM bindings and firewall rules
+
+    Every project has the given number of instances, bindings (of two
+    members each) and firewall rules. The last `denied` projects answer
+    the compute calls with 403, as projects without Compute Engine do.
+    """
+
+    def __init__(self, projects=10, zones=8, instances=3, bindings=4, firewalls=3, denied=0):
+        self.projects = projects
+        self.instances = instances
+        self.bindings = bindings
+        self.firewalls = firewalls
+        self.denied = denied
+        self.zones = ['%s-%s' % (REGIONS[i % len(REGIONS)], 'bcdf'[i // len(REGIONS) % 4])
+                      for i in range(zones)]
+
+        self._numbers = dict((self.project_id(i), i) for i in range(projects))
+
+    @staticmethod
+    def project_id(number):
+        return 'synthetic-%06d' % number
+
+    def number(self, project):
+        """
+        Return the number of a project, None for unknown projects
+        """
+
+        return self._numbers.get(project)
+
+    def is_denied(self, number):
+        return number >= self.projects - self.denied
+
+    def project_resource(self, number):
+        return {'projectId': self.project_id(number), 'name': 'Synthetic %d' % number,
+                'projectNumber': str(100000000 + number), 'lifecycleState': 'ACTIVE'}
+
+    def zone_resources(self):
+        return [{'kind': 'compute#zone', 'name': zone, 'status': 'UP',
+                 'region': zone.rsplit('-', 1)[0]} for zone in self.zones]
+
+    def instance_resources(self, number):
+        instances = []
+        for i in range(self.instances):
+            zone = self.zones[(number + i) % len(self.zones)]
+            machine_type = MACHINE_TYPES[(number + i) % len(MACHINE_TYPES)]
+            instances.append({
+                'kind': 'compute#instance', 'name': 'vm-%d-%d' % (number, i),
+                'status': 'TERMINATED' if (number + i) % 3 == 0 else 'RUNNING',
+                'zone': 'https://www.googleapis.com/compute/v1/projects/%s/zones/%s' % (
+                    self.project_id(number), zone),
+                'machineType': 'https://www.googleapis.com/compute/v1/projects/%s/zones/%s/'
+                               'machineTypes/%s' % (self.project_id(number), zone, machine_type)})
+        return instances
+
+    def firewall_resources(self, number):
+        return [{'kind': 'compute#firewall', 'name': 'default-%d' % i if i == 0 else 'rule-%d' % i,
+                 'sourceRanges': SOURCE_RANGES[(number + i) % len(SOURCE_RANGES)],
+                 'allowed': ALLOWED[(number + i) % len(ALLOWED)]}
+                for i in range(self.firewalls)]
+
+    def iam_policy(self, number):
+        bindings = []
+        for i in range(self.bindings):
+            members = []
+            for j in range(2):
+                # Members repeat across projects, as people work on many of them
+                person = (number * 7 + i * 3 + j) % max(self.projects * 2, 50)
+                if person % 4 == 3:
+                    members.append('serviceAccount:sa-%d@%s.iam.gserviceaccount.com' % (
+                        person, self.project_id(number)))
+                else:
+                    members.append('user:first%d.last%d@%s' % (
+                        person, person, DOMAINS[person % len(DOMAINS)]))
+            bindings.append({'role': ROLES[(number + i) % len(ROLES)], 'members': members})
+
+        return {'version': 1, 'etag': 'BwE%06d' % number, 'bindings': bindings}
+
+def _page(count, item, query, key='items'):
+    """
+    Return one page of a list response, following maxResults and pageToken
+
+    item(i) returns the i-th of count items, only the items of the page are built.
+    """
+
+    start = int(query.get('pageToken') or 0)
+    size = int(query.get('maxResults') or query.get('pageSize') or PAGE_SIZE)
+    page = {key: [item(i) for i in range(start, min(start + size, count))]}
+    if start + size < count:
+        page['nextPageToken'] = str(start + size)
+    return page
+
+def _list_page(items, query):
+    return _page(len(items), items.__getitem__, query)
+
+class SyntheticHttp(object):
+    """
+    Answers the requests of the watchdog from a SyntheticOrg
+    """
+
+    routes = [
+        ('GET', re.compile(r'/v1/projects$'), '_projects'),
+        ('GET', re.compile(r'/compute/v1/projects/([^/]+)/zones$'), '_zones'),
+        ('GET', re.compile(r'/compute/v1/projects/([^/]+)/aggregated/instances$'),
+         '_aggregated_instances'),
+        ('GET', re.compile(r'/compute/v1/projects/([^/]+)/zones/([^/]+)/instances$'),
+         '_zone_instances'),
+        ('GET', re.compile(r'/compute/v1/projects/([^/]+)/global/firewalls$'), '_firewalls'),
+        ('POST', re.compile(r'/v1/projects/([^/:]+):getIamPolicy$'), '_iam_policy'),
+        ('POST', re.compile(r'/batch(/.*)?$'), '_batch'),
+    ]
+
+    def __init__(self, org):
+        self.org = org
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        status, headers, content = self.respond(method, uri, body, headers)
+        return httplib2.Response(dict(headers, status=str(status))), content
+
+    def respond(self, method, uri, body=None, headers=None):
+        """
+        Return (status, headers, content) of a request
+        """
+
+        parsed = urlsplit(uri)
+        query = dict(parse_qsl(parsed.query))
+        for route_method, pattern, handler in self.routes:
+            match = pattern.search(parsed.path)
+            if route_method == method.upper() and match:
+                return getattr(self, handler)(query, body, headers, *match.groups())
+
+        return self._error(404, 'notFound', 'No such method: %s %s' % (method, parsed.path))
+
+    @staticmethod
+    def _json(value):
+        return 200, {'content-type': 'application/json; charset=UTF-8'}, json.dumps(value)
+
+    @staticmethod
+    def _error(status, reason, message):
+        return status, {'content-type': 'application/json; charset=UTF-8'}, json.dumps(
+            {'error': {'code': status, 'message': message,
+                       'errors': [{'reason': reason, 'message': message}]}})
+
+    def _project(self, project):
+        number = self.org.number(project)
+        if number is None:
+            return None, self._error(404, 'notFound', "The resource 'projects/%s' was not found"
+                                     % project)
+        if self.org.is_denied(number):
+            return None, self._error(403, 'accessNotConfigured',
+                                     'Access Not Configured. Compute Engine API has not been '
+                                     'used in project %s' % project)
+        return number, None
+
+    def _projects(self, query, body, headers):
+        return self._json(_page(self.org.projects, self.org.project_resource, query, 'projects'))
+
+    def _zones(self, query, body, headers, project):
+        number, error = self._project(project)
+        return error or self._json(_list_page(self.org.zone_resources(), query))
+
+    def _aggregated_instances(self, query, body, headers, project):
+        number, error = self._project(project)
+        if error:
+            return error
+
+        page = _list_page(self.org.instance_resources(number), query)
+        items = {}
+        for instance in page['items']:
+            scope = 'zones/' + instance['zone'].rsplit('/', 1)[-1]
+            items.setdefault(scope, {'instances': []})['instances'].append(instance)
+        page['items'] = items
+        return self._json(page)
+
+    def _zone_instances(self, query, body, headers, project, zone):
+        number, error = self._project(project)
+        if error:
+            return error
+
+        instances = [instance for instance in self.org.instance_resources(number)
+                     if instance['zone'].endswith('/' + zone)]
+        return self._json(_list_page(instances, query))
+
+    def _firewalls(self, query, body, headers, project):
+        number, error = self._project(project)
+        return error or self._json(_list_page(self.org.firewall_resources(number), query))
+
+    def _iam_policy(self, query, body, headers, project):
+        number = self.org.number(project)
+        if number is None:
+            return self._error(403, 'forbidden', "The caller does not have permission")
+        return self._json(self.org.iam_policy(number))
+
+    def _batch(self, query, body, headers, *groups):
+        """
+        Answer every part of a batch request (see googleapiclient.http.BatchHttpRequest)
+        """
+
+        boundary = 'batch_synthetic'
+        parts = []
+        for part in re.split(r'\r?\n--[^\r\n]+', '\n' + body):
+            content_id = re.search(r'Content-ID: <([^>]+)>', part)
+            request_line = re.search(r'^(GET|POST) (\S+) HTTP/1\.1', part, re.MULTILINE)
+            if content_id is None or request_line is None:
+                continue
+
+            part_body = re.split(r'\r?\n\r?\n', part.strip(), 2)
+            status, _, content = self.respond(request_line.group(1), request_line.group(2),
+                                              part_body[2] if len(part_body) > 2 else None)
+            parts.append('--%s\r\nContent-Type: application/http\r\n'
+                         'Content-ID: <response-%s>\r\n\r\n'
+                         'HTTP/1.1 %d OK\r\nContent-Type: application/json; charset=UTF-8\r\n'
+                         '\r\n%s\r\n' % (boundary, content_id.group(1), status, content))
+
+        return 200, {'content-type': 'multipart/mixed; boundary=%s' % boundary}, \
+            ''.join(parts) + '--%s--\r\n' % boundary
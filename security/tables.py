@@ -0,0 +1,105 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Builds the report tables from the rows yielded by the GCP calls
+
+The rows are consumed in chunks and appended column by column to
+dictionary-encoded builders: every distinct value (Project_ID, Zone,
+Status, ...) is stored once and the rows only keep an integer code. The
+tables are categorical DataFrames, so memory and rule evaluation (see
+security.rules) grow with the number of distinct values.
+
+"""
+
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+
+class CategoryBuilder(object):
+    """
+    Dictionary-encoded column: distinct values and one code per row
+    """
+
+    def __init__(self):
+        self._codes = []
+        self._uniques = []
+
+    def extend(self, values):
+        """
+        Append a chunk of values (None for missing values)
+        """
+
+        codes, uniques = pd.factorize(values)
+        self._codes.append(codes)
+        self._uniques.append(uniques)
+
+    def build(self):
+        """
+        Return the column as pandas Categorical with sorted categories
+        """
+
+        if not self._codes:
+            return pd.Categorical([])
+
+        # The distinct values of all chunks are encoded once more, the chunk
+        # codes are translated with the offsets of their chunks (-1 stays missing)
+        column_codes, categories = pd.factorize(np.concatenate(self._uniques))
+        offsets = np.cumsum([0] + [len(uniques) for uniques in self._uniques])
+
+        # Sorted categories sort the rows like their values (e.g. the IAM table)
+        order = np.argsort(categories, kind='mergesort')
+        ranks = np.empty(len(order), dtype=np.int32)
+        ranks[order] = np.arange(len(order))
+
+        ranks = ranks[column_codes]
+
+        codes = np.empty(sum(len(chunk_codes) for chunk_codes in self._codes), dtype=np.int32)
+        start = 0
+        for chunk_codes, offset, end in zip(self._codes, offsets, offsets[1:]):
+            mapping = np.append(ranks[offset:end], -1)
+            codes[start:start + len(chunk_codes)] = mapping[chunk_codes]
+            start += len(chunk_codes)
+
+        return pd.Categorical.from_codes(codes, categories[order])
+
+class ObjectBuilder(object):
+    """
+    Column of Python objects, for values that can't be encoded (e.g. lists of roles)
+    """
+
+    def __init__(self):
+        self._values = []
+
+    def extend(self, values):
+        self._values.extend(values)
+
+    def build(self):
+        return self._values
+
+def build_frame(rows, columns, chunksize=50000, objects=()):
+    """
+    Build a categorical DataFrame from an iterator of rows
+
+    The rows are consumed chunk by chunk, so at most one chunk of Python lists
+    exists next to the encoded columns. The columns listed in objects keep
+    their Python values (e.g. the lists of IAM roles).
+    """
+
+    rows = iter(rows)
+    builders = [ObjectBuilder() if column in objects else CategoryBuilder()
+                for column in columns]
+
+    while True:
+        chunk = list(islice(rows, chunksize))
+        if not chunk:
+            break
+
+        chunk = pd.DataFrame(chunk, columns=columns)
+        for column, builder in zip(columns, builders):
+            builder.extend(chunk[column].values)
+
+    data = dict((column, builder.build()) for column, builder in zip(columns, builders))
+    return pd.DataFrame(data, columns=columns)
@@ -18,7 +18,7 @@ setup(name='gcp-watchdog',
           'jinja2',
           'pyyaml',
           'google-api-python-client',
-          'gcloud',
+          'httplib2',
           'oauth2client',
           'inlinestyler',
           'sendgrid'
@@ -0,0 +1,129 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Turns audit-log entries into patches and follows entry files (security.audit_log)
+
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from security.audit_log import parse_entry, FileSubscriber
+
+def _entry(method, resource, request=None, response=None, status=None,
+           service='compute.googleapis.com'):
+    payload = {'methodName': method, 'resourceName': resource, 'serviceName': service}
+    if request is not None:
+        payload['request'] = request
+    if response is not None:
+        payload['response'] = response
+    if status is not None:
+        payload['status'] = status
+    return {'protoPayload': payload}
+
+class ParseEntryTest(unittest.TestCase):
+
+    def test_set_iam_policy(self):
+        policy = {'etag': 'e1', 'bindings': [{'role': 'roles/owner',
+                                              'members': ['user:jane.doe@x.com']}]}
+        patch, = parse_entry(_entry('SetIamPolicy', 'projects/proj-a', response=policy,
+                                    service='cloudresourcemanager.googleapis.com'))
+        self.assertEqual((patch.kind, patch.match, patch.refetch), ('IAM',
+                                                                    {'Project_ID': 'proj-a'},
+                                                                    False))
+        self.assertEqual(patch.rows, [['proj-a', 'jane doe', 'jane.doe@x.com', 'x.com', 'user',
+                                       ['owner']]])
+        self.assertEqual(patch.policy, policy)
+
+        # Without the new policy, or of another service
+        patch, = parse_entry(_entry('SetIamPolicy', 'projects/proj-a',
+                                    service='cloudresourcemanager.googleapis.com'))
+        self.assertTrue(patch.refetch)
+        self.assertEqual(parse_entry(_entry('SetIamPolicy', 'projects/proj-a',
+                                            service='storage.googleapis.com')), [])
+
+    def test_firewalls(self):
+        resource = 'projects/proj-a/global/firewalls/ssh'
+        patch, = parse_entry(_entry('v1.compute.firewalls.insert', resource, request={
+            'sourceRanges': ['0.0.0.0/0'], 'alloweds': [{'IPProtocol': 'tcp', 'ports': ['22']}]}))
+        self.assertEqual(patch.match, {'Project_ID': 'proj-a', 'Rule_name': 'ssh'})
+        self.assertEqual(patch.rows, [['proj-a', 'ssh', '0.0.0.0/0', 'tcp', '22',
+                                       'compute#firewall']])
+
+        patch, = parse_entry(_entry('beta.compute.firewalls.patch', resource,
+                                    request={'disabled': True}))
+        self.assertTrue(patch.refetch)
+
+        patch, = parse_entry(_entry('v1.compute.firewalls.delete', resource))
+        self.assertEqual(patch.rows, [])
+
+    def test_instances(self):
+        resource = 'projects/proj-a/zones/eu-1/instances/vm-1'
+        patch, = parse_entry(_entry('v1.compute.instances.stop', resource))
+        self.assertEqual(patch.match, {'Project_ID': 'proj-a', 'Zone': 'eu-1', 'Instance': 'vm-1'})
+        self.assertEqual(patch.values, {'Status': 'TERMINATED'})
+
+        patch, = parse_entry(_entry('v1.compute.instances.insert', resource, request={
+            'machineType': 'zones/eu-1/machineTypes/n1-standard-1'}))
+        self.assertEqual(patch.rows, [['vm-1', 'RUNNING', 'n1-standard-1', 'proj-a', 'eu-1']])
+
+        # Later entries of the insert operation have no request
+        self.assertEqual(parse_entry(_entry('v1.compute.instances.insert', resource)), [])
+
+    def test_ignored_entries(self):
+        resource = 'projects/proj-a/zones/eu-1/instances/vm-1'
+        self.assertEqual(parse_entry(_entry('v1.compute.instances.stop', resource,
+                                            status={'code': 7})), [])
+        self.assertEqual(parse_entry(_entry('v1.compute.instances.get', resource)), [])
+        self.assertEqual(parse_entry(_entry('v1.compute.disks.insert', 'projects/proj-a')), [])
+        self.assertEqual(parse_entry({}), [])
+
+class FileSubscriberTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'entries.jsonl')
+        self.stdout, sys.stdout = sys.stdout, StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.directory)
+
+    def write(self, text, mode='a'):
+        with open(self.path, mode) as the_file:
+            the_file.write(text)
+
+    def test_pull(self):
+        self.write(json.dumps({'n': 0}) + '\n')
+        subscriber = FileSubscriber(self.path)
+        self.assertEqual(subscriber.pull(), [])
+
+        # A partly written line is read once it is complete
+        self.write(json.dumps({'n': 1}) + '\n' + '{"n": ')
+        self.assertEqual(subscriber.pull(), [{'n': 1}])
+        self.write('2}\n')
+        self.assertEqual(subscriber.pull(), [{'n': 2}])
+
+        # A rotated file is read from its start
+        self.write(json.dumps({'n': 3}) + '\n', mode='w')
+        self.assertEqual(subscriber.pull(), [{'n': 3}])
+
+        self.assertEqual(FileSubscriber(self.path, from_start=True).pull(), [{'n': 3}])
+
+    def test_bad_lines_are_skipped(self):
+        subscriber = FileSubscriber(self.path)
+        self.write('{"n": 1}\nnot json\n\n{"n": 2}\n')
+
+        self.assertEqual(subscriber.pull(), [{'n': 1}, {'n': 2}])
+        self.assertIn('Skipping a bad line of %s' % self.path, sys.stdout.getvalue())
+        self.assertEqual(subscriber.pull(), [])
+
+if __name__ == '__main__':
+    unittest.main()
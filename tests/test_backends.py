@@ -0,0 +1,116 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Reads Cloud Asset Inventory exports (security.backends.AssetExportBackend)
+
+"""
+
+import json
+import unittest
+
+from security.backends import AssetExportBackend
+
+def _project(number, project_ID, policy=None, data=True):
+    asset = {'name': '//cloudresourcemanager.googleapis.com/projects/%d' % number,
+             'asset_type': 'cloudresourcemanager.googleapis.com/Project'}
+    if data:
+        asset['resource'] = {'data': {'projectId': project_ID, 'name': project_ID.upper()}}
+    if policy:
+        asset['iam_policy'] = {'bindings': [{'role': 'roles/' + role, 'members': members}
+                                            for role, members in policy]}
+    return asset
+
+def _instance(project_ID, zone, name):
+    return {'name': '//compute.googleapis.com/projects/%s/zones/%s/instances/%s' % (
+                project_ID, zone, name),
+            'asset_type': 'compute.googleapis.com/Instance',
+            'resource': {'data': {'name': name, 'status': 'RUNNING',
+                                  'machineType': 'zones/%s/machineTypes/n1-standard-1' % zone,
+                                  'zone': 'https://x/zones/' + zone}}}
+
+def _firewall(project_ID, name, port):
+    return {'name': '//compute.googleapis.com/projects/%s/global/firewalls/%s' % (
+                project_ID, name),
+            'assetType': 'compute.googleapis.com/Firewall',
+            'resource': {'data': {'name': name, 'sourceRanges': ['0.0.0.0/0'],
+                                  'allowed': [{'IPProtocol': 'tcp', 'ports': [port]}]}}}
+
+class Lines(object):
+    """
+    The lines of an export, counting the passes over them and the lines read
+    """
+
+    def __init__(self, assets):
+        self.lines = [json.dumps(asset) + '\n' for asset in assets]
+        self.passes = 0
+        self.read = 0
+
+    def __iter__(self):
+        self.passes += 1
+        for line in self.lines:
+            self.read += 1
+            yield line
+
+class AssetExportBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lines = Lines([
+            # The policy export may come before the resource export
+            _project(1, 'proj-a', [('owner', ['user:jane.doe@x.com'])], data=False),
+            _instance('proj-a', 'eu-1', 'vm-1'),
+            _project(1, 'proj-a'),
+            _project(2, 'proj-b', [('viewer', ['user:jane.doe@x.com', 'group:ops@x.com'])]),
+            _firewall('proj-b', 'ssh', '22'),
+            _instance('proj-b', 'us-1', 'vm-2'),
+            _instance('proj-a', 'us-1', 'vm-3'),
+            _firewall('proj-a', 'web', '80'),
+        ])
+        self.backend = AssetExportBackend(self.lines)
+
+    def test_projects_and_zones(self):
+        self.assertEqual(self.backend.get_projects(), [['PROJ-A', 'proj-a'], ['PROJ-B', 'proj-b']])
+        self.assertEqual(self.backend.get_zones(None), ['eu-1', 'us-1'])
+
+        # One pass for both
+        self.assertEqual(self.lines.passes, 1)
+
+    def test_tables(self):
+        self.assertEqual(list(self.backend.iter_instances(['proj-a'], ['eu-1', 'us-1'])),
+                         [['vm-1', 'RUNNING', 'n1-standard-1', 'proj-a', 'eu-1'],
+                          ['vm-3', 'RUNNING', 'n1-standard-1', 'proj-a', 'us-1']])
+        self.assertEqual(list(self.backend.iter_instances(['proj-a', 'proj-b'], ['us-1'])),
+                         [['vm-2', 'RUNNING', 'n1-standard-1', 'proj-b', 'us-1'],
+                          ['vm-3', 'RUNNING', 'n1-standard-1', 'proj-a', 'us-1']])
+        self.assertEqual(list(self.backend.iter_firewalls(['proj-b'])),
+                         [['proj-b', 'ssh', '0.0.0.0/0', 'tcp', '22', 'compute#firewall']])
+
+        self.assertEqual(list(self.backend.iter_iam_members(['proj-a', 'proj-b'])),
+                         [['proj-a', 'jane doe', 'jane.doe@x.com', 'x.com', 'user', ['owner']],
+                          ['proj-b', 'jane doe', 'jane.doe@x.com', 'x.com', 'user', ['viewer']],
+                          ['proj-b', 'ops', 'ops@x.com', 'x.com', 'group', ['viewer']]])
+
+    def test_tables_are_streamed(self):
+        rows = self.backend.iter_instances(['proj-a'], ['eu-1'])
+        self.assertEqual(next(rows)[0], 'vm-1')
+
+        # Only the lines up to the first instance were read
+        self.assertEqual((self.lines.passes, self.lines.read), (1, 2))
+
+    def test_iterator_sources_are_read_once(self):
+        backend = AssetExportBackend(line for line in self.lines)
+        self.assertEqual(self.lines.passes, 1)
+
+        self.assertEqual(len(backend.get_projects()), 2)
+        self.assertEqual(len(list(backend.iter_instances(['proj-a', 'proj-b'], ['us-1']))), 2)
+        self.assertEqual(len(list(backend.iter_firewalls(['proj-a', 'proj-b']))), 2)
+        self.assertEqual(len(list(backend.iter_iam_members(['proj-a', 'proj-b']))), 3)
+
+    def test_projects_without_project_assets(self):
+        backend = AssetExportBackend(Lines([_firewall('proj-b', 'ssh', '22'),
+                                            _instance('proj-a', 'eu-1', 'vm-1')]))
+        self.assertEqual(backend.get_projects(), [['proj-a', 'proj-a'], ['proj-b', 'proj-b']])
+
+if __name__ == '__main__':
+    unittest.main()
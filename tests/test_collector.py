@@ -0,0 +1,136 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Runs per-project calls of a stub client through the Collector (security.collector)
+
+"""
+
+import threading
+import time
+import unittest
+
+from security.collector import Collector
+from security.profiling import Profiler
+
+# Seconds every stub request takes, like a GCP round trip
+LATENCY = 0.02
+
+PROJECTS = ['project-%03d' % i for i in range(64)]
+
+class StubHttp(object):
+    """
+    Stands in for an authorized httplib2.Http, counts the instances created
+    """
+
+    created = 0
+    _lock = threading.Lock()
+
+    def __init__(self):
+        with StubHttp._lock:
+            StubHttp.created += 1
+
+class StubRequest(object):
+    """
+    A discovery request that answers after LATENCY seconds
+    """
+
+    def __init__(self, project):
+        self.project = project
+
+    def execute(self, http=None):
+        time.sleep(LATENCY)
+        return {'project': self.project, 'http': id(http)}
+
+def get_instances(project, collector):
+    response = collector.execute(StubRequest(project))
+    return [[response['project'], 'vm-%d' % i] for i in range(3)]
+
+class CollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        StubHttp.created = 0
+
+    def test_results_in_project_order(self):
+        expected = [[project, 'vm-%d' % i] for project in PROJECTS for i in range(3)]
+
+        for workers in [1, 8, 32]:
+            collector = Collector(StubHttp, workers)
+            try:
+                self.assertEqual(collector.map_rows(get_instances, PROJECTS, collector), expected)
+                self.assertEqual([rows[0][0] for rows in
+                                  collector.map(get_instances, PROJECTS, collector)], PROJECTS)
+            finally:
+                collector.close()
+
+    def test_speedup(self):
+        seconds = {}
+        for workers in [1, 8, 32]:
+            collector = Collector(StubHttp, workers)
+            try:
+                start = time.time()
+                collector.map_rows(get_instances, PROJECTS, collector)
+                seconds[workers] = time.time() - start
+            finally:
+                collector.close()
+
+        print "\n%d projects, %.0fms per request: %s" % (
+            len(PROJECTS), LATENCY * 1000, ', '.join(
+                '%d workers %.2fs (%.1fx)' % (workers, seconds[workers],
+                                              seconds[1] / seconds[workers])
+                for workers in sorted(seconds)))
+
+        # Far from the ideal 8x and 32x, so a busy machine doesn't fail the test
+        self.assertGreater(seconds[1] / seconds[8], 4)
+        self.assertGreater(seconds[1] / seconds[32], 10)
+
+    def test_http_objects_are_kept_between_calls(self):
+        collector = Collector(StubHttp, 8)
+        try:
+            https = set()
+            for _ in range(3):
+                https.update(rows[0]['http'] for rows in collector.map(
+                    lambda project: [collector.execute(StubRequest(project))], PROJECTS))
+                list(collector.imap_rows(get_instances, PROJECTS, collector))
+        finally:
+            collector.close()
+
+        # One http object per worker thread, not one per call
+        self.assertLessEqual(StubHttp.created, 8)
+        self.assertEqual(len(https), StubHttp.created)
+
+    def test_close(self):
+        collector = Collector(StubHttp, 8)
+        collector.map(get_instances, PROJECTS, collector)
+        collector.close()
+        collector.close()
+
+        # A closed collector starts new workers when it is used again
+        self.assertEqual(len(collector.map(get_instances, PROJECTS, collector)), len(PROJECTS))
+        collector.close()
+
+    def test_failed_project_is_not_attributed_afterwards(self):
+        def fail(project):
+            collector.execute(StubRequest(project))
+            raise ValueError(project)
+
+        for workers in [1, 8]:
+            profiler = Profiler()
+            collector = Collector(StubHttp, workers, profiler=profiler)
+            try:
+                self.assertRaises(ValueError, collector.map, fail, ['project-a', 'project-b'])
+                self.assertRaises(ValueError, list, collector.imap_rows(fail, ['project-c']))
+
+                # A request outside of a project, e.g. a batch, on the calling thread
+                profiler.record_request(1.0)
+            finally:
+                collector.close()
+
+            # One request per project that ran (one worker stops at project-a)
+            self.assertIn('project-c', profiler.projects)
+            self.assertEqual([p['api_calls'] for p in profiler.projects.values()],
+                             [1] * len(profiler.projects))
+
+if __name__ == '__main__':
+    unittest.main()
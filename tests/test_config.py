@@ -0,0 +1,107 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Checks, compiles and caches configs (security.config)
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+import yaml
+
+from security.config import load_config, compile_config, compiled_path, ConfigError
+from security.exposure import exposure_highlight
+
+CONFIG = """
+general:
+  report-title: Report
+  watchdog-email: watchdog@example.com
+  receiver-email:
+    - email: jane.doe@example.com
+  ignore-projects:
+    project-ID:
+      - string: sandbox-
+compute:
+  print: True
+  alert-rules:
+    status:
+      - string: RUNNING
+firewall:
+  print: True
+  exposure-rules:
+    - max-prefix: 0
+      ports: %s
+"""
+
+FIREWALLS = pd.DataFrame([['p', 'ssh', '0.0.0.0/0', 'tcp', '22'],
+                          ['p', 'web', '0.0.0.0/0', 'tcp', '80, 443'],
+                          ['p', 'app', '0.0.0.0/0', 'tcp', '1500-1600'],
+                          ['p', 'internal', '10.0.0.0/8', 'tcp', '22']],
+                         columns=['Project_ID', 'Rule_name', 'Range', 'Protocol', 'Port'])
+
+def _raw(ports):
+    return yaml.safe_load(CONFIG % ports)
+
+class ConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'watchdog.yaml')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, text):
+        with open(self.path, 'w') as the_file:
+            the_file.write(text)
+
+    def test_string_ports_match_like_numbers(self):
+        for ports, expected in [('[22]', [True, False, False, False]),
+                                ("['22']", [True, False, False, False]),
+                                ("['1000-2000']", [False, False, True, False]),
+                                ("[22, '443']", [True, True, False, False])]:
+            rules = compile_config(_raw(ports))['rules'].firewall.exposure
+            self.assertEqual(exposure_highlight(FIREWALLS, rules).tolist(), expected, ports)
+
+    def test_invalid_ports(self):
+        for ports in ["['ssh']", '[70000]', "['20-10']", '[True]']:
+            self.assertRaises(ConfigError, compile_config, _raw(ports))
+
+    def test_unknown_key(self):
+        raw = _raw('[22]')
+        raw['compute']['alert-rules']['machine_type'] = 'n1-standard-1'
+        with self.assertRaises(ConfigError) as context:
+            compile_config(raw)
+        self.assertIn("did you mean 'machine-type'", str(context.exception))
+
+    def test_cached_config(self):
+        self.write(CONFIG % '[22]')
+        cfg = load_config(self.path)
+        self.assertTrue(os.path.exists(compiled_path(self.path)))
+
+        cached = load_config(self.path)
+        self.assertEqual(cached['rules'].compute.alert[0].regex.pattern, 'RUNNING')
+        self.assertEqual(cached['rules'].firewall.exposure, cfg['rules'].firewall.exposure)
+        self.assertEqual(cached['rules'].projects.ignore[0].column, 'Project_ID')
+
+    def test_compiled_file_is_only_read_for_its_content(self):
+        self.write(CONFIG % '[22]')
+        load_config(self.path)
+
+        # A compiled file of other content (or any other file) is ignored
+        with open(compiled_path(self.path), 'w') as the_file:
+            the_file.write("cos\nsystem\n(S'exit 1'\ntR.")
+        self.assertEqual(load_config(self.path)['general']['report-title'], 'Report')
+
+        self.write(CONFIG % '[3389]')
+        self.assertEqual(load_config(self.path)['rules'].firewall.exposure[0].ports,
+                         ((3389, 3389),))
+
+if __name__ == '__main__':
+    unittest.main()
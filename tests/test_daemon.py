@@ -0,0 +1,142 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Polls the sections and applies audit-log entries (watchdog.daemon)
+
+"""
+
+import sys
+import unittest
+from StringIO import StringIO
+
+import pandas as pd
+import yaml
+
+from security.config import compile_config
+from security.gcp_calls import firewall_rows
+from security.profiling import Profiler
+from watchdog import daemon as daemon_module
+from watchdog.daemon import Daemon
+
+CONFIG = """
+general:
+  report-title: Report
+  watchdog-email: watchdog@example.com
+  receiver-email:
+    - email: jane.doe@example.com
+firewall:
+  print: True
+  alert-rules:
+    port:
+      - string: '22'
+"""
+
+class StubBackend(object):
+    """
+    An organization with two projects of firewall rules, fails while broken is set
+    """
+
+    def __init__(self):
+        self.rules = {'proj-a': [('rule-1', '80'), ('rule-2', '443')],
+                      'proj-b': [('rule-3', '8080')]}
+        self.broken = False
+
+    def get_projects(self):
+        return [[project.upper(), project] for project in sorted(self.rules)]
+
+    def check_projects(self, projects):
+        return projects, pd.DataFrame({'Project_ID': [], 'Reason': []})
+
+    def get_zones(self, project_IDs):
+        return ['eu-1']
+
+    def iter_firewalls(self, project_IDs):
+        if self.broken:
+            raise IOError("backend unavailable")
+        for project in project_IDs:
+            for name, port in self.rules[project]:
+                for row in firewall_rows(project, {'name': name, 'sourceRanges': ['0.0.0.0/0'],
+                                                   'allowed': [{'IPProtocol': 'tcp',
+                                                                'ports': [port]}]}):
+                    yield row
+
+class StopLoop(Exception):
+    pass
+
+def _rules(section):
+    _, table, highlight = section
+    return zip(table['Rule_name'].tolist(), table['Port'].tolist(), list(highlight))
+
+class DaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = StubBackend()
+        self.sent = []
+        self.daemon = Daemon(compile_config(yaml.safe_load(CONFIG)), self.backend,
+                             lambda sections: [section[0] for section in sections],
+                             self.sent.append, Profiler(),
+                             intervals={'projects': 100, 'firewall': 10})
+        self.stdout, sys.stdout = sys.stdout, StringIO()
+        self.sleep = daemon_module.time.sleep
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        daemon_module.time.sleep = self.sleep
+
+    def test_poll(self):
+        self.assertFalse(self.daemon.poll(0))
+        self.assertEqual(self.daemon.html, ['Incaccessible Projects', 'Firewalls'])
+        self.assertEqual(_rules(self.daemon.sections['firewall']),
+                         [('rule-1', '80', False), ('rule-2', '443', False),
+                          ('rule-3', '8080', False)])
+
+        # Only the firewall section is due, its new alert changes the report
+        self.backend.rules['proj-b'] = [('rule-3', '22')]
+        self.assertTrue(self.daemon.poll(10))
+        self.assertEqual(self.daemon.next_poll, {'projects': 100, 'firewall': 20})
+
+    def test_failed_poll_keeps_the_last_sections(self):
+        self.daemon.poll(0)
+        section = self.daemon.sections['firewall']
+
+        self.backend.broken = True
+        self.backend.rules['proj-b'] = [('rule-3', '22')]
+        self.assertRaises(IOError, self.daemon.poll, 10)
+        self.assertIs(self.daemon.sections['firewall'], section)
+
+        # Retried on the next interval, not at once
+        self.assertEqual(self.daemon.poll(15), False)
+        self.backend.broken = False
+        self.assertTrue(self.daemon.poll(20))
+
+    def test_run_survives_failed_polls(self):
+        def sleep(seconds):
+            raise StopLoop()
+        daemon_module.time.sleep = sleep
+
+        self.backend.broken = True
+        self.assertRaises(StopLoop, self.daemon.run)
+        self.assertIn('poll failed, keeping the last report: backend unavailable',
+                      sys.stdout.getvalue())
+        self.assertEqual(self.daemon.sections, {})
+
+    def test_patched_rows_keep_their_place(self):
+        self.daemon.poll(0)
+
+        # The patch entry has only the changed fields, the rule is fetched again
+        self.backend.rules['proj-a'] = [('rule-1', '22'), ('rule-2', '443')]
+        self.assertTrue(self.daemon.apply([{'protoPayload': {
+            'methodName': 'v1.compute.firewalls.patch',
+            'resourceName': 'projects/proj-a/global/firewalls/rule-1',
+            'request': {'alloweds': [{'IPProtocol': 'tcp', 'ports': ['22']}]}}}]))
+
+        self.assertEqual(_rules(self.daemon.sections['firewall']),
+                         [('rule-1', '22', True), ('rule-2', '443', False),
+                          ('rule-3', '8080', False)])
+        self.assertEqual(self.daemon.tables['firewall']['Rule_name'].tolist(),
+                         ['rule-1', 'rule-2', 'rule-3'])
+
+if __name__ == '__main__':
+    unittest.main()
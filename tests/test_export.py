@@ -0,0 +1,50 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Writes the report tables as data files (watchdog.export)
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from watchdog.export import export_sections, table_path
+
+class ExportTest(unittest.TestCase):
+
+    def test_table_path(self):
+        for title, name in [('Instances', 'report_instances.csv'),
+                            ('IAM (changes)', 'report_iam_changes.csv'),
+                            ('Incaccessible Projects', 'report_incaccessible_projects.csv'),
+                            ('Run Statistics / 2', 'report_run_statistics_2.csv')]:
+            self.assertEqual(table_path('out/report.html', title, 'csv'),
+                             os.path.join('out', name))
+
+    def test_export_sections(self):
+        directory = tempfile.mkdtemp()
+        try:
+            table = pd.DataFrame([['p1', 'vm-1'], ['p2', 'vm-2']],
+                                 columns=['Project_ID', 'Instance'])
+            report_file = os.path.join(directory, 'report.html')
+            sections = [('Instances (changes)', table, [True, False])]
+
+            self.assertEqual(list(export_sections(sections, ['html', 'csv', 'jsonl'],
+                                                  report_file)), sections)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ['report_instances_changes.csv',
+                              'report_instances_changes.jsonl'])
+            with open(os.path.join(directory, 'report_instances_changes.csv')) as the_file:
+                self.assertEqual(the_file.read().splitlines(),
+                                 ['Project_ID,Instance,highlighted',
+                                  'p1,vm-1,True', 'p2,vm-2,False'])
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    unittest.main()
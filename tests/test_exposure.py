@@ -0,0 +1,89 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Parses source ranges and ports and answers exposure queries (security.exposure)
+
+"""
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from security.exposure import parse_cidr, parse_ports, FirewallIndex, _explode
+
+# Project_ID, Rule_name, Range, Protocol, Port
+RULES = [['p', 'both', '0.0.0.0/0, ::/0', 'tcp', '22'],
+         ['p', 'no-range', '', 'tcp', '22'],
+         ['p', 'ipv6', '2001:db8::/32', 'tcp', None],
+         ['p', 'ping', '10.0.0.0/8', 'icmp', None],
+         ['p', 'missing-range', None, 'udp', '53, 1000-2000'],
+         ['p', 'mixed', '2001:db8:1::/48, 192.168.0.0/16', 'all', None]]
+
+class ExposureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = FirewallIndex(pd.DataFrame(
+            RULES, columns=['Project_ID', 'Rule_name', 'Range', 'Protocol', 'Port']))
+
+    def test_parse_cidr(self):
+        self.assertEqual(parse_cidr(' 10.1.2.3/8'), (4, 10 << 24, (11 << 24) - 1, 8))
+        self.assertEqual(parse_cidr('10.1.2.3'), (4, 0x0a010203, 0x0a010203, 32))
+        self.assertEqual(parse_cidr('::/0'), (6, 0, 2 ** 64 - 1, 0))
+
+        # IPv6 addresses are kept as their upper 64 bits
+        self.assertEqual(parse_cidr('2001:db8::/32'),
+                         (6, 0x20010db800000000, 0x20010db8ffffffff, 32))
+        self.assertEqual(parse_cidr('2001:db8::1'), (6, 0x20010db800000000,
+                                                     0x20010db800000000, 128))
+
+    def test_parse_ports(self):
+        self.assertEqual(parse_ports('22, 8000-8080', 'tcp'), [(22, 22), (8000, 8080)])
+        for port in [None, '', 'None', float('nan')]:
+            self.assertEqual(parse_ports(port, 'UDP'), [(0, 65535)])
+        self.assertEqual(parse_ports(None, 'icmp'), [])
+        self.assertEqual(parse_ports('22', None), [])
+
+    def test_explode(self):
+        rows, ids = _explode(np.array([1, -1, 0, 2, 1]), [[7], [], [8, 9]])
+        self.assertEqual(rows.tolist(), [2, 3, 3])
+        self.assertEqual(ids.tolist(), [7, 8, 9])
+
+        rows, ids = _explode(np.array([-1, -1]), [])
+        self.assertEqual((rows.tolist(), ids.tolist()), ([], []))
+
+    def test_edge_cases(self):
+        # Empty and missing ranges open nothing, icmp rules open no ports
+        self.assertEqual(self.index.wide_ranges(32).tolist(),
+                         [True, False, True, True, False, True])
+        self.assertEqual(self.index.open_ports([(0, 65535)]).tolist(),
+                         [True, True, True, False, True, True])
+
+        self.assertEqual(self.index.exposed(0, [22]).tolist(),
+                         [True, False, False, False, False, False])
+        self.assertEqual(self.index.exposed(16).tolist(),
+                         [True, False, False, True, False, True])
+        self.assertEqual(self.index.wide_ranges(48, family=6).tolist(),
+                         [True, False, True, False, False, True])
+
+    def test_containing(self):
+        self.assertEqual(self.index.containing('2001:db8:1::5').tolist(),
+                         [True, False, True, False, False, True])
+        self.assertEqual(self.index.containing('2001:db9::1').tolist(),
+                         [True, False, False, False, False, False])
+        self.assertEqual(self.index.containing('10.2.3.4').tolist(),
+                         [True, False, False, True, False, False])
+        self.assertEqual(self.index.exposed(ports=[22], address='192.168.3.3').tolist(),
+                         [True, False, False, False, False, True])
+
+    def test_tables_without_ranges(self):
+        for rows in [RULES[1:2], []]:
+            index = FirewallIndex(pd.DataFrame(
+                rows, columns=['Project_ID', 'Rule_name', 'Range', 'Protocol', 'Port']))
+            self.assertEqual(index.exposed(32).tolist(), [False] * len(rows))
+            self.assertEqual(index.containing('10.0.0.1').tolist(), [False] * len(rows))
+
+if __name__ == '__main__':
+    unittest.main()
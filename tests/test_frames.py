@@ -0,0 +1,74 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Writes and reads DataFrames as Parquet or gzipped JSON (security.frames)
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from security import frames
+
+def _frame():
+    return pd.DataFrame({
+        'Project_ID': pd.Categorical(['proj-a', 'proj-b', None, 'proj-a']),
+        'Name': [u'caf\xe9', 'ops', None, 'jane doe'],
+        'Role': [['owner'], ['viewer', 'editor'], [], ['owner']],
+        'Row_hash': np.array([1, 2 ** 63 + 5, 3, 4], dtype=np.uint64),
+        'Run': pd.to_datetime(['2016-10-18', '2016-10-18 08:30:00.123456', None, '2016-10-19']),
+        'Rank': np.arange(4),
+        'Seconds': [1.5, np.nan, 2.0, 3.0],
+        'Highlighted': [True, False, True, True]},
+        columns=['Project_ID', 'Name', 'Role', 'Row_hash', 'Run', 'Rank', 'Seconds',
+                 'Highlighted'])
+
+class FramesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pyarrow = frames.pyarrow
+
+    def tearDown(self):
+        frames.pyarrow = self.pyarrow
+        shutil.rmtree(self.directory)
+
+    def check_round_trip(self, extension):
+        frame = _frame()
+        path = frames.write_frame(frame, os.path.join(self.directory, 'iam', 'table'))
+        self.assertEqual(path, os.path.join(self.directory, 'iam', 'table' + extension))
+        self.assertEqual(frames.frame_file(os.path.join(self.directory, 'iam', 'table')), path)
+
+        read = frames.read_frame(path)
+        pd.util.testing.assert_frame_equal(read, frame)
+        self.assertEqual([type(value) for value in read['Name']], [unicode, str, type(None), str])
+        self.assertEqual(type(read['Role'][0]), list)
+
+        empty = frames.read_frame(frames.write_frame(frame.iloc[:0], path[:-len(extension)]))
+        self.assertEqual(map(str, empty.dtypes), map(str, frame.dtypes))
+
+    def test_json(self):
+        frames.pyarrow = None
+        self.check_round_trip(frames.JSON)
+
+    @unittest.skipIf(frames.pyarrow is None, "needs pyarrow")
+    def test_parquet(self):
+        self.check_round_trip(frames.PARQUET)
+
+        # The JSON file of the same frame is replaced
+        frames.pyarrow = None
+        frames.write_frame(_frame(), os.path.join(self.directory, 'table'))
+        frames.pyarrow = self.pyarrow
+        frames.write_frame(_frame(), os.path.join(self.directory, 'table'))
+        self.assertEqual(frames.frame_files(os.path.join(self.directory, '*')),
+                         [os.path.join(self.directory, 'table.parquet')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Records table history and answers point-in-time queries (security.history)
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from security import history
+from security.history import HistoryStore, BUCKETS
+
+PROJECTS = ['project-%02d' % i for i in range(40)]
+START = pd.Timestamp('2016-09-24 08:00')
+
+def _table(run):
+    # Every project has two members, one of them changes its role every third run
+    rows = []
+    for i, project in enumerate(PROJECTS):
+        rows.append([project, 'jane.doe@x.com', 'user', ['owner']])
+        rows.append([project, 'ops-%d@x.com' % i, 'group',
+                     ['editor'] if (run + i) // 3 % 2 else ['viewer']])
+    return pd.DataFrame(rows, columns=['Project_ID', 'Email', 'Account_type', 'Role'])
+
+def _rows(table):
+    return sorted((row[0], row[1], row[2], tuple(row[3])) for row in
+                  table[['Project_ID', 'Email', 'Account_type', 'Role']].astype(object).values)
+
+class HistoryStoreTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.store = HistoryStore(cls.directory, retention_days=5, compact_after_days=3)
+
+        for run in range(14):
+            when = START + pd.Timedelta(days=run)
+            cls.store.record('IAM', _table(run), when)
+            cls.store.maintain(when)
+        cls.last = START + pd.Timedelta(days=13)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.read_frame = history.read_frame
+
+    def tearDown(self):
+        history.read_frame = self.read_frame
+
+    def test_at(self):
+        for run in [8, 11, 13]:
+            when = START + pd.Timedelta(days=run, hours=1)
+            self.assertEqual(_rows(self.store.at('IAM', when)), _rows(_table(run)))
+
+        # Compacted, expired and daily partitions
+        names = sorted(name for name in os.listdir(os.path.join(self.directory, 'iam'))
+                       if not name.startswith('state.'))
+        self.assertEqual(names, ['2016-10', '2016-10-04', '2016-10-05', '2016-10-06',
+                                 '2016-10-07', 'base', 'runs.txt'])
+
+    def test_columns(self):
+        self.assertEqual(self.store.columns('IAM'),
+                         ['Project_ID', 'Email', 'Account_type', 'Role'])
+        self.assertEqual(self.store.columns('Firewalls'), [])
+
+    def test_project_queries_read_their_buckets(self):
+        paths = []
+
+        def read_frame(path):
+            paths.append(path)
+            return self.read_frame(path)
+        history.read_frame = read_frame
+
+        self.store.at('IAM', self.last)
+        everything = len(paths)
+
+        del paths[:]
+        table = self.store.at('IAM', self.last, projects=['project-07'])
+        self.assertEqual(_rows(table), [row for row in _rows(_table(13))
+                                        if row[0] == 'project-07'])
+
+        # One bucket of every partition
+        self.assertEqual(set(os.path.basename(path).split('.')[0] for path in paths),
+                         set(['b%02d' % history._bucket('project-07')]))
+        self.assertLess(len(paths) * BUCKETS // 2, everything)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Applies audit-log patches to the tables and sections of the daemon (watchdog.patches)
+
+"""
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from security.audit_log import Patch
+from watchdog.patches import patch_table, patch_section
+
+PROJECT_IDS = ['proj-a', 'proj-b']
+COLUMNS = ['Project_ID', 'Rule_name', 'Range', 'Protocol', 'Port', 'Firewall_type']
+
+def _rule(project, name, port='22'):
+    return [project, name, '0.0.0.0/0', 'tcp', port, 'compute#firewall']
+
+def _firewalls(rows):
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+def _names(table):
+    return [tuple(row) for row in table[['Project_ID', 'Rule_name', 'Port']].values]
+
+def _rule_patch(project, name, **kwargs):
+    return Patch('firewall', project, {'Project_ID': project, 'Rule_name': name}, **kwargs)
+
+class PatchTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = _firewalls([_rule('proj-a', 'rule-1'), _rule('proj-a', 'rule-2'),
+                                 _rule('proj-b', 'rule-3')])
+        self.crawl = _firewalls([_rule('proj-a', 'rule-1', '443'), _rule('proj-a', 'rule-2'),
+                                 _rule('proj-b', 'rule-3')])
+
+    def fetch(self, patch):
+        return self.crawl.loc[self.crawl['Project_ID'] == patch.project]
+
+    def test_refetched_rows_keep_their_place(self):
+        patched, added = patch_table(self.table, [_rule_patch('proj-a', 'rule-1', refetch=True)],
+                                     self.fetch, 'firewall', PROJECT_IDS)
+        self.assertEqual(_names(patched), _names(self.crawl))
+        self.assertEqual(_names(added), [('proj-a', 'rule-1', '443')])
+
+    def test_new_rows_go_to_the_end_of_their_project(self):
+        patches = [_rule_patch('proj-a', 'rule-4', rows=[_rule('proj-a', 'rule-4')]),
+                   _rule_patch('proj-b', 'rule-3', rows=[]),
+                   _rule_patch('proj-a', 'rule-2', rows=[_rule('proj-a', 'rule-2', '80')]),
+                   _rule_patch('proj-a', 'rule-4', rows=[_rule('proj-a', 'rule-4', '8080')])]
+        patched, _ = patch_table(self.table, patches, self.fetch, 'firewall', PROJECT_IDS)
+        self.assertEqual(_names(patched), [('proj-a', 'rule-1', '22'), ('proj-a', 'rule-2', '80'),
+                                           ('proj-a', 'rule-4', '8080')])
+
+    def test_values(self):
+        instances = pd.DataFrame([['vm-1', 'RUNNING', 'n1-standard-1', 'proj-a', 'eu-1'],
+                                  ['vm-2', 'RUNNING', 'n1-standard-1', 'proj-a', 'eu-1']],
+                                 columns=['Instance', 'Status', 'Machine_type', 'Project_ID',
+                                          'Zone'])
+        instances['Status'] = instances['Status'].astype('category')
+        match = {'Project_ID': 'proj-a', 'Zone': 'eu-1', 'Instance': 'vm-1'}
+        patches = [Patch('compute', 'proj-a', match, values={'Status': 'TERMINATED'}),
+                   Patch('compute', 'proj-a', match, values={'Machine_type': 'n1-highcpu-2'})]
+
+        patched, added = patch_table(instances, patches, None, 'compute', PROJECT_IDS)
+        self.assertEqual(patched.values.tolist(),
+                         [['vm-1', 'TERMINATED', 'n1-highcpu-2', 'proj-a', 'eu-1'],
+                          ['vm-2', 'RUNNING', 'n1-standard-1', 'proj-a', 'eu-1']])
+        self.assertEqual(len(added), 1)
+        self.assertTrue(hasattr(patched['Status'], 'cat'))
+
+    def test_iam_rows_are_sorted(self):
+        columns = ['Project_ID', 'Name', 'Email', 'Email_suffix', 'Account_type', 'Role']
+        iam = pd.DataFrame([['proj-a', 'jane', 'jane@x.com', 'x.com', 'user', ['owner']],
+                            ['proj-b', 'ops', 'ops@x.com', 'x.com', 'group', ['viewer']]],
+                           columns=columns)
+        patch = Patch('IAM', 'proj-a', {'Project_ID': 'proj-a'}, rows=[
+            ['proj-a', 'zoe', 'zoe@x.com', 'x.com', 'user', ['viewer']],
+            ['proj-a', 'adam', 'adam@x.com', 'x.com', 'user', ['owner']]])
+
+        patched, _ = patch_table(iam, [patch], None, 'IAM', PROJECT_IDS)
+        self.assertEqual(patched['Email'].tolist(), ['adam@x.com', 'zoe@x.com', 'ops@x.com'])
+
+class PatchSectionTest(unittest.TestCase):
+
+    def test_new_rows_keep_their_place(self):
+        table = _firewalls([_rule('proj-a', 'rule-1'), _rule('proj-a', 'rule-2'),
+                            _rule('proj-b', 'rule-3')]).drop('Firewall_type', axis=1)
+        table.index += 1
+        section = ('Firewalls', table, np.array([True, False, True]))
+
+        new_table = _firewalls([_rule('proj-a', 'rule-1', '443')]).drop('Firewall_type', axis=1)
+        new_table.index += 1
+        title, patched, highlight = patch_section(
+            section, [_rule_patch('proj-a', 'rule-1', refetch=True)],
+            ('Firewalls', new_table, np.array([False])), 'firewall', PROJECT_IDS)
+
+        self.assertEqual(title, 'Firewalls')
+        self.assertEqual(_names(patched), [('proj-a', 'rule-1', '443'), ('proj-a', 'rule-2', '22'),
+                                           ('proj-b', 'rule-3', '22')])
+        self.assertEqual(list(patched.index), [1, 2, 3])
+        self.assertEqual(highlight.tolist(), [False, False, True])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Resets and merges run statistics (security.profiling)
+
+"""
+
+import unittest
+
+from security.profiling import Profiler
+
+def _run(profiler, stage, project, rows, requests):
+    profiler.set_project(project)
+    with profiler.stage(stage) as result:
+        for _ in range(requests):
+            profiler.record_request(0.5)
+        result['rows'] = rows
+    profiler.set_project(None)
+
+def _counts(stats):
+    return dict((stage['stage'], (stage['api_calls'], stage['rows'])) for stage in stats['stages'])
+
+class ProfilerTest(unittest.TestCase):
+
+    def test_reset(self):
+        profiler = Profiler()
+        _run(profiler, 'instances', 'p1', 10, 3)
+        profiler.reset()
+        _run(profiler, 'iam', 'p2', 5, 1)
+
+        self.assertEqual(_counts(profiler.to_dict()), {'iam': (1, 5)})
+        self.assertEqual([p['project'] for p in profiler.slowest_projects()], ['p2'])
+
+    def test_worker_statistics_are_merged_back(self):
+        parent = Profiler()
+        _run(parent, 'instances', 'p1', 10, 3)
+
+        # A worker process starts with a copy of the parent's statistics
+        workers = []
+        for rows in [4, 6]:
+            worker = Profiler()
+            worker.merge(parent.to_dict())
+            before = worker.to_dict()
+            _run(worker, 'alerts', None, rows, 0)
+            _run(worker, 'instances', 'p1', 1, 2)
+            workers.append(worker.since(before))
+
+        self.assertEqual(_counts(workers[0]), {'alerts': (0, 4), 'instances': (2, 1)})
+
+        for stats in workers:
+            parent.merge(stats)
+        self.assertEqual(_counts(parent.to_dict()), {'instances': (7, 12), 'alerts': (0, 10)})
+        self.assertEqual(parent.projects['p1']['api_calls'], 7)
+        self.assertEqual(parent.projects['p1']['seconds'], 3.5)
+
+if __name__ == '__main__':
+    unittest.main()
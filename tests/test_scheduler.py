@@ -0,0 +1,156 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Executes discovery requests on a fake transport through the Scheduler (security.scheduler)
+
+The transport answers with scripted statuses or raises connection errors,
+the clock of the scheduler only advances when it sleeps.
+
+"""
+
+import json
+import socket
+import unittest
+
+import httplib2
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+from googleapiclient.model import JsonModel
+
+from security import scheduler as scheduler_module
+from security.scheduler import Scheduler
+
+URI = 'https://www.googleapis.com/compute/v1/projects/my-project/zones'
+
+def _error(status, reason):
+    return json.dumps({'error': {'code': status, 'message': reason,
+                                 'errors': [{'reason': reason, 'message': reason}]}})
+
+class FakeTransport(object):
+    """
+    An http object that answers with the scripted (status, content) or raises the scripted error
+    """
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.requests = 0
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        self.requests += 1
+        answer = self.script.pop(0) if self.script else (200, '{"items": []}')
+        if isinstance(answer, Exception):
+            raise answer
+
+        status, content = answer
+        return httplib2.Response({'status': str(status)}), content
+
+class FakeClock(object):
+    """
+    Replaces the time module of the scheduler, sleeping only advances the clock
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class NoJitter(object):
+    """
+    Replaces the random module of the scheduler, the backoff gets its full length
+    """
+
+    @staticmethod
+    def random():
+        return 1.0
+
+QUOTA = (429, _error(429, 'rateLimitExceeded'))
+RATE_LIMIT = (403, _error(403, 'rateLimitExceeded'))
+FORBIDDEN = (403, _error(403, 'forbidden'))
+UNAVAILABLE = (503, _error(503, 'backendError'))
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        scheduler_module.time, self.time = self.clock, scheduler_module.time
+        scheduler_module.random, self.random = NoJitter, scheduler_module.random
+
+    def tearDown(self):
+        scheduler_module.time = self.time
+        scheduler_module.random = self.random
+
+    def execute(self, scheduler, transport):
+        request = HttpRequest(transport, JsonModel(False).response, URI)
+        return scheduler.execute(request, transport)
+
+    def test_quota_errors_back_off_exponentially(self):
+        scheduler = Scheduler(retries=5, backoff=1.0)
+        transport = FakeTransport([QUOTA, QUOTA, RATE_LIMIT])
+
+        self.assertEqual(self.execute(scheduler, transport), {'items': []})
+        self.assertEqual(transport.requests, 4)
+        self.assertEqual(self.clock.sleeps, [1.0, 2.0, 4.0])
+
+        stats = scheduler.stats()['compute']
+        self.assertEqual((stats['requests'], stats['retries'], stats['quota_errors']), (4, 3, 3))
+        self.assertEqual(stats['throttled_seconds'], 7.0)
+
+    def test_gives_up_after_retries(self):
+        scheduler = Scheduler(retries=2, backoff=0.5)
+        transport = FakeTransport([QUOTA] * 10)
+
+        self.assertRaises(HttpError, self.execute, scheduler, transport)
+        self.assertEqual(transport.requests, 3)
+        self.assertEqual(self.clock.sleeps, [0.5, 1.0])
+
+    def test_permission_errors_are_not_retried(self):
+        scheduler = Scheduler()
+        transport = FakeTransport([FORBIDDEN])
+
+        self.assertRaises(HttpError, self.execute, scheduler, transport)
+        self.assertEqual(transport.requests, 1)
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_server_and_connection_errors_are_retried(self):
+        scheduler = Scheduler(backoff=1.0)
+        transport = FakeTransport([UNAVAILABLE, socket.timeout('timed out'),
+                                   socket.error(104, 'Connection reset by peer'),
+                                   httplib2.ServerNotFoundError('Unable to find the server')])
+
+        self.assertEqual(self.execute(scheduler, transport), {'items': []})
+        self.assertEqual(transport.requests, 5)
+        self.assertEqual(self.clock.sleeps, [1.0, 2.0, 4.0, 8.0])
+        self.assertEqual(scheduler.stats()['compute']['transport_errors'], 3)
+
+    def test_quota_errors_halve_the_concurrency(self):
+        scheduler = Scheduler(max_concurrency=8, backoff=0)
+        self.execute(scheduler, FakeTransport([QUOTA, QUOTA]))
+
+        # 8 / 2 / 2, then + 1/2 for the successful request
+        self.assertEqual(scheduler._api('compute').limit, 2.5)
+
+        # Grows back by one per window of successful requests
+        for _ in range(40):
+            self.execute(scheduler, FakeTransport([]))
+        self.assertEqual(scheduler._api('compute').limit, 8.0)
+
+    def test_rate_limit(self):
+        scheduler = Scheduler(rates={'compute': 5})
+        start = self.clock.now
+        for _ in range(10):
+            self.execute(scheduler, FakeTransport([]))
+
+        # A burst of 5 requests, then one every 1/5 s
+        self.assertAlmostEqual(self.clock.now - start, 1.0)
+        self.assertEqual(len(self.clock.sleeps), 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Sends reports to a fake SendGrid server on localhost
+
+    python -m unittest discover -s tests
+
+"""
+
+import json
+import threading
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from python_http_client.exceptions import HTTPError
+
+from watchdog import send_email
+from watchdog.send_email import build_mail, send_report
+
+class FakeSendGrid(HTTPServer):
+    """
+    Records the posted mails and answers with the given status codes (then 202)
+    """
+
+    def __init__(self, statuses=()):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+        self.statuses = list(statuses)
+        self.mails = []
+        self.replies = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        mail = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        status = self.server.statuses.pop(0) if self.server.statuses else 202
+        self.server.mails.append(mail)
+        self.server.replies.append(status)
+
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class SendReportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.html = u'<html><body><p>Report</p></body></html>'
+        self.receivers = ['user%d@example.com' % i for i in range(2500)]
+
+        # Only the requests are tested, not the css inliner
+        self.inline_css = send_email.inline_css
+        send_email.inline_css = lambda html: html
+
+    def tearDown(self):
+        send_email.inline_css = self.inline_css
+
+    def send(self, server, receivers):
+        send_report(self.html, 'watchdog@example.com', receivers, 'Report', 'key',
+                    host=server.url, retries=2, backoff=0)
+
+    def test_batches_of_1000_receivers(self):
+        server = FakeSendGrid()
+        try:
+            self.send(server, self.receivers)
+        finally:
+            server.stop()
+
+        self.assertEqual([len(mail['personalizations']) for mail in server.mails],
+                         [1000, 1000, 500])
+        receivers = [p['to'][0]['email'] for mail in server.mails
+                     for p in mail['personalizations']]
+        self.assertEqual(receivers, self.receivers)
+
+    def test_retries_rate_limits_and_server_errors(self):
+        server = FakeSendGrid([429, 503])
+        try:
+            self.send(server, self.receivers[:1500])
+        finally:
+            server.stop()
+
+        # The first batch is posted three times, then the second one once
+        self.assertEqual(server.replies, [429, 503, 202, 202])
+        self.assertEqual([len(mail['personalizations']) for mail in server.mails],
+                         [1000, 1000, 1000, 500])
+
+    def test_gives_up_after_retries(self):
+        server = FakeSendGrid([500, 500, 500])
+        try:
+            self.assertRaises(HTTPError, self.send, server, self.receivers[:10])
+        finally:
+            server.stop()
+
+        self.assertEqual(server.replies, [500, 500, 500])
+
+    def test_no_retry_on_client_errors(self):
+        server = FakeSendGrid([400])
+        try:
+            self.assertRaises(HTTPError, self.send, server, self.receivers[:10])
+        finally:
+            server.stop()
+
+        self.assertEqual(server.replies, [400])
+
+class BuildMailTest(unittest.TestCase):
+
+    def test_size_limit_counts_utf8_bytes(self):
+        # 1000 characters, 3000 bytes in UTF-8
+        html = u'\u20ac' * 1000
+
+        mail = build_mail(html, 'from@example.com', ['to@example.com'], 'Report', 2000)
+        self.assertIn('attachments', mail)
+
+        mail = build_mail(html, 'from@example.com', ['to@example.com'], 'Report', 3000)
+        self.assertNotIn('attachments', mail)
+        self.assertEqual(mail['content'][0]['value'], html)
+
+if __name__ == '__main__':
+    unittest.main()
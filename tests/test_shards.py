@@ -0,0 +1,75 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Writes and merges the shards of a crawl (watchdog.shards)
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from security.profiling import Profiler
+from watchdog.shards import shard_of, write_shard, read_shards, read_profiles
+
+PROJECTS = ['proj-%d' % i for i in range(8)]
+
+def _collection(shard):
+    projects = pd.DataFrame([[project.upper(), project] for project in PROJECTS],
+                            columns=['Name', 'Project_ID'])
+    projects = projects[[shard_of(project, shard[1]) == shard[0] for project in PROJECTS]]
+    firewalls = pd.DataFrame([[project, rule, '0.0.0.0/0', 'tcp', '22', 'compute#firewall']
+                              for project in projects['Project_ID'] for rule in ['b', 'a']],
+                             columns=['Project_ID', 'Rule_name', 'Range', 'Protocol', 'Port',
+                                      'Firewall_type'])
+    return {'projects': projects,
+            'inaccessible': pd.DataFrame({'Project_ID': [], 'Reason': []}),
+            'zones': ['eu-1'],
+            'tables': {'firewall': firewalls}}
+
+def _profile(rows):
+    profiler = Profiler()
+    with profiler.stage('firewalls') as stage:
+        stage['rows'] = rows
+    return profiler.to_dict()
+
+class ShardsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_merge(self):
+        for index in range(3):
+            collection = _collection((index, 3))
+            write_shard(self.directory, (index, 3), collection,
+                        _profile(len(collection['tables']['firewall'])))
+
+        # The rules of every project in the order of the projects, as in one crawl
+        merged = read_shards(self.directory)
+        self.assertEqual(merged['projects']['Project_ID'].tolist(), PROJECTS)
+        self.assertEqual(merged['tables']['firewall'][['Project_ID', 'Rule_name']].values.tolist(),
+                         [[project, rule] for project in PROJECTS for rule in ['b', 'a']])
+
+        profiler = Profiler()
+        for stats in read_profiles(self.directory):
+            profiler.merge(stats)
+        self.assertEqual([(stage['stage'], stage['rows']) for stage in profiler.stages],
+                         [('firewalls', 2 * len(PROJECTS))])
+
+    def test_shards_without_profile(self):
+        write_shard(self.directory, (0, 1), _collection((0, 1)))
+        self.assertEqual(read_profiles(self.directory), [])
+        self.assertEqual(sorted(name.split('.')[0] for name in os.listdir(
+            os.path.join(self.directory, 'shard-0000-of-0001'))),
+            ['inaccessible', 'meta', 'projects', 'table-firewall'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Keeps the tables of the previous run and diffs them (security.snapshot)
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from security.snapshot import SnapshotStore, diff_sections
+
+COLUMNS = ['Project_ID', 'Name', 'Email', 'Email_suffix', 'Account_type', 'Role']
+
+def _iam(rows):
+    table = pd.DataFrame(rows, columns=COLUMNS)
+    table.index += 1
+    return table
+
+OLD = _iam([['p1', 'jane doe', 'jane.doe@x.com', 'x.com', 'user', ['owner']],
+            ['p1', 'ops', 'ops@x.com', 'x.com', 'group', ['viewer']],
+            ['p2', 'jane doe', 'jane.doe@x.com', 'x.com', 'user', ['viewer']]])
+NEW = _iam([['p1', 'jane doe', 'jane.doe@x.com', 'x.com', 'user', ['owner', 'editor']],
+            ['p2', 'jane doe', 'jane.doe@x.com', 'x.com', 'user', ['viewer']],
+            ['p3', 'bob', 'bob@y.com', 'y.com', 'user', ['owner']]])
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = SnapshotStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_snapshots_are_data_files(self):
+        list(diff_sections([('IAM', OLD, [True, False, False])], self.store))
+
+        self.assertEqual([name for name in os.listdir(self.directory)
+                          if not name.startswith('iam.')], [])
+        loaded = self.store.load('IAM')
+        self.assertEqual(loaded['Role'].tolist(), [['owner'], ['viewer'], ['viewer']])
+        self.assertEqual(loaded['highlighted'].tolist(), [True, False, False])
+        self.assertEqual(self.store.load('Firewalls'), None)
+
+    def test_diff(self):
+        list(diff_sections([('IAM', OLD, [True, False, False])], self.store))
+        (title, changes, highlight), = diff_sections([('IAM', NEW, [True, False, True])],
+                                                     self.store)
+
+        self.assertEqual(changes[['Change', 'Project_ID', 'Email']].values.tolist(),
+                         [['added', 'p3', 'bob@y.com'],
+                          ['changed', 'p1', 'jane.doe@x.com'],
+                          ['removed', 'p1', 'ops@x.com']])
+        self.assertEqual(list(highlight), [True, True, False])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Checks that the command line starts without its heavy dependencies (watchdog.watchdog)
+
+Every command runs in a fresh interpreter, which prints the modules loaded
+once the command has exited.
+
+"""
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only loaded once a command needs them
+HEAVY_MODULES = ['pandas', 'numpy', 'googleapiclient', 'oauth2client', 'jinja2']
+
+SCRIPT = """
+import json, sys
+sys.argv = ['gcp-watchdog'] + sys.argv[1:]
+try:
+    from watchdog.watchdog import main
+    main()
+except SystemExit:
+    pass
+sys.stderr.write(json.dumps(sorted(sys.modules)))
+"""
+
+def _modules(*args):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + filter(None, [env.get('PYTHONPATH')]))
+    process = subprocess.Popen([sys.executable, '-c', SCRIPT] + list(args), cwd=ROOT, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, modules = process.communicate()
+    return output, set(json.loads(modules.splitlines()[-1]))
+
+class StartupTest(unittest.TestCase):
+
+    def test_help(self):
+        for args in [['--help'], ['history', '--help'], ['history', 'at', '--help']]:
+            output, modules = _modules(*args)
+            self.assertIn('usage: ', output)
+            self.assertEqual([module for module in HEAVY_MODULES if module in modules], [],
+                             ' '.join(args))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,252 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Keeps the watchdog running: polls every report section on its own interval
+
+Credentials, discovery clients and the inventory cache are created once and
+stay warm. The latest report is kept in memory and served over HTTP, an email
+is only sent when a highlighted (alert) row appears or disappears.
+
+With a subscriber of audit-log entries (see security.audit_log) the changes
+are patched into the tables within seconds of being logged, the polls then
+only reconcile what the entries missed.
+
+"""
+
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from security.snapshot import alert_keys
+from security.audit_log import parse_entries
+
+from sections import SECTIONS, load_projects, load_zones
+from patches import patch_table, patch_section
+
+# Seconds between two pulls of the audit-log subscriber
+DEFAULT_PULL_INTERVAL = 2
+
+# Seconds between two polls of a section if the config has no interval
+DEFAULT_INTERVAL = 900
+
+# Cached response kinds (see security.gcp_calls) that are fetched again when a section is polled
+CACHE_KINDS = {'projects': ['projects', 'zones', 'iam'],
+               'compute': [],
+               'IAM': ['iam'],
+               'firewall': ['firewalls']}
+
+class ReportServer(object):
+    """
+    Serves the latest report from memory on http://host:port/
+    """
+
+    def __init__(self, host='localhost', port=8080):
+        self.html = u'<html><body>No report yet</body></html>'
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = server.html.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class Daemon(object):
+    """
+    Polls the report sections and keeps the latest report
+
+    render(sections) returns the HTML of a list of (title, table, highlight),
+    notify(html) sends it. intervals maps 'projects' (projects and zones) and
+    the config sections ('compute', 'IAM', 'firewall') to seconds. subscriber
+    delivers audit-log entries, pulled every pull_interval seconds.
+    """
+
+    def __init__(self, cfg, backend, render, notify, profiler, cache=None, intervals=None,
+                 server=None, subscriber=None, pull_interval=DEFAULT_PULL_INTERVAL):
+        self.cfg = cfg
+        self.backend = backend
+        self.render = render
+        self.notify = notify
+        self.profiler = profiler
+        self.cache = cache
+        self.server = server
+        self.subscriber = subscriber
+        self.pull_interval = pull_interval
+
+        intervals = intervals or {}
+        self.kinds = ['projects'] + [kind for kind, _, _ in SECTIONS if cfg[kind]['print']]
+        self.intervals = dict((kind, intervals.get(kind, DEFAULT_INTERVAL)) for kind in self.kinds)
+        self.next_poll = dict((kind, 0) for kind in self.kinds)
+
+        self.project_IDs = None
+        self.zones = None
+        self.tables = {}
+        self.sections = {}
+        self.alerts = {}
+        self.html = None
+
+    def poll(self, now=None):
+        """
+        Rebuild the sections that are due. Returns True if the alerts changed.
+
+        If a fetch fails, no section changes and the due sections are polled
+        again on their next interval.
+        """
+
+        now = time.time() if now is None else now
+        due = [kind for kind in self.kinds if self.next_poll[kind] <= now]
+
+        for kind in due:
+            self.next_poll[kind] = now + self.intervals[kind]
+
+        # The run statistics of the report are those since the last poll
+        if due:
+            self.profiler.reset()
+
+        for kind in due:
+            if self.cache is not None:
+                for cache_kind in CACHE_KINDS[kind]:
+                    self.cache.invalidate(cache_kind)
+
+        project_IDs, zones = self.project_IDs, self.zones
+        tables, sections = {}, {}
+        if 'projects' in due:
+            project_IDs, sections['projects'] = load_projects(self.cfg, self.backend,
+                                                              self.profiler)
+            zones = load_zones(self.cfg, self.backend, project_IDs, self.profiler)
+
+        # The tables are kept for the audit-log patches
+        for kind, fetch, evaluate in SECTIONS:
+            if kind in due:
+                tables[kind] = fetch(self.backend, project_IDs, zones, self.profiler)
+                with self.profiler.stage('alerts'):
+                    sections[kind] = evaluate(self.cfg, tables[kind])
+
+        self.project_IDs, self.zones = project_IDs, zones
+        self.tables.update(tables)
+        self.sections.update(sections)
+        return self._update(due)
+
+    def _update(self, kinds):
+        """
+        Compare the alerts of changed sections and render the report. Returns True
+        if the alerts changed.
+        """
+
+        changed = False
+        for kind in kinds:
+            _, table, highlight = self.sections[kind]
+            keys = alert_keys(table, highlight)
+            # The first poll of a section sets the baseline
+            if kind in self.alerts and keys != self.alerts[kind]:
+                changed = True
+            self.alerts[kind] = keys
+
+        if kinds:
+            self.html = self.render([self.sections[kind] for kind in self.kinds])
+            if self.server is not None:
+                self.server.html = self.html
+
+        return changed
+
+    def _in_scope(self, patch):
+        """
+        Return True if a patch changes rows of a reported project, zone and section
+        """
+
+        if patch.kind not in self.tables or patch.project not in self.project_IDs:
+            return False
+        return 'Zone' not in patch.match or patch.match['Zone'] in self.zones
+
+    def _fetch(self, patch):
+        """
+        Return the current table rows of the project of a patch
+        """
+
+        if self.cache is not None:
+            for cache_kind in CACHE_KINDS[patch.kind]:
+                self.cache.invalidate(cache_kind, patch.project)
+
+        for kind, fetch, _ in SECTIONS:
+            if kind == patch.kind:
+                return fetch(self.backend, [patch.project], self.zones, self.profiler)
+
+    def apply(self, entries):
+        """
+        Patch the tables with audit-log entries and evaluate the changed rows.
+        Returns True if the alerts changed.
+        """
+
+        patches = [patch for patch in parse_entries(entries) if self._in_scope(patch)]
+
+        # New policies replace the cached ones, so the next poll doesn't fetch them
+        if self.cache is not None:
+            for patch in patches:
+                if patch.policy is not None:
+                    self.cache.set('iam', patch.project, patch.policy, patch.policy.get('etag'))
+
+        kinds = [kind for kind in self.kinds[1:]
+                 if any(patch.kind == kind for patch in patches)]
+        for kind in kinds:
+            kind_patches = [patch for patch in patches if patch.kind == kind]
+            with self.profiler.stage('patches') as stage:
+                self.tables[kind], rows = patch_table(self.tables[kind], kind_patches,
+                                                      self._fetch, kind, self.project_IDs)
+                stage['rows'] = len(rows)
+
+            with self.profiler.stage('alerts'):
+                evaluate = [evaluate for section_kind, _, evaluate in SECTIONS
+                            if section_kind == kind][0]
+                self.sections[kind] = patch_section(self.sections[kind], kind_patches,
+                                                    evaluate(self.cfg, rows), kind,
+                                                    self.project_IDs)
+
+        return self._update(kinds)
+
+    def run(self):
+        """
+        Poll until interrupted, sending the report whenever the alerts change
+
+        A failed poll or pull is logged and keeps the last good sections, the
+        sections are polled again on their next interval.
+        """
+
+        while True:
+            changed = False
+            try:
+                changed = self.poll()
+            except Exception as error:
+                print "%s poll failed, keeping the last report: %s" % (str(time.ctime()), error)
+
+            if self.subscriber is not None:
+                try:
+                    changed = self.apply(self.subscriber.pull()) or changed
+                except Exception as error:
+                    print "%s audit-log patches failed: %s" % (str(time.ctime()), error)
+
+            if changed:
+                print "%s alerts changed, sending report" % str(time.ctime())
+                self.notify(self.html)
+
+            wake_up = min(self.next_poll.values())
+            if self.subscriber is not None:
+                wake_up = min(wake_up, time.time() + self.pull_interval)
+            time.sleep(max(0, wake_up - time.time()))
@@ -0,0 +1,106 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Writes the report tables as machine-readable files (CSV, JSONL, Parquet)
+
+Every table gets a 'highlighted' column with the result of the alert-rules.
+The tables are written in chunks of rows; Parquet needs pyarrow.
+
+"""
+
+import os
+import re
+
+FORMATS = ['html', 'csv', 'jsonl', 'parquet']
+DATA_FORMATS = ['csv', 'jsonl', 'parquet']
+
+def table_path(report_file, title, fmt):
+    """
+    Return the file name of a table, e.g. report_instances.csv for report.html
+
+    The title is reduced to lowercase letters, digits and underscores, e.g.
+    'IAM (changes)' becomes iam_changes.
+    """
+
+    base = os.path.splitext(report_file)[0]
+    return '%s_%s.%s' % (base, re.sub(r'[^a-z0-9]+', '_', title.lower()).strip('_'), fmt)
+
+def _with_highlight(table, highlight):
+    """
+    Return the table without its index and with the 'highlighted' column
+    """
+
+    table = table.reset_index(drop=True)
+    if highlight is None:
+        table['highlighted'] = False
+    else:
+        table['highlighted'] = list(highlight)
+
+    return table
+
+def _chunks(table, chunksize):
+    for start in range(0, len(table), chunksize):
+        yield table.iloc[start:start + chunksize]
+
+def _write_csv(table, path, chunksize):
+    # Lists (the IAM roles) are written comma separated
+    table = table.copy()
+    for column in table.columns:
+        if table[column].dtype == object and \
+                table[column].map(lambda value: isinstance(value, list)).any():
+            table[column] = table[column].map(
+                lambda value: ', '.join(value) if isinstance(value, list) else value)
+
+    with open(path, 'w') as the_file:
+        table.iloc[:0].to_csv(the_file, index=False, encoding='utf-8')
+        for chunk in _chunks(table, chunksize):
+            chunk.to_csv(the_file, index=False, header=False, encoding='utf-8')
+
+def _write_jsonl(table, path, chunksize):
+    with open(path, 'w') as the_file:
+        for chunk in _chunks(table, chunksize):
+            lines = chunk.to_json(orient='records', lines=True)
+            the_file.write(lines if lines.endswith('\n') else lines + '\n')
+
+def _write_parquet(table, path, chunksize):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet output needs pyarrow (pip install pyarrow)")
+
+    schema = pyarrow.Schema.from_pandas(table, preserve_index=False)
+    writer = pyarrow.parquet.ParquetWriter(path, schema)
+    try:
+        # One row group per chunk
+        for chunk in _chunks(table, chunksize):
+            writer.write_table(pyarrow.Table.from_pandas(chunk, schema=schema,
+                                                         preserve_index=False))
+    finally:
+        writer.close()
+
+WRITERS = {'csv': _write_csv, 'jsonl': _write_jsonl, 'parquet': _write_parquet}
+
+def write_table(table, highlight, path, fmt, chunksize=50000):
+    """
+    Write a table and its highlight mask in one of the DATA_FORMATS
+    """
+
+    WRITERS[fmt](_with_highlight(table, highlight), path, chunksize)
+
+def export_sections(sections, formats, report_file):
+    """
+    Write every (title, table, highlight) section in the given data formats
+
+    The sections are passed on unchanged, so the HTML report can be rendered
+    from the same stream.
+    """
+
+    for title, table, highlight in sections:
+        for fmt in formats:
+            if fmt in DATA_FORMATS:
+                write_table(table, highlight, table_path(report_file, title, fmt), fmt)
+
+        yield title, table, highlight
@@ -0,0 +1,134 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Command line queries of the table history (gcp-watchdog history ...)
+
+    gcp-watchdog history runs iam
+    gcp-watchdog history at "2016-10-18 08:00" iam --match Email=jane.doe --match Role=owner
+    gcp-watchdog history intervals instances --match Instance=vm-1 --match Status=RUNNING
+    gcp-watchdog history compact
+
+"""
+
+import argparse
+import os
+import sys
+
+from security.config import load_config, ConfigError
+
+DEFAULT_HISTORY_DIR = '.watchdog_history'
+
+def history_store(cfg, name=None):
+    """
+    Return the HistoryStore of a config (history in its general section)
+
+    With a name (several configs in one run) the history is kept in path/<name>.
+    """
+
+    from security.history import HistoryStore
+
+    history_cfg = cfg['general'].get('history') or {}
+    path = history_cfg.get('path') or DEFAULT_HISTORY_DIR
+    if name is not None:
+        path = os.path.join(path, name)
+
+    return HistoryStore(path, history_cfg.get('retention-days'),
+                        history_cfg.get('compact-after-days', 7))
+
+def _match(text):
+    column, _, string = text.partition('=')
+    if not column or not string:
+        raise argparse.ArgumentTypeError("use COLUMN=STRING, e.g. Role=owner")
+    return column, string
+
+def main(argv):
+    """
+    Run a history query
+    """
+
+    parser = argparse.ArgumentParser(prog='gcp-watchdog history')
+    parser.add_argument('--config', '-c',
+                        dest='config_file',
+                        default='watchdog.yaml',
+                        help='Configuration file with the history settings (default: watchdog.yaml)')
+    parser.add_argument('--name',
+                        help='Name of the config, if the history was written with several configs')
+    commands = parser.add_subparsers(dest='command')
+
+    runs = commands.add_parser('runs', help='List the recorded runs of a table')
+    runs.add_argument('table', help='instances, iam or firewalls')
+
+    at = commands.add_parser('at', help='Show a table as it was at a time')
+    at.add_argument('time', help='e.g. "2016-10-18 08:00"')
+    at.add_argument('table', help='instances, iam or firewalls')
+
+    intervals = commands.add_parser('intervals', help="""Show every version of the rows with the
+                                    run it was first (Since) and last (Last_seen) seen in""")
+    intervals.add_argument('table', help='instances, iam or firewalls')
+    intervals.add_argument('--since', help='Only versions that existed after this time')
+    intervals.add_argument('--until', help='Only versions that existed before this time')
+
+    for command in (at, intervals):
+        command.add_argument('--project',
+                             dest='projects',
+                             action='append',
+                             help='Only rows of this project (repeatable)')
+        command.add_argument('--match',
+                             action='append',
+                             type=_match,
+                             help="""Only rows whose COLUMN contains STRING, e.g.
+                             Email=jane.doe (repeatable)""")
+
+    for command in (runs, at, intervals):
+        command.add_argument('--csv',
+                             action='store_true',
+                             help='Print CSV instead of a text table')
+
+    commands.add_parser('compact', help='Apply compaction and retention now')
+
+    args = parser.parse_args(argv)
+
+    import pandas as pd
+
+    try:
+        cfg = load_config(args.config_file)
+    except ConfigError as error:
+        parser.error(str(error))
+    store = history_store(cfg, args.name)
+
+    if args.command == 'compact':
+        store.maintain(pd.Timestamp.now())
+        return
+
+    if args.table.lower() not in store.titles():
+        parser.error("no history of '%s' in %s (recorded: %s)" % (
+            args.table, store.directory, ', '.join(store.titles()) or 'none'))
+
+    if args.command != 'runs':
+        columns = store.columns(args.table)
+        for column, _ in args.match or []:
+            if column not in columns:
+                parser.error("no column '%s' in %s (columns: %s)" % (
+                    column, args.table, ', '.join(columns)))
+
+    if args.command == 'runs':
+        table = pd.DataFrame({'Run': store.runs(args.table)})
+
+    elif args.command == 'at':
+        table = store.at(args.table, pd.Timestamp(args.time), args.projects,
+                         dict(args.match or []))
+
+    else:
+        table = store.intervals(args.table,
+                                pd.Timestamp(args.since) if args.since else None,
+                                pd.Timestamp(args.until) if args.until else None,
+                                args.projects, dict(args.match or []))
+
+    if table is None or not len(table):
+        print "No rows"
+    elif args.csv:
+        table.to_csv(sys.stdout, index=False, encoding='utf-8')
+    else:
+        print table.to_string(index=False).encode('utf-8')
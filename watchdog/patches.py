@@ -0,0 +1,141 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Applies audit-log patches (see security.audit_log) to the tables of the daemon
+
+The daemon keeps every fetched table next to its evaluated section. A patch
+replaces the matching rows of the table, only the new rows are evaluated
+against the rules of the config and spliced into the section; all other rows
+keep their filter and highlight until the next full poll reconciles them.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+from sections import IAM_KEYS
+
+def select(table, match):
+    """
+    Return a boolean array, True for the rows with all {column: value} of match
+    """
+
+    rows = np.ones(len(table), dtype=bool)
+    for column, value in match.items():
+        rows &= (table[column] == value).values
+    return rows
+
+def _encode_like(table, template):
+    """
+    Dictionary encode the columns of a table that are categorical in template
+    """
+
+    for column in table.columns:
+        if column in template.columns and hasattr(template[column], 'cat') \
+                and not hasattr(table[column], 'cat'):
+            table[column] = table[column].astype('category')
+    return table
+
+def order_rows(kind, table, project_IDs, slots):
+    """
+    Return the positions of the rows in report order
+
+    IAM rows are sorted by project and member (like sort_iam), the other
+    tables keep the order of the projects (like shards.read_shards) and
+    within one project the order of their slots. A new row has the slot of
+    the row it replaces, so it keeps its place like in a full crawl.
+    """
+
+    if not len(table):
+        return np.arange(0)
+
+    if kind == 'IAM':
+        return table.reset_index(drop=True).sort_values(IAM_KEYS).index.values
+
+    rank = pd.Series(np.arange(len(project_IDs)), index=project_IDs)
+    ranks = rank.reindex(table['Project_ID'].astype(object)).values
+    order = np.argsort(slots, kind='mergesort')
+    return order[np.argsort(ranks[order], kind='mergesort')]
+
+def _slot(old, new, slots, end):
+    """
+    Return the slot of the rows of a patch: the first old row it replaces, else
+    the slot of the new rows it replaces, else end
+    """
+
+    if old.any():
+        return np.flatnonzero(old)[0]
+    if new.any():
+        return slots[new].min()
+    return end
+
+def patch_table(table, patches, fetch, kind, project_IDs):
+    """
+    Apply the patches of one table, in order
+
+    fetch(patch) returns the current rows of the project of a refetch patch.
+    Returns the patched table in report order and its new rows (not yet
+    evaluated).
+    """
+
+    removed = np.zeros(len(table), dtype=bool)
+    added = table.iloc[:0].astype(object)
+    added_slots = np.zeros(0, dtype=int)
+
+    for patch in patches:
+        old = select(table, patch.match) & ~removed
+        new = select(added, patch.match)
+        slot = _slot(old, new, added_slots, len(table))
+
+        if patch.refetch:
+            rows = fetch(patch)
+            rows = rows.loc[select(rows, patch.match)]
+        elif patch.values is not None:
+            # Later patches of the same rows (e.g. insert, then stop) change the new rows
+            rows = pd.concat([table.loc[old].astype(object), added.loc[new]])
+            for column, value in patch.values.items():
+                rows[column] = value
+        else:
+            rows = pd.DataFrame(patch.rows, columns=table.columns)
+
+        removed |= old
+        added = pd.concat([added.loc[~new], rows.astype(object)], ignore_index=True)
+        added_slots = np.append(added_slots[~new], np.repeat(slot, len(rows)))
+
+    patched = pd.concat([table.loc[~removed], added], ignore_index=True)
+    order = order_rows(kind, patched, project_IDs,
+                       np.append(np.flatnonzero(~removed), added_slots))
+    patched = patched.iloc[order].reset_index(drop=True)
+    return _encode_like(patched, table), added
+
+def patch_section(section, patches, new_section, kind, project_IDs):
+    """
+    Replace the rows of a section matched by the patches with the evaluated new rows
+
+    new_section is the (title, table, highlight) of the new rows.
+    """
+
+    title, table, highlight = section
+    _, new_table, new_highlight = new_section
+
+    # The new rows of a patch take the slot of the first row it replaces
+    removed = np.zeros(len(table), dtype=bool)
+    new_slots = np.repeat(len(table), len(new_table))
+    for patch in patches:
+        old = select(table, patch.match)
+        if old.any():
+            new_slots[select(new_table, patch.match)] = np.flatnonzero(old)[0]
+        removed |= old
+
+    highlight = np.concatenate([np.asarray(highlight, dtype=bool)[~removed],
+                                np.asarray(new_highlight, dtype=bool)])
+    patched = _encode_like(pd.concat([table.loc[~removed], new_table], ignore_index=True), table)
+
+    order = order_rows(kind, patched, project_IDs,
+                       np.append(np.flatnonzero(~removed), new_slots))
+    patched = patched.iloc[order].reset_index(drop=True)
+    patched.index += 1
+
+    return title, patched, highlight[order]
@@ -0,0 +1,78 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Renders the report tables as HTML
+
+Highlighted rows get the 'alert' class, the colors are defined once in
+templates/daily_report.html instead of per cell.
+
+Tables are produced in chunks of rows and the report template is streamed to
+the output file, so the report is never held in memory as a whole.
+
+"""
+
+from cgi import escape
+from itertools import izip
+
+TABLE_CLASS = 'watchdog-table'
+ALERT_CLASS = 'alert'
+
+def _cell(value):
+    """
+    Return the escaped text of a table cell
+    """
+
+    if isinstance(value, (list, tuple)):
+        value = ', '.join(unicode(v) for v in value)
+    elif value is None or (isinstance(value, float) and value != value):
+        # Missing values of categorical columns are NaN
+        value = ''
+
+    return escape(unicode(value), quote=True)
+
+def iter_table(table, highlight=None, chunksize=1000):
+    """
+    Yield the HTML of a table in chunks of rows
+
+    highlight is a boolean sequence aligned with the rows of the table
+    """
+
+    yield u'<table border=1 class="%s"><thead><tr><th></th>' % TABLE_CLASS
+    for column in table.columns:
+        yield u'<th>%s</th>' % _cell(column)
+    yield u'</tr></thead><tbody>'
+
+    if highlight is None:
+        highlight = [False] * len(table)
+
+    chunk = []
+    for index, row, alert in izip(table.index, table.itertuples(index=False), highlight):
+        chunk.append(u'<tr class="%s">' % ALERT_CLASS if alert else u'<tr>')
+        chunk.append(u'<th>%s</th>' % _cell(index))
+        chunk.extend(u'<td>%s</td>' % _cell(value) for value in row)
+        chunk.append(u'</tr>')
+
+        if len(chunk) >= chunksize * (len(table.columns) + 3):
+            yield u''.join(chunk)
+            chunk = []
+
+    if chunk:
+        yield u''.join(chunk)
+
+    yield u'</tbody></table>'
+
+def render_table(table, highlight=None):
+    """
+    Return the HTML of a table
+    """
+
+    return u''.join(iter_table(table, highlight))
+
+def write_report(template, content, path):
+    """
+    Stream the rendered template into a file
+    """
+
+    template.stream(content).dump(path, encoding='utf-8')
@@ -0,0 +1,489 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Runs the watchdog for parsed command line arguments and loaded configs
+
+Imported by watchdog.main only after the arguments are parsed, so --help and
+invalid arguments don't load pandas. The GCP client libraries, jinja2 and
+sendgrid are only imported by the stages that use them.
+
+"""
+
+import datetime
+import multiprocessing
+import os
+from itertools import chain
+
+from security.cache import MemoryCache, DiskCache
+from security.snapshot import SnapshotStore, diff_sections
+from security.history import record_sections
+from security.backends import ApiBackend, AssetExportBackend
+from security.profiling import Profiler
+
+from report import iter_table, write_report
+from export import export_sections
+from sections import SECTIONS, load_projects, load_zones, iter_sections, iter_stats_sections
+from sections import fetch_projects, evaluate_projects, fetch_zones, evaluate_zones
+from sections import iter_shared_sections
+from shards import write_shard, read_shards, read_profiles, remove_shards
+from history_cli import history_store
+
+# Discovery documents are kept here if the config has no discovery-cache
+DEFAULT_DISCOVERY_CACHE = os.path.join('~', '.cache', 'gcp-watchdog')
+
+def run(args, configs, formats):
+    """
+    Collect the inventory and write and send the reports of all configs
+
+    configs is a list of (name, config), the collection settings are taken
+    from the first one.
+    """
+
+    cfg = configs[0][1]
+
+    if args.shard:
+        # One shard of a crawl split across machines, merged later with --merge
+        collect_shard(args, configs, args.shard)
+        return
+
+    if args.processes:
+        # Crawl all shards locally, then report as with --merge
+        collect_shards(args, configs, args.processes)
+        args.merge = True
+
+    profiler = Profiler()
+    if args.merge:
+        # The crawl stages of all shards, summed up
+        for stats in read_profiles(args.shard_dir):
+            profiler.merge(stats)
+
+        with profiler.stage('merge') as stage:
+            collection = read_shards(args.shard_dir)
+            stage['rows'] = sum(len(table) for table in collection['tables'].values())
+        report_collection(configs, collection, args, formats, profiler)
+        print_stages(profiler, args)
+        return
+
+    backend, cache, scheduler = build_backend(cfg, args, profiler)
+
+    if args.daemon:
+        run_daemon(cfg, args, backend, cache, scheduler, profiler)
+        return
+
+    if len(configs) == 1:
+        # Get projects and zones
+        project_IDs, inaccessible_section = load_projects(cfg, backend, profiler)
+        zones = load_zones(cfg, backend, project_IDs, profiler)
+
+        # Get data and alerts from GCP, section by section while the report is written
+        sections = chain(
+            [inaccessible_section],
+            iter_sections(cfg, backend, project_IDs, zones, profiler),
+            iter_stats_sections(cfg, cache, scheduler, profiler))
+
+        publish(cfg, sections, args, formats, profiler)
+
+    else:
+        collection = collect(configs, backend, profiler)
+        report_collection(configs, collection, args, formats, profiler, cache, scheduler)
+
+    close_backend(backend, cache)
+
+    if scheduler:
+        print "\nAPI requests:"
+        for api, stats in sorted(scheduler.stats().items()):
+            print "- %s: %d requests, %d retries, %d quota errors, %d connection errors, " \
+                  "%.1fs throttled" % (api, stats['requests'], stats['retries'],
+                                       stats['quota_errors'], stats['transport_errors'],
+                                       stats['throttled_seconds'])
+
+    print_stages(profiler, args)
+
+def print_stages(profiler, args):
+    """
+    Print the statistics of every stage and write the profile file
+    """
+
+    print "\nStages:"
+    for stage in profiler.stages:
+        print "- %s: %.1fs, %d API calls, %d rows, %.0fMB peak memory" % (
+            stage['stage'], stage['seconds'], stage['api_calls'], stage['rows'],
+            stage['peak_rss_mb'])
+
+    if args.profile_file:
+        profiler.dump(args.profile_file)
+
+def build_backend(cfg, args, profiler):
+    """
+    Return the inventory backend, the cache and the scheduler (None without API calls)
+    """
+
+    if args.asset_export:
+        return AssetExportBackend(args.asset_export), None, None
+
+    import httplib2
+    from oauth2client.service_account import ServiceAccountCredentials
+
+    from security.collector import Collector
+    from security.scheduler import Scheduler
+    from security.discovery_cache import build_client, DEFAULT_TTL
+
+    # The discovery documents are read from a local cache instead of fetched every run
+    discovery_cache = os.path.expanduser(cfg['general'].get('discovery-cache') or
+                                         DEFAULT_DISCOVERY_CACHE)
+    discovery_ttl = DEFAULT_TTL
+
+    if args.replay or args.synthetic:
+        # Offline transports answer every request themselves and need no credentials
+        credentials = None
+        if args.replay:
+            from security.replay import FixtureStore, ReplayHttp
+            store = FixtureStore(args.replay)
+            http_factory = lambda: ReplayHttp(store)
+            discovery_cache, discovery_ttl = store.discovery_dir, float('inf')
+        else:
+            from security.synthetic import SyntheticOrg, SyntheticHttp
+            org = SyntheticOrg(**args.synthetic)
+            http_factory = lambda: SyntheticHttp(org)
+        client_http = http_factory()
+
+    else:
+        # Get authentication and GCP APIs
+        if args.key_path:
+            credentials = ServiceAccountCredentials.from_json_keyfile_name(args.key_path)
+        else: 
+            credentials = ServiceAccountCredentials.from_json_keyfile_name(
+            os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'))
+
+        http_factory = lambda: credentials.authorize(httplib2.Http())
+        client_http = None
+
+        if args.record:
+            # Keep every response and the discovery documents as fixtures for --replay
+            from security.replay import FixtureStore, RecordingHttp
+            store = FixtureStore(args.record)
+            authorized_http = http_factory
+            http_factory = lambda: RecordingHttp(authorized_http(), store)
+            discovery_cache = store.discovery_dir
+
+    with profiler.stage('discovery'):
+        compute = build_client('compute', 'v1', credentials, discovery_cache, discovery_ttl,
+                               client_http)
+        rm = build_client('cloudresourcemanager', 'v1', credentials, discovery_cache,
+                          discovery_ttl, client_http)
+
+    # The cache lets the report stages reuse the zones and IAM policies fetched
+    # by check_projects and, if configured, keeps them on disk between runs
+    # Offline runs must not mix their responses into the cache of real ones
+    cache_cfg = cfg['general'].get('cache')
+    if cache_cfg and not (args.replay or args.synthetic):
+        cache = DiskCache(cache_cfg.get('path', '.watchdog_cache.sqlite'),
+                          cache_cfg.get('ttl'), args.refresh)
+    else:
+        cache = MemoryCache()
+
+    # Requests per second of each API, retries of quota errors
+    concurrency = cfg['general'].get('concurrency', 1)
+    scheduler = Scheduler(cfg['general'].get('rate-limits'), concurrency,
+                          cfg['general'].get('retries', 5))
+
+    # Every worker thread gets its own authorized http object
+    collector = Collector(http_factory, concurrency, cache, scheduler, profiler)
+
+    backend = ApiBackend(compute, rm, collector, cfg['general'].get('max-results'))
+
+    return backend, cache, scheduler
+
+def close_backend(backend, cache):
+    """
+    Stop the worker threads of the backend and close the cache file
+    """
+
+    if isinstance(backend, ApiBackend):
+        backend.collector.close()
+    if isinstance(cache, DiskCache):
+        cache.close()
+
+def get_template():
+    """
+    Return the jinja2 template of the report
+    """
+
+    import pkg_resources
+    from jinja2 import Environment, FileSystemLoader
+
+    templates_folder = pkg_resources.resource_filename('templates','')
+    env = Environment(loader=FileSystemLoader(templates_folder))
+    return env.get_template('daily_report.html')
+
+def run_daemon(cfg, args, backend, cache, scheduler, profiler):
+    """
+    Poll the sections until interrupted (see daemon.Daemon)
+    """
+
+    from daemon import Daemon, ReportServer, DEFAULT_PULL_INTERVAL
+
+    template = get_template()
+    daemon_cfg = cfg['general'].get('daemon') or {}
+    server = ReportServer(daemon_cfg.get('host', 'localhost'), daemon_cfg.get('port', 8080))
+
+    def render(sections):
+        if cfg['general'].get('history'):
+            sections = record_sections(sections, history_store(cfg))
+        return template.render(report_content(
+            cfg, chain(sections, iter_stats_sections(cfg, cache, scheduler, profiler)),
+            profiler))
+
+    def notify(html):
+        if args.email:
+            with profiler.stage('email'):
+                email_report(cfg, html, args.sendgrid_key)
+
+    print "\nServing the latest report on http://%s:%d/" % server.httpd.server_address
+    server.start()
+    try:
+        subscriber = None
+        if args.audit_log:
+            from security.audit_log import FileSubscriber
+            subscriber = FileSubscriber(args.audit_log)
+
+        Daemon(cfg, backend, render, notify, profiler, cache, daemon_cfg.get('intervals'),
+               server, subscriber, daemon_cfg.get('pull-interval', DEFAULT_PULL_INTERVAL)).run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        close_backend(backend, cache)
+
+def report_content(cfg, sections, profiler):
+    """
+    Return the template content of a report
+    """
+
+    return {'title': cfg['general']['report-title'] + '  ' + str(datetime.datetime.now())[:-7],
+            'sections': ((title, profiler.timed('render', iter_table(table, highlight)))
+                         for title, table, highlight in sections)
+           }
+
+def email_report(cfg, html, sendgrid_key=None):
+    """
+    Send a report to the receivers of its config
+    """
+
+    from send_email import send_report, DEFAULT_SIZE_LIMIT
+
+    send_report(html, cfg['general']['watchdog-email'],
+                [to_email['email'] for to_email in cfg['general']['receiver-email']],
+                cfg['general']['report-title'], sendgrid_key,
+                cfg['general'].get('email-size-limit', DEFAULT_SIZE_LIMIT))
+
+def publish(cfg, sections, args, formats, profiler, name=None):
+    """
+    Write the report files of a config and send its email
+
+    With a name (several configs in one run) the files are called e.g.
+    report_<name>.html and the snapshots and history are kept in
+    snapshot-dir/<name> and history/path/<name>.
+    """
+
+    report_file = args.report_file
+    snapshot_dir = cfg['general'].get('snapshot-dir')
+    if name is not None:
+        root, ext = os.path.splitext(report_file)
+        report_file = '%s_%s%s' % (root, name, ext)
+        if snapshot_dir:
+            snapshot_dir = os.path.join(snapshot_dir, name)
+
+    # Append the full tables to the history, before --diff reduces them to their changes
+    if cfg['general'].get('history'):
+        sections = record_sections(sections, history_store(cfg, name))
+
+    # Keep the tables for the next run and, in diff mode, only report their changes
+    if args.diff or snapshot_dir:
+        if not snapshot_dir:
+            snapshot_dir = os.path.join('.watchdog_snapshots', name or '')
+        sections = diff_sections(sections, SnapshotStore(snapshot_dir), args.diff)
+
+    # Write the data files while the sections pass by
+    if not args.no_output:
+        sections = export_sections(sections, formats, report_file)
+
+    write_html = 'html' in formats and not args.no_output
+
+    # Data only runs don't render HTML at all
+    if not write_html and not args.email:
+        for _ in sections:
+            pass
+        return
+
+    # Create report
+    template = get_template()
+    content = report_content(cfg, sections, profiler)
+
+    # Write report to file, streaming each section as soon as it is produced
+    if write_html:
+        write_report(template, content, report_file)
+
+    # Send email (needs email client to be configured)
+    if args.email:
+        if write_html:
+            with open(report_file, 'r') as the_file:
+                html = the_file.read().decode('utf-8')
+        else:
+            html = template.render(content)
+
+        with profiler.stage('email'):
+            email_report(cfg, html, args.sendgrid_key)
+
+# Tables shared with the report processes of report_configs (inherited on fork)
+_shared = {}
+
+def _report_config(index):
+    """
+    Evaluate, write and send the report of one config (runs in a worker process)
+    """
+
+    name, cfg, project_IDs, zones = _shared['jobs'][index]
+    profiler = _shared['profiler']
+
+    sections = chain(
+        [_shared['inaccessible_section']],
+        iter_shared_sections(cfg, _shared['tables'], project_IDs, zones, profiler),
+        iter_stats_sections(cfg, _shared['cache'], _shared['scheduler'], profiler))
+
+    publish(cfg, sections, _shared['args'], _shared['formats'], profiler, name)
+    return name
+
+def _report_config_process(index):
+    """
+    Run _report_config in a worker process, returning its name and its new statistics
+
+    The worker inherits the statistics of the collection (shown in its
+    report), only what it added is merged back into the parent's profiler.
+    """
+
+    before = _shared['profiler'].to_dict()
+    name = _report_config(index)
+    return name, _shared['profiler'].since(before)
+
+def collect(configs, backend, profiler, shard=None):
+    """
+    Return the projects, zones and tables reported by any of the configs
+
+    Projects, zones and tables are fetched for the union of the projects and
+    zones the configs report on. With a shard (index, count) only the
+    projects of that shard are crawled (see shards).
+    """
+
+    projects, inaccessible_projects = fetch_projects(backend, profiler, shard)
+
+    selected = set(chain(*[evaluate_projects(cfg, projects, inaccessible_projects)[0]
+                           for _, cfg in configs]))
+    project_IDs = [project for project in projects['Project_ID'] if project in selected]
+
+    # A shard may get no reported projects at all, zones are listed through a project
+    all_zones = fetch_zones(backend, project_IDs, profiler) if project_IDs else []
+    selected_zones = set(chain(*[evaluate_zones(cfg, all_zones) for _, cfg in configs]))
+    zones = [zone for zone in all_zones if zone in selected_zones]
+
+    tables = {}
+    for kind, fetch, _ in SECTIONS:
+        if any(cfg[kind]['print'] for _, cfg in configs):
+            tables[kind] = fetch(backend, project_IDs, zones, profiler)
+
+    return {'projects': projects,
+            'inaccessible': inaccessible_projects,
+            'zones': all_zones,
+            'tables': tables}
+
+def report_collection(configs, collection, args, formats, profiler, cache=None, scheduler=None):
+    """
+    Write the report of every config from a collection (see collect)
+
+    The rules of every config are evaluated on the collected tables, in
+    report-processes worker processes (general section of the first config,
+    default: one per config up to the number of CPUs).
+    """
+
+    projects, inaccessible_projects = collection['projects'], collection['inaccessible']
+
+    # A single config writes the files without a name, as in the one-shot report
+    jobs = []
+    for name, cfg in configs:
+        project_IDs = evaluate_projects(cfg, projects, inaccessible_projects)[0]
+        jobs.append((name if len(configs) > 1 else None, cfg, project_IDs,
+                     evaluate_zones(cfg, collection['zones'])))
+
+    _shared.update({
+        'jobs': jobs,
+        'inaccessible_section': ('Incaccessible Projects', inaccessible_projects,
+                                 [True] * len(inaccessible_projects)),
+        'tables': collection['tables'],
+        'args': args,
+        'formats': formats,
+        'profiler': profiler,
+        'cache': cache,
+        'scheduler': scheduler})
+
+    processes = configs[0][1]['general'].get('report-processes') or \
+        min(len(configs), multiprocessing.cpu_count())
+
+    try:
+        if processes == 1 or len(configs) == 1:
+            names = [_report_config(index) for index in range(len(configs))]
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_report_config_process, range(len(configs)))
+            finally:
+                pool.close()
+                pool.join()
+
+            names = [name for name, _ in results]
+            for _, stats in results:
+                profiler.merge(stats)
+    finally:
+        _shared.clear()
+
+    if len(configs) > 1:
+        print "\nReports: " + ', '.join(names)
+
+def collect_shard(args, configs, shard):
+    """
+    Crawl the projects of one shard and write its collection to the shard directory
+    """
+
+    profiler = Profiler()
+    backend, cache, scheduler = build_backend(configs[0][1], args, profiler)
+
+    collection = collect(configs, backend, profiler, shard)
+    close_backend(backend, cache)
+
+    # The merge adds the statistics of every shard to its own
+    path = write_shard(args.shard_dir, shard, collection, profiler.to_dict())
+
+    print "Shard %d/%d: %d projects, %s" % (shard[0], shard[1], len(collection['projects']), path)
+
+def collect_shards(args, configs, count):
+    """
+    Crawl all shards of the organization in count local processes
+
+    Every process builds its own clients (http connections can't be shared
+    across a fork) and writes its shard file.
+    """
+
+    # Shards of an earlier run must not be merged with the new ones
+    remove_shards(args.shard_dir)
+
+    processes = [multiprocessing.Process(target=collect_shard, args=(args, configs, (index, count)))
+                 for index in range(count)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    failed = [index for index, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        raise RuntimeError("shards %s failed" % ', '.join(str(index) for index in failed))
@@ -0,0 +1,284 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Builds the (title, table, highlight) sections of the report
+
+Every section is fetched (fetch_*) and then evaluated against the rules of
+a config (evaluate_*). The one-shot report does both in a row, the daemon
+rebuilds single sections on their own interval and a run with several
+configs fetches the tables once and evaluates them per config.
+
+"""
+
+import pandas as pd
+
+from security.alerts import alert_projects, alert_zones
+from security.alerts import alert_instances, alert_firewalls, alert_iam
+from security.tables import build_frame
+
+# Sort order of the IAM table
+IAM_KEYS = ['Project_ID', 'Name', 'Email', 'Email_suffix', 'Account_type']
+
+def fetch_projects(backend, profiler, shard=None):
+    """
+    Return the DataFrames of accessible and of inaccessible projects
+
+    With a shard (index, count) only the projects of that shard are checked
+    (see shards.in_shard). The projects keep their index in the full list.
+    """
+
+    projects_columns = ['Name', 'Project_ID']
+    with profiler.stage('projects') as stage:
+        projects_data = backend.get_projects()
+        projects = pd.DataFrame(projects_data, columns=projects_columns)
+        if shard is not None:
+            from shards import in_shard
+            projects = projects[in_shard(projects['Project_ID'], shard)]
+        stage['rows'] = len(projects)
+
+    with profiler.stage('check_projects') as stage:
+        projects, inaccessible_projects = backend.check_projects(projects)
+        stage['rows'] = len(projects)
+
+    return projects, inaccessible_projects
+
+def evaluate_projects(cfg, projects, inaccessible_projects):
+    """
+    Return the IDs of the projects reported by a config and the section of inaccessible projects
+    """
+
+    project_IDs = alert_projects(projects, cfg['rules'].projects)['Project_ID'].tolist()
+
+    # Table of unaccessible projects (all highlighted)
+    section = ('Incaccessible Projects', inaccessible_projects, [True] * len(inaccessible_projects))
+    return project_IDs, section
+
+def load_projects(cfg, backend, profiler):
+    """
+    Return the IDs of the reported projects and the section of inaccessible projects
+    """
+
+    projects, inaccessible_projects = fetch_projects(backend, profiler)
+    return evaluate_projects(cfg, projects, inaccessible_projects)
+
+def fetch_zones(backend, project_IDs, profiler):
+    """
+    Return the names of all zones
+    """
+
+    with profiler.stage('zones') as stage:
+        zones = list(backend.get_zones(project_IDs))
+        stage['rows'] = len(zones)
+
+    return zones
+
+def evaluate_zones(cfg, zones):
+    """
+    Return the names of the zones reported by a config
+    """
+
+    zones = pd.DataFrame(zones, columns=['Name'])
+    return alert_zones(zones, cfg['rules'].zones)['Name'].tolist()
+
+def load_zones(cfg, backend, project_IDs, profiler):
+    """
+    Return the names of the reported zones
+    """
+
+    return evaluate_zones(cfg, fetch_zones(backend, project_IDs, profiler))
+
+def fetch_instances(backend, project_IDs, zones, profiler):
+    """
+    Return the table of compute instances
+    """
+
+    instances_coulmns = ['Instance', 'Status', 'Machine_type', 'Project_ID', 'Zone']
+
+    with profiler.stage('instances') as stage:
+        instance_data = backend.iter_instances(project_IDs, zones)
+        instances = build_frame(instance_data, instances_coulmns)
+        stage['rows'] = len(instances)
+
+    return instances
+
+def evaluate_instances(cfg, instances):
+    """
+    Return the section of compute instances
+    """
+
+    # Get alerts and filters
+    instances, instances_highlight = alert_instances(instances, cfg['rules'].compute)
+
+    return 'Instances', instances, instances_highlight
+
+def fetch_iam(backend, project_IDs, zones, profiler):
+    """
+    Return the table of IAM members
+    """
+
+    iam_coulmns = ['Project_ID', 'Name', 'Email', 'Email_suffix', 'Account_type', 'Role',]
+
+    with profiler.stage('iam') as stage:
+        # One row per project and member, the roles are already grouped into a list
+        iam_data = backend.iter_iam_members(project_IDs)
+        iam = sort_iam(build_frame(iam_data, iam_coulmns, objects=['Role']))
+        stage['rows'] = len(iam)
+
+    return iam
+
+def sort_iam(iam):
+    """
+    Return the IAM table sorted by project and member
+    """
+
+    return iam.sort_values(IAM_KEYS).reset_index(drop=True)
+
+def evaluate_iam(cfg, iam):
+    """
+    Return the section of IAM members
+    """
+
+    # Get alerts and filters
+    alerted_iam, alerted_iam_highlight = alert_iam(iam, cfg['rules'].IAM)
+
+    return 'IAM', alerted_iam, alerted_iam_highlight
+
+def fetch_firewalls(backend, project_IDs, zones, profiler):
+    """
+    Return the table of firewall rules
+    """
+
+    firewalls_columns = ['Project_ID', 'Rule_name', 'Range',
+                         'Protocol', 'Port', 'Firewall_type']
+
+    with profiler.stage('firewalls') as stage:
+        firewall_data = backend.iter_firewalls(project_IDs)
+        firewalls = build_frame(firewall_data, firewalls_columns)
+        stage['rows'] = len(firewalls)
+
+    return firewalls
+
+def evaluate_firewalls(cfg, firewalls):
+    """
+    Return the section of firewall rules
+    """
+
+    # Get alerts and filters
+    alerted_firewalls, alerted_firewalls_highlight = alert_firewalls(firewalls,
+                                                                     cfg['rules'].firewall)
+
+    return 'Firewalls', alerted_firewalls, alerted_firewalls_highlight
+
+# Report sections in report order: config section, fetch, evaluate
+SECTIONS = [('compute', fetch_instances, evaluate_instances),
+            ('IAM', fetch_iam, evaluate_iam),
+            ('firewall', fetch_firewalls, evaluate_firewalls)]
+
+def build_section(cfg, kind, backend, project_IDs, zones, profiler):
+    """
+    Fetch the table of a config section and evaluate its rules
+    """
+
+    for section_kind, fetch, evaluate in SECTIONS:
+        if section_kind == kind:
+            table = fetch(backend, project_IDs, zones, profiler)
+            with profiler.stage('alerts'):
+                return evaluate(cfg, table)
+
+    raise KeyError(kind)
+
+def iter_sections(cfg, backend, project_IDs, zones, profiler):
+    """
+    Yield (title, table, highlight) for every requested report table
+
+    The data of a table is only fetched once the previous table has been
+    consumed, so only one table is held in memory at a time.
+    """
+
+    for kind, _, _ in SECTIONS:
+        if cfg[kind]['print']:
+            yield build_section(cfg, kind, backend, project_IDs, zones, profiler)
+
+def select_rows(table, project_IDs, zones=None):
+    """
+    Return the rows of a shared table that belong to the given projects (and zones)
+    """
+
+    rows = table['Project_ID'].isin(project_IDs)
+    if zones is not None and 'Zone' in table.columns:
+        rows &= table['Zone'].isin(zones)
+
+    return table.loc[rows].reset_index(drop=True)
+
+def iter_shared_sections(cfg, tables, project_IDs, zones, profiler):
+    """
+    Yield the sections of a config from tables fetched once for several configs
+
+    tables maps a config section ('compute', 'IAM', 'firewall') to its table
+    over the projects and zones of all configs.
+    """
+
+    for kind, _, evaluate in SECTIONS:
+        if cfg[kind]['print']:
+            with profiler.stage('alerts'):
+                section = evaluate(cfg, select_rows(tables[kind], project_IDs, zones))
+            yield section
+
+def iter_cache_sections(cache):
+    """
+    Yield the table of cache statistics (after all other tables have been fetched)
+    """
+
+    cache_stats = pd.DataFrame([[kind, counts['hits'], counts['misses'], counts['unchanged']]
+                                for kind, counts in sorted(cache.stats.items())],
+                               columns=['Kind', 'Hits', 'Misses', 'Unchanged'])
+    yield 'Inventory Cache', cache_stats, None
+
+def iter_scheduler_sections(scheduler):
+    """
+    Yield the table of API request statistics (after all other tables have been fetched)
+    """
+
+    api_stats = pd.DataFrame([[api, stats['requests'], stats['retries'], stats['quota_errors'],
+                               stats['transport_errors'], round(stats['throttled_seconds'], 1)]
+                              for api, stats in sorted(scheduler.stats().items())],
+                             columns=['API', 'Requests', 'Retries', 'Quota_errors',
+                                      'Connection_errors', 'Throttled_seconds'])
+    yield 'API Requests', api_stats, None
+
+def iter_profile_sections(profiler):
+    """
+    Yield the tables of run statistics (after all other tables have been fetched)
+    """
+
+    stage_stats = pd.DataFrame([[stage['stage'], round(stage['seconds'], 1), stage['api_calls'],
+                                 stage['bytes'], stage['rows'], stage['peak_rss_mb']]
+                                for stage in profiler.stages],
+                               columns=['Stage', 'Seconds', 'API_calls', 'Bytes', 'Rows',
+                                        'Peak_RSS_MB'])
+    yield 'Run Statistics', stage_stats, None
+
+    project_stats = pd.DataFrame([[stats['project'], round(stats['seconds'], 1),
+                                   stats['api_calls'], stats['bytes']]
+                                  for stats in profiler.slowest_projects()],
+                                 columns=['Project_ID', 'Request_seconds', 'API_calls', 'Bytes'])
+    yield 'Slowest Projects', project_stats, None
+
+def iter_stats_sections(cfg, cache, scheduler, profiler):
+    """
+    Yield the configured statistics tables
+    """
+
+    if cfg['general'].get('cache') and hasattr(cache, 'stats'):
+        for section in iter_cache_sections(cache):
+            yield section
+
+    if scheduler is not None:
+        for section in iter_scheduler_sections(scheduler):
+            yield section
+
+    if cfg['general'].get('run-statistics'):
+        for section in iter_profile_sections(profiler):
+            yield section
@@ -5,35 +5,109 @@
 """
 This sends an HTML email via the sendgrid email client
 
+The report is inlined once and sent to all receivers with one request (one
+personalization per receiver, so they don't see each other).
+
 """
 
+import base64
+import gzip
 import os
+import random
+import time
+from StringIO import StringIO
+
 import sendgrid
-from sendgrid.helpers.mail import Email, Content, Mail
+from python_http_client.exceptions import HTTPError
 from inlinestyler.utils import inline_css
 
-def send_email(html, from_email, to_email, subject, sendgrid_key=None):
-    """Send html via email"""
+# SendGrid accepts at most 1000 personalizations per request
+MAX_PERSONALIZATIONS = 1000
 
-    if sendgrid_key:
-        sg = sendgrid.SendGridAPIClient(apikey=sendgrid_key)
+# Reports larger than this (in UTF-8 bytes) are sent as gzip attachment (SendGrid
+# allows 30MB in total)
+DEFAULT_SIZE_LIMIT = 10 * 1024 * 1024
+
+def _encode(html):
+    """Return the html as UTF-8 bytes"""
+
+    return html.encode('utf-8') if isinstance(html, unicode) else html
+
+def _gzip(html):
+    """Return the gzip compressed html"""
+
+    buf = StringIO()
+    with gzip.GzipFile(filename='report.html', mode='wb', fileobj=buf) as the_file:
+        the_file.write(_encode(html))
+
+    return buf.getvalue()
+
+def build_mail(html, from_email, to_emails, subject, size_limit=DEFAULT_SIZE_LIMIT):
+    """Return the SendGrid v3 request body for the (already inlined) html"""
+
+    mail = {'from': {'email': from_email},
+            'subject': subject,
+            'personalizations': [{'to': [{'email': to_email}]} for to_email in to_emails]}
+
+    if len(_encode(html)) <= size_limit:
+        mail['content'] = [{'type': 'text/html', 'value': html}]
     else:
-        sg = sendgrid.SendGridAPIClient(apikey=os.environ.get('SENDGRID_API_KEY'))
-        
-    from_email = Email(from_email)
-    subject = subject
-    to_email = Email(to_email)
+        mail['content'] = [{'type': 'text/html',
+                            'value': '<p>The report is too large for an email body, '
+                                     'see the attached report.html.gz</p>'}]
+        mail['attachments'] = [{'content': base64.b64encode(_gzip(html)),
+                                'type': 'application/gzip',
+                                'filename': 'report.html.gz',
+                                'disposition': 'attachment'}]
+
+    return mail
+
+def _post(sg, mail, retries, backoff):
+    """Post a mail, retrying on rate limits, server and connection errors"""
+
+    for attempt in range(retries + 1):
+        try:
+            return sg.client.mail.send.post(request_body=mail)
+
+        except HTTPError as error:
+            status_code = getattr(error, 'status_code', None) or getattr(error, 'code', None)
+            if attempt == retries or not (status_code == 429 or status_code >= 500):
+                raise
+
+        except IOError:
+            # Connection errors (URLError, socket.error)
+            if attempt == retries:
+                raise
+
+        # Exponential backoff with jitter
+        time.sleep(backoff * (2 ** attempt) * (0.5 + random.random()))
+
+def send_report(html, from_email, to_emails, subject, sendgrid_key=None,
+                size_limit=DEFAULT_SIZE_LIMIT, host=None, retries=3, backoff=1.0):
+    """Send html via email to all receivers"""
+
+    if not sendgrid_key:
+        sendgrid_key = os.environ.get('SENDGRID_API_KEY')
+
+    if host:
+        sg = sendgrid.SendGridAPIClient(apikey=sendgrid_key, host=host)
+    else:
+        sg = sendgrid.SendGridAPIClient(apikey=sendgrid_key)
 
     # Inline css in html
     html = inline_css(html)
 
-    content = Content("text/html", html)
-    mail = Mail(from_email, subject, to_email, content)
-
-    response = sg.client.mail.send.post(request_body=mail.get())
-    print response.status_code
-    print response.body
-    print response.headers
+    to_emails = list(to_emails)
+    for start in range(0, len(to_emails), MAX_PERSONALIZATIONS):
+        mail = build_mail(html, from_email, to_emails[start:start + MAX_PERSONALIZATIONS],
+                          subject, size_limit)
 
+        response = _post(sg, mail, retries, backoff)
+        print response.status_code
+        print response.body
+        print response.headers
 
+def send_email(html, from_email, to_email, subject, sendgrid_key=None):
+    """Send html via email"""
 
+    send_report(html, from_email, [to_email], subject, sendgrid_key)
@@ -0,0 +1,187 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2016 Datatonic
+# ----------------------------------------------------------------------
+
+"""
+Splits the crawl of an organization into shards of projects
+
+A project belongs to shard crc32(project ID) % count, so shards crawled by
+different processes or machines agree without exchanging the project list.
+Every shard writes its collected tables into a directory of data files (see
+security.frames), the merge step concatenates the tables of all shards into
+the tables of one report.
+
+"""
+
+import glob
+import json
+import os
+import re
+import shutil
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from security.frames import write_frame, read_frame, frame_file
+
+from sections import sort_iam
+
+_shard_pattern = re.compile(r'^(\d+)/(\d+)$')
+_dir_pattern = re.compile(r'shard-(\d+)-of-(\d+)$')
+
+def parse_shard(text):
+    """
+    Return (index, count) of a shard given as 'index/count', e.g. '0/4'
+    """
+
+    match = _shard_pattern.match(text.strip())
+    if match is None:
+        raise ValueError("shard must be given as index/count, e.g. 0/4")
+
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 0 <= index < count:
+        raise ValueError("shard index must be between 0 and %d" % (count - 1))
+
+    return index, count
+
+def shard_of(project, count):
+    """
+    Return the shard of a project
+    """
+
+    return (zlib.crc32(str(project)) & 0xffffffff) % count
+
+def in_shard(project_IDs, shard):
+    """
+    Return a boolean mask of the projects that belong to shard (index, count)
+    """
+
+    index, count = shard
+    return np.array([shard_of(project, count) == index for project in project_IDs], dtype=bool)
+
+def shard_path(directory, index, count):
+    return os.path.join(directory, 'shard-%04d-of-%04d' % (index, count))
+
+def write_shard(directory, shard, collection, profile=None):
+    """
+    Write the collection (see runner.collect) of a shard
+
+    The projects keep their rank in get_projects as a column, the zones and
+    the table kinds go into meta.json, the statistics of the crawl (see
+    Profiler.to_dict) into profile.json.
+    """
+
+    # Write next to the final directory first, so the merge never reads half a shard
+    path = shard_path(directory, *shard)
+    if os.path.isdir(path + '.tmp'):
+        shutil.rmtree(path + '.tmp')
+    os.makedirs(path + '.tmp')
+
+    write_frame(collection['projects'].rename_axis('Rank').reset_index(),
+                os.path.join(path + '.tmp', 'projects'))
+    write_frame(collection['inaccessible'].reset_index(drop=True),
+                os.path.join(path + '.tmp', 'inaccessible'))
+    for kind, table in collection['tables'].items():
+        write_frame(table.reset_index(drop=True), os.path.join(path + '.tmp', 'table-' + kind))
+
+    with open(os.path.join(path + '.tmp', 'meta.json'), 'w') as the_file:
+        json.dump({'zones': collection['zones'],
+                   'tables': sorted(collection['tables'])}, the_file)
+
+    if profile is not None:
+        with open(os.path.join(path + '.tmp', 'profile.json'), 'w') as the_file:
+            json.dump(profile, the_file, indent=2)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(path + '.tmp', path)
+    return path
+
+def _read_shard(path):
+    with open(os.path.join(path, 'meta.json'), 'r') as the_file:
+        meta = json.load(the_file)
+
+    def frame(name):
+        return read_frame(frame_file(os.path.join(path, name)))
+
+    projects = frame('projects').set_index('Rank')
+    projects.index.name = None
+    return {'projects': projects,
+            'inaccessible': frame('inaccessible'),
+            'zones': [str(zone) for zone in meta['zones']],
+            'tables': dict((str(kind), frame('table-' + kind)) for kind in meta['tables'])}
+
+def _shard_dirs(directory):
+    return sorted(path for path in glob.glob(os.path.join(directory, 'shard-*-of-*'))
+                  if _dir_pattern.search(path) and os.path.isdir(path))
+
+def remove_shards(directory):
+    """
+    Delete the shards in a directory
+    """
+
+    for path in _shard_dirs(directory):
+        shutil.rmtree(path)
+
+def read_profiles(directory):
+    """
+    Return the crawl statistics of the shards in a directory (shards without are skipped)
+    """
+
+    profiles = []
+    for path in _shard_dirs(directory):
+        if os.path.exists(os.path.join(path, 'profile.json')):
+            with open(os.path.join(path, 'profile.json'), 'r') as the_file:
+                profiles.append(json.load(the_file))
+    return profiles
+
+def read_shards(directory):
+    """
+    Return the collection of all shards in a directory
+
+    Fails if shards are missing, e.g. because a shard crawl has not finished.
+    """
+
+    paths = _shard_dirs(directory)
+    if not paths:
+        raise IOError("no shards found in %s" % directory)
+
+    counts = set(int(_dir_pattern.search(path).group(2)) for path in paths)
+    if len(counts) != 1 or len(paths) != counts.pop():
+        raise IOError("incomplete or mixed shards in %s: %s" % (
+            directory, ', '.join(os.path.basename(path) for path in paths)))
+
+    collections = [_read_shard(path) for path in paths]
+
+    # Projects in the order of get_projects (the shards keep its index)
+    projects = pd.concat([c['projects'] for c in collections]).sort_index()
+    rank = pd.Series(np.arange(len(projects)), index=projects['Project_ID'].values)
+
+    tables = {}
+    for kind in collections[0]['tables']:
+        parts = [c['tables'][kind] for c in collections]
+        table = pd.concat(parts, ignore_index=True)
+
+        # Dictionary encoding is lost when the categories of the shards differ
+        for column in parts[0].columns:
+            if hasattr(parts[0][column], 'cat') and not hasattr(table[column], 'cat'):
+                table[column] = table[column].astype('category')
+
+        if kind == 'IAM':
+            table = sort_iam(table)
+        else:
+            order = np.argsort(rank.reindex(table['Project_ID'].astype(object)).values,
+                               kind='mergesort')
+            table = table.iloc[order].reset_index(drop=True)
+        tables[kind] = table
+
+    zones = []
+    for collection in collections:
+        zones.extend(zone for zone in collection['zones'] if zone not in zones)
+
+    return {'projects': projects,
+            'inaccessible': pd.concat([c['inaccessible'] for c in collections],
+                                      ignore_index=True),
+            'zones': zones,
+            'tables': tables}
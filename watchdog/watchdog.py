@@ -9,36 +9,32 @@ Main Script which creates a report based on the configuration file (watchdog.yam
 
 """
 
-import datetime
 import os
+import sys
 import argparse
-import yaml
-import pkg_resources
-import pandas as pd
 
-from googleapiclient import discovery
-from oauth2client.service_account import ServiceAccountCredentials
-
-from jinja2 import Environment, FileSystemLoader
-
-from security.gcp_calls import get_projects, get_gcp_zones, get_instance_data
-from security.gcp_calls import get_firewall_data, get_people_access
-from security.alerts import check_projects, alert_projects, alert_zones
-from security.alerts import alert_instances, alert_firewalls, alert_iam
-
-from send_email import send_email
+from security.config import load_config, ConfigError
+from export import FORMATS
 
 def main():
     """
     Main function
     """
 
+    # Queries of the table history have their own arguments (see history_cli)
+    if sys.argv[1:2] == ['history']:
+        from history_cli import main as history_main
+        return history_main(sys.argv[2:])
+
     # Parse Command line arguments
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', '-c',
-                        dest='config_file',
-                        default="watchdog.yaml",
-                        help='Configuration file (required)')
+                        dest='config_files',
+                        nargs='+',
+                        default=["watchdog.yaml"],
+                        help="""Configuration files or directories of them (required).
+                        The inventory is collected once and every config gets its own
+                        report and receivers""")
     parser.add_argument('--email',
                         dest='email',
                         action='store_true',
@@ -51,6 +47,12 @@ def main():
                         dest='no_output',
                         action='store_true',
                         help="Don't output report file")
+    parser.add_argument('--format', '-f',
+                        dest='formats',
+                        default='html',
+                        help="""Comma separated output formats: html, csv, jsonl, parquet
+                        (default: html). Tables are written next to the report file,
+                        e.g. report_instances.csv""")
     parser.add_argument('--key', '-k',
                         dest='key_path',
                         help="""Absolute path of service account key (optional). 
@@ -61,15 +63,149 @@ def main():
                         help="""Absolute path of Sendgrid API key (optional).
                         On default SENDGRID_API_KEY is used""")
 
-    args = parser.parse_args()
+    parser.add_argument('--asset-export',
+                        dest='asset_export',
+                        help="""Read the inventory from a Cloud Asset Inventory export
+                        (newline-delimited JSON) instead of calling the GCP APIs""")
+    parser.add_argument('--record',
+                        dest='record',
+                        help="""Keep every GCP response and the discovery documents in
+                        this directory, to run the watchdog offline with --replay""")
+    parser.add_argument('--replay',
+                        dest='replay',
+                        help="""Answer the GCP calls with the responses recorded in this
+                        directory (with --record) instead of calling GCP""")
+    parser.add_argument('--synthetic',
+                        dest='synthetic',
+                        help="""Crawl a generated organization instead of GCP, e.g. 1000 or
+                        projects=1000,zones=8,instances=3,bindings=4,firewalls=3,denied=0
+                        (uses the cached discovery documents). Time it with --profile""")
+    parser.add_argument('--diff',
+                        dest='diff',
+                        action='store_true',
+                        help="Only report instances, IAM and firewalls that changed since the last run")
+    parser.add_argument('--refresh',
+                        dest='refresh',
+                        action='store_true',
+                        help="Don't read the inventory cache, fetch everything from GCP")
+    parser.add_argument('--profile',
+                        dest='profile_file',
+                        help="""Write the time, API calls, bytes, rows and peak memory of
+                        every stage and the API statistics per project to a JSON file""")
+    parser.add_argument('--daemon',
+                        dest='daemon',
+                        action='store_true',
+                        help="""Keep running: poll every section on its interval (daemon in
+                        watchdog.yaml), serve the latest report over HTTP and send it
+                        only when alerts appear or disappear""")
+    parser.add_argument('--audit-log',
+                        dest='audit_log',
+                        help="""With --daemon: follow a JSONL file of Admin Activity audit-log
+                        entries (e.g. written by the subscriber of a log sink) and patch
+                        the IAM, firewall and instance changes into the report within
+                        seconds. The polls then only reconcile the tables""")
+
+    parser.add_argument('--shard',
+                        dest='shard',
+                        help="""Only crawl shard INDEX/COUNT of the projects (e.g. 0/4) and
+                        write it to the shard directory instead of a report. Run every
+                        shard, e.g. on its own machine, then report with --merge""")
+    parser.add_argument('--merge',
+                        dest='merge',
+                        action='store_true',
+                        help="Report from the shards in the shard directory instead of crawling")
+    parser.add_argument('--processes',
+                        dest='processes',
+                        type=int,
+                        help="""Crawl the projects in this many local processes (one shard
+                        each), then report from the merged shards""")
+    parser.add_argument('--shard-dir',
+                        dest='shard_dir',
+                        default='.watchdog_shards',
+                        help='Directory of the shard files (default: .watchdog_shards)')
 
-    # Parse watchdog configuration file (watchdog.yaml)
-    with open(args.config_file, 'r') as ymlfile:
-        cfg = yaml.load(ymlfile)
+    args = parser.parse_args()
 
+    if sum(map(bool, [args.asset_export, args.record, args.replay, args.synthetic])) > 1:
+        parser.error("use only one of --asset-export, --record, --replay and --synthetic")
+    if args.synthetic:
+        from security.synthetic import parse_sizes
+        try:
+            args.synthetic = parse_sizes(args.synthetic)
+        except ValueError as error:
+            parser.error(str(error))
+    if args.daemon and args.asset_export:
+        parser.error("--daemon polls the GCP APIs and can't be used with --asset-export")
+    if args.audit_log and not args.daemon:
+        parser.error("--audit-log needs --daemon")
+    if args.daemon and (args.shard or args.merge or args.processes):
+        parser.error("--daemon can't be used with --shard, --merge or --processes")
+    if sum(map(bool, [args.shard, args.merge, args.processes])) > 1:
+        parser.error("use only one of --shard, --merge and --processes")
+    if args.processes is not None and args.processes < 1:
+        parser.error("--processes must be at least 1")
+    if args.shard:
+        from shards import parse_shard
+        try:
+            args.shard = parse_shard(args.shard)
+        except ValueError as error:
+            parser.error(str(error))
+
+    formats = [fmt.strip() for fmt in args.formats.split(',') if fmt.strip()]
+    for fmt in formats:
+        if fmt not in FORMATS:
+            parser.error("unknown format '%s' (choose from %s)" % (fmt, ', '.join(FORMATS)))
+
+    # Parse watchdog configuration files (watchdog.yaml)
+    try:
+        configs = load_configs(args.config_files)
+    except ConfigError as error:
+        parser.error(str(error))
+    if not configs:
+        parser.error("no configuration files found in %s" % ', '.join(args.config_files))
+    if args.daemon and len(configs) > 1:
+        parser.error("--daemon runs with a single configuration file")
 
     # Print header
     print "\n***** Google Cloud Platform Watchdog *****\n"
+    for _, config in configs:
+        print_config(config)
+
+    # Heavy dependencies (pandas, GCP clients) are only loaded from here on
+    from runner import run
+    run(args, configs, formats)
+
+def load_configs(paths):
+    """
+    Return (name, config) of every configuration file
+
+    Directories are replaced by the *.yaml and *.yml files they contain. The
+    name is the file name without extension. Raises a ConfigError for invalid files.
+    """
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.endswith(('.yaml', '.yml'))))
+        else:
+            files.append(path)
+
+    configs = []
+    for path in files:
+        # Validated and compiled once, then read from the compiled file (see security.config)
+        cfg = load_config(path)
+        for warning in cfg['warnings']:
+            print "Warning:", warning
+        configs.append((os.path.splitext(os.path.basename(path))[0], cfg))
+
+    return configs
+
+def print_config(cfg):
+    """
+    Print the title, receivers and requested reports of a config
+    """
+
     print 'Report Title:', cfg['general']['report-title']
     print "Watchdog email: ", cfg['general']['watchdog-email']
     print "Receivers: "
@@ -83,118 +219,7 @@ def main():
         print '- IAM'
     if cfg['firewall']['print']:
         print '- firewall'
-
-    # Get authentication and GCP APIs
-    if args.key_path:
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(args.key_path)
-    else: 
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'))
-
-    compute = discovery.build('compute', 'v1', credentials=credentials)
-    rm = discovery.build('cloudresourcemanager', 'v1', credentials=credentials)
-
-
-    # Get data and alerts from GCP
-    tables = []
-    table_titles = []
-
-    # Get projects
-    projects_columns = ['Name', 'Project_ID']
-    projects_data = get_projects(credentials)
-    projects = pd.DataFrame(projects_data, columns=projects_columns)
-    projects, inaccessible_projects = check_projects(compute, rm, projects)
-
-    projects = alert_projects(projects, cfg['general'])
-    project_IDs = projects['Project_ID'].tolist()
-
-    # Render table of unaccessible projects
-    colors = ['background-color: darkorange' for i in range(inaccessible_projects.shape[1])]
-    inaccessible_projects_styler = inaccessible_projects.style
-    if inaccessible_projects.shape[0] > 0:
-        inaccessible_projects_styler = inaccessible_projects_styler.apply(
-            lambda x: colors, axis=1)
-
-    inaccessible_projects_styler.set_table_attributes("border=1")
-    tables.append(inaccessible_projects_styler.render())
-    table_titles.append('Incaccessible Projects')
-
-    # Get zones
-    zone_columns = ['Name']
-    zones_data = get_gcp_zones(compute, project_IDs[0])
-    zones = pd.DataFrame(zones_data, columns=zone_columns)
-    zones = alert_zones(zones, cfg['general'])
-    zones = zones['Name'].tolist()
-
-    if cfg['compute']['print']:
-        instances_coulmns = ['Instance', 'Status', 'Machine_type', 'Project_ID', 'Zone']
-
-        instance_data = get_instance_data(compute, project_IDs, zones)
-        instances = pd.DataFrame(instance_data, columns=instances_coulmns)
-
-        # Get alerts and filters
-        instances, alerted_instances_styler = alert_instances(instances, cfg['compute'])
-
-        tables.append(alerted_instances_styler.render())
-        table_titles.append('Instances')
-
-
-    if cfg['IAM']['print']:
-        iam_coulmns = ['Project_ID', 'Name', 'Email', 'Email_suffix', 'Account_type', 'Role',]
-
-        iam_data = get_people_access(rm, project_IDs)
-        iam = pd.DataFrame(iam_data, columns=iam_coulmns)
-        iam = iam.groupby(['Project_ID', 'Name', 'Email', 'Email_suffix', 'Account_type'])['Role']\
-        .apply(list).reset_index()
-
-        # Get alerts and filters
-        alerted_iam, alerted_iam_styler = alert_iam(iam, cfg['IAM'])
-
-        tables.append(alerted_iam_styler.render())
-        table_titles.append('IAM')
-
-
-    if cfg['firewall']['print']:
-        firewalls_columns = ['Project_ID', 'Rule_name', 'Range',
-                             'Protocol', 'Port', 'Firewall_type']
-
-        firewall_data = get_firewall_data(compute, project_IDs)
-        firewalls = pd.DataFrame(firewall_data, columns=firewalls_columns)
-
-        # Get alerts and filters
-        alerted_firewalls, alerted_firewalls_styler = alert_firewalls(firewalls, cfg['firewall'])
-
-        tables.append(alerted_firewalls_styler.render())
-        table_titles.append('Firewalls')
-
-
-    # Create report
-
-    # Construct email content
-    templates_folder = pkg_resources.resource_filename('templates','')
-    env = Environment(loader=FileSystemLoader(templates_folder))
-    content = {'title': cfg['general']['report-title'] + '  ' + str(datetime.datetime.now())[:-7],
-               'num_tables': len(tables),
-               'table_titles': table_titles,
-               'tables' : tables
-              }
-    # Render HTML
-    html = env.get_template('daily_report.html').render(content)
-    subject = cfg['general']['report-title']
-
-
-    # Write report to file
-    if not args.no_output:
-        report_file_path = args.report_file
-        with open(report_file_path, 'w') as the_file:
-            the_file.write(html)
-
-    # Send email (needs email client to be configured)
-    if args.email:
-        for to_email in cfg['general']['receiver-email']:
-            send_email(html, cfg['general']['watchdog-email'], to_email['email'], 
-                        subject, args.sendgrid_key)
-
+    print
 
 if __name__ == "__main__":
     main()